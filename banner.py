@@ -0,0 +1,149 @@
+import re
+import ssl
+
+import trio
+
+import defaults
+from tlscert import CertificateError, insecure_tls_context, parse_certificate
+
+# Sent only when the server keeps quiet, most HTTP-ish services answer it and everything else just closes
+HTTP_PROBE = b"HEAD / HTTP/1.0\r\n\r\n"
+TLS_ALERT = b'\x15\x03'
+SERVER_HEADER_RE = re.compile(rb'^server:[ \t]*(.+?)\r?$', re.IGNORECASE | re.MULTILINE)
+SMTP_PORTS = (25, 465, 587, 2525)
+# smtps, ftps, imaps, pop3s
+TLS_SERVER_FIRST_PORTS = (465, 990, 993, 995)
+
+
+def _decode(data):
+    return data.decode('utf-8', 'replace').strip()
+
+
+def _first_line(data):
+    return _decode(data.split(b'\n', 1)[0])
+
+
+def identify_service(banner, port=None):
+    # (service, product) from the first bytes a service sends, None for whatever isn't recognized
+    if not banner:
+        return None, None
+    line = _first_line(banner)
+
+    if banner.startswith(b'SSH-'):
+        # SSH-2.0-OpenSSH_8.9p1 Ubuntu-3
+        return 'ssh', line.split('-', 2)[-1] or None
+    if banner.startswith(b'HTTP/'):
+        server = SERVER_HEADER_RE.search(banner)
+        return 'http', _decode(server.group(1)) if server else None
+    if banner.startswith(b'220'):
+        upper = banner.upper()
+        if b'SMTP' in upper or b'POSTFIX' in upper or b'EXIM' in upper or (b'FTP' not in upper and port in SMTP_PORTS):
+            return 'smtp', line[4:] or None
+        return 'ftp', line[4:] or None
+    if banner.startswith(b'+OK'):
+        return 'pop3', line[4:] or None
+    if banner.startswith(b'* OK'):
+        return 'imap', line[5:] or None
+    if banner.startswith(TLS_ALERT):
+        return 'tls', None
+    if len(banner) > 5 and banner[4] == 0x0a:
+        # MySQL greeting: 3 byte length, sequence id, protocol 10, NUL terminated server version
+        version = banner[5:].split(b'\0', 1)[0]
+        if version and version[:1].isdigit():
+            return 'mysql', _decode(version)
+    if banner.startswith(b'-ERR') or banner.startswith(b'-NOAUTH') or banner.startswith(b'-DENIED'):
+        return 'redis', None
+    return None, None
+
+
+async def _read(stream, max_bytes, wait, gap):
+    # Whatever arrives within `wait`, then keep going only while more follows within `gap`
+    data = b''
+    with trio.move_on_after(wait):
+        data = await stream.receive_some(max_bytes)
+    while data and len(data) < max_bytes:
+        chunk = None
+        with trio.move_on_after(gap):
+            try:
+                chunk = await stream.receive_some(max_bytes - len(data))
+            except trio.BrokenResourceError:
+                # Plenty of TLS servers hang up without a close_notify, what came before still counts
+                pass
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+async def _exchange(stream, max_bytes, wait, gap, server_first=True):
+    # Server-first protocols talk right away, for the rest an HTTP request is the most likely to get an answer
+    if server_first:
+        data = await _read(stream, max_bytes, wait, gap)
+        if data:
+            return data
+    await stream.send_all(HTTP_PROBE)
+    return await _read(stream, max_bytes, wait, gap)
+
+
+def _looks_like_tls(data):
+    # A TLS alert, a web server complaining about plain HTTP on its HTTPS port, or nothing at all even to the probe
+    return not data or data.startswith(TLS_ALERT) or b'HTTP request was sent to HTTPS' in data
+
+
+async def _grab(ip, port, tls, server_name, max_bytes, wait, gap):
+    stream = await trio.open_tcp_stream(ip, port)
+    cert = None
+    try:
+        if tls:
+            stream = trio.SSLStream(stream, insecure_tls_context(), server_hostname=server_name)
+            await stream.do_handshake()
+            der = stream.getpeercert(binary_form=True)
+            try:
+                cert = parse_certificate(der) if der else None
+            except CertificateError:
+                pass
+        try:
+            # A TLS stream is broken once a read is cancelled, so over TLS only the known server-first ports are
+            # waited on and everything else gets the probe straight away
+            data = await _exchange(stream, max_bytes, wait, gap, server_first=not tls or port in TLS_SERVER_FIRST_PORTS)
+        except trio.BrokenResourceError:
+            # Closed on us after the handshake, the certificate is still worth having
+            data = b''
+        return data, cert
+    finally:
+        await trio.aclose_forcefully(stream)
+
+
+async def _try_grab(*args):
+    try:
+        return await _grab(*args)
+    except (trio.BrokenResourceError, ssl.SSLError, OSError):
+        return None
+
+
+async def grab_banner(ip, port, server_name=None, tls=None, timeout=defaults.BANNER_TIMEOUT,
+                      wait=defaults.BANNER_READ_WAIT, max_bytes=defaults.BANNER_MAX_BYTES, gap=defaults.BANNER_READ_GAP):
+    # At most max_bytes read and timeout spent per port, a second connection only when the first guess about TLS
+    # was wrong
+    tls = port in defaults.TLS_PORTS if tls is None else tls
+    grabbed = None
+    with trio.move_on_after(timeout):
+        grabbed = await _try_grab(ip, port, tls, server_name, max_bytes, wait, gap)
+        if grabbed is None and tls:
+            tls = False
+            grabbed = await _try_grab(ip, port, tls, server_name, max_bytes, wait, gap)
+        elif grabbed is not None and not tls and _looks_like_tls(grabbed[0]):
+            secure = await _try_grab(ip, port, True, server_name, max_bytes, wait, gap)
+            if secure is not None:
+                tls, grabbed = True, secure
+
+    data, cert = grabbed or (b'', None)
+    service, product = identify_service(data, port)
+    if tls and cert is not None:
+        service = service + 's' if service in ('http', 'ftp', 'smtp', 'pop3', 'imap') else service or 'tls'
+    return {
+        'banner': _decode(data) or None,
+        'service': service,
+        'product': product,
+        'tls': cert,
+    }
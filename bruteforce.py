@@ -1,47 +1,57 @@
+import itertools
 import time
-import trio
+from contextlib import AsyncExitStack
 
 from tqdm import tqdm
 
 import defaults
+from dnscache import get_dns_cache
+from dnsengine import open_dns_engine, WildcardFilter
+from fingerprint import build_baseline
+from httpclient import HttpClient
 from primitives import fetch_url, query_dns
-from utils import init_source, random_string, append_subdomain
+from utils import iter_wordlist, count_lines, append_subdomain, run_worker_pool, info
 
 
-async def bruteforce_urls(base_url, iterator, url_builder, valid_status_codes=None):
-    limit = trio.CapacityLimiter(defaults.DEFAULT_CONNECTION_COUNT)
+async def bruteforce_urls(base_url, iterator, url_builder, valid_status_codes=None, session=None,
+                          method=defaults.HTTP_PROBE_METHOD, on_found=None):
+    if session is None:
+        session = HttpClient()
     if valid_status_codes is None:
         valid_status_codes = defaults.DEFAULT_VALID_STATUS_CODES
 
     valid_status_codes = set(valid_status_codes)
 
     start_time = time.time()
-    total = sum([1 for _ in init_source(iterator)])
-    source = init_source(iterator)
-
     if isinstance(base_url, str):
         base_url = [base_url]
 
-    async with trio.open_nursery() as nursery:
-        results = []
-        for _url in base_url:
-            for item in [random_string(30, defaults.ALLOWED_CHARS) for _ in range(30)]:
-                url = url_builder(_url, item)
-                nursery.start_soon(fetch_url, url, results, limit, valid_status_codes)
-
-    if results:
-        wildcard_status_codes = set([item[1] for item in results])
-        print(f"Found Wildcard Status Codes: {wildcard_status_codes}, removing them from the Valid Status Codes List")
-        valid_status_codes = valid_status_codes.difference(wildcard_status_codes)
-        print(f"Valid Status Codes: {valid_status_codes}")
-
-    async with trio.open_nursery() as nursery:
-        results = []
-        pbar = tqdm(total=total)
-        for _url in base_url:
-            for item in source:
-                url = url_builder(_url, item)
-                nursery.start_soon(fetch_url, url, results, limit, valid_status_codes, pbar)
+    total = count_lines(iterator)
+    if total is not None:
+        total *= len(base_url)
+
+    baselines = {}
+
+    async def probe_baseline(_url):
+        # Always with bodies, HEAD candidates that look like a soft-404 are compared to them with a GET
+        baseline = await build_baseline(session, _url, url_builder, method='GET', follow_redirects=False,
+                                        timeout=defaults.DEFAULT_TIMEOUT)
+        baselines[baseline.host] = baseline
+        soft_404s = {code: fps for code, fps in baseline.fingerprints.items() if code in valid_status_codes}
+        if soft_404s:
+            print(f"Found Wildcard Responses for {baseline.host}: {soft_404s}, filtering responses that look like them")
+
+    await run_worker_pool(base_url, probe_baseline, workers=defaults.DEFAULT_CONNECTION_COUNT)
+
+    results = []
+    pbar = tqdm(total=total)
+
+    async def probe(url):
+        await fetch_url(url, session, results, valid_status_codes, pbar, method,
+                        baselines.get(session.host_key(url)), on_found)
+
+    urls = (url_builder(_url, item) for item in iter_wordlist(iterator) for _url in base_url)
+    await run_worker_pool(urls, probe, workers=defaults.DEFAULT_CONNECTION_COUNT)
 
     end_time = time.time()
     print(f"Total Time: {end_time - start_time}s")
@@ -49,30 +59,42 @@ async def bruteforce_urls(base_url, iterator, url_builder, valid_status_codes=No
     return results
 
 
-async def bruteforce_subdomains(domain, iterator, nameservers):
-    limit = trio.CapacityLimiter(defaults.DNS_LIMIT)
-
+async def bruteforce_subdomains(domain, iterator, nameservers, engine=None, on_found=None, start=0,
+                                on_progress=None):
     start_time = time.time()
-    source = list(init_source(iterator))
+    source = itertools.islice(iter_wordlist(iterator), start, None)
 
     results = []
-    pbar = tqdm(total=len(source))
-
-    while True:
-        batch, source = source[:defaults.DNS_BATCH_SZ], source[defaults.DNS_BATCH_SZ:]
-        if not batch:
-            break
-        async with trio.open_nursery() as nursery:
-            for item in batch:
-                subdomain = append_subdomain(domain, item)
-                nursery.start_soon(
-                    query_dns,
-                    subdomain,
-                    nameservers,
-                    results,
-                    limit,
-                    pbar
-                )
+    pbar = tqdm(total=count_lines(iterator), initial=start)
+    # Words finish out of order, the offset only moves past a word once everything before it is done
+    offset = start
+    finished = set()
+
+    async with AsyncExitStack() as stack:
+        if engine is None:
+            engine = await stack.enter_async_context(
+                open_dns_engine(nameservers, check_resolvers=True, cache=get_dns_cache()))
+
+        wildcards = WildcardFilter(engine)
+        await wildcards.wildcard_answers(domain)
+
+        async def resolve(item):
+            nonlocal offset
+            index, subdomain = item
+            answer = await query_dns(subdomain, engine, results, pbar, wildcards=wildcards)
+            if on_found is not None and answer and answer.addresses:
+                await on_found(subdomain, answer.addresses)
+
+            finished.add(index)
+            while offset in finished:
+                finished.remove(offset)
+                offset += 1
+            if on_progress is not None:
+                on_progress(offset)
+
+        subdomains = enumerate((append_subdomain(domain, item) for item in source), start)
+        await run_worker_pool(subdomains, resolve, workers=defaults.DNS_LIMIT)
+        info(f"Resolvers: {engine.pool.summary()}, DNS cache: {engine.cache.stats() if engine.cache else None}")
 
     end_time = time.time()
     print(f"Total Time: {end_time - start_time}s")
@@ -0,0 +1,65 @@
+import os
+import pickle
+import time
+
+import trio
+
+import defaults
+from store import EntityStore
+from utils import info, warning
+
+
+class Checkpoint(object):
+    # Entity store, which entities every stage is done with, and whatever progress stages keep mid-entity.
+    # Pickled instead of JSON so keys and tuples come back the way they were written.
+
+    def __init__(self, path, max_age=None, interval=defaults.CHECKPOINT_INTERVAL):
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+        self.interval = interval
+        self.store = None
+        self.done = {}
+        self.progress = {}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as handle:
+                    state = pickle.load(handle)
+                self.store, self.done, self.progress = state['store'], state['done'], state['progress']
+                info(f"Resuming from {self.path}, saved {time.ctime(state['saved'])}")
+            except (OSError, EOFError, KeyError, pickle.UnpicklingError) as e:
+                warning(f"Ignoring unreadable checkpoint {self.path}: {e!r}")
+
+    @staticmethod
+    def key(entity):
+        return EntityStore.key(entity.type, entity.value, entity.parent)
+
+    def is_done(self, stage, entity):
+        finished = self.done.get(stage, {}).get(self.key(entity))
+        if finished is None:
+            return False
+        return self.max_age is None or time.time() - finished < self.max_age
+
+    def mark_done(self, stage, entity):
+        self.done.setdefault(stage, {})[self.key(entity)] = time.time()
+
+    def stage_progress(self, stage):
+        return self.progress.setdefault(stage, {})
+
+    def save(self):
+        if self.store is None:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        state = {'store': self.store, 'done': self.done, 'progress': self.progress, 'saved': time.time()}
+        # Write next to the old checkpoint and swap, a crash mid-write must not lose both
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    async def autosave(self):
+        while True:
+            await trio.sleep(self.interval)
+            self.save()
@@ -1,6 +1,20 @@
 import string
 
 DEFAULT_CONNECTION_COUNT = 100
+DOMAIN_CONCURRENCY = 10
+HTTP_CONNECTIONS_PER_HOST = 20
+HTTP_MAX_HOSTS = 256
+HTTP_INITIAL_WINDOW = 4
+HTTP_DECREASE_INTERVAL = 1
+HTTP_BACKOFF_STATUS_CODES = (429, 503)
+HTTP_BACKOFF_BASE = 0.5
+HTTP_MAX_RETRY_AFTER = 120
+HTTP_PROBE_METHOD = 'HEAD'
+HTTP_PROBE_MAX_BODY = 16384
+HTTP_HEAD_REJECTED_STATUS_CODES = (400, 405, 501)
+HTTP_LENGTH_BUCKET = 256
+HTTP_SIMHASH_DISTANCE = 6
+HTTP_BASELINE_PROBES = 6
 DEFAULT_TIMEOUT = 10
 DEFAULT_RETRIES = 5
 DEFAULT_VALID_STATUS_CODES = [200, 204, 301, 302, 307, 401, 403]
@@ -9,7 +23,50 @@ USER_AGENTS = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:78.0) Gecko/20100101 Firefox/78.0",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.105 Safari/537.36",
 )
-DNS_BATCH_SZ = 2000
 DNS_LIMIT = 2000
-PORT_SCAN_LIMIT = 100
-PORT_SCAN_TIMEOUT = 2
\ No newline at end of file
+DNS_SOCKETS = 4
+DNS_TIMEOUT = 3
+DNS_RETRIES = 4
+DNS_POISON_CHECK_DOMAIN = 'example.com'
+DNS_WILDCARD_PROBES = 5
+DNS_CACHE_PATH = '~/.digr/dns_cache.sqlite'
+DNS_CACHE_SIZE = 100000
+DNS_CACHE_FLUSH_SZ = 1000
+DNS_CACHE_MIN_TTL = 60
+DNS_CACHE_MAX_TTL = 86400
+DNS_NEGATIVE_TTL = 3600
+RESOLVER_MAX_FAILURES = 3
+RESOLVER_BENCH_TIME = 30
+PORT_SCAN_LIMIT = 4096
+PORT_SCAN_HOST_LIMIT = 512
+PORT_SCAN_TIMEOUT = 2
+PORT_SCAN_MIN_TIMEOUT = 0.25
+PORT_SCAN_RETRIES = 1
+PORT_SCAN_FD_RESERVE = 256
+PORT_SCAN_MAX_FDS = 65536
+PORT_SCAN_BACKOFF = 0.1
+HOST_DISCOVERY_PORTS = (80, 443, 22, 445, 3389, 21, 25, 8080)
+HOST_DISCOVERY_TIMEOUT = 1.5
+HOST_CACHE_PATH = '~/.digr/hosts.sqlite'
+HOST_CACHE_FLUSH_SZ = 100
+HOST_ALIVE_TTL = 21600
+HOST_DEAD_TTL = 3600
+CHECKPOINT_INTERVAL = 60
+BANNER_TIMEOUT = 5
+BANNER_READ_WAIT = 2
+BANNER_READ_GAP = 0.25
+BANNER_MAX_BYTES = 2048
+BANNER_CONCURRENCY = 256
+TLS_PORTS = (443, 465, 636, 853, 989, 990, 992, 993, 995, 2083, 2087, 3269, 4443, 5986, 8443, 9443)
+CDN_RANGES_PATH = 'data/cdn_ranges.txt'
+CDN_SAMPLE_SIZE = 1
+NETWORK_BUCKET_V4 = 24
+NETWORK_BUCKET_V6 = 48
+NETWORK_TOP_GROUPS = 10
+VHOST_CONNECTIONS_PER_IP = 4
+SCHEME_PORTS = {'http': 80, 'https': 443}
+HTTP_MAX_REDIRECTS = 5
+HTTP_FAVICON_MAX_BODY = 262144
+SCRAPER_TIMEOUT = 60
+SCRAPER_RATE = 1
+SCRAPER_BURST = 2
\ No newline at end of file
@@ -1,14 +1,25 @@
 import json
+import sys
 import yaml
 import atexit
+import urllib.parse as urlparse
 from functools import partial
 
 import trio
 import click
 
+import defaults
 from bruteforce import bruteforce_urls, bruteforce_subdomains
+from checkpoint import Checkpoint
+from dnscache import close_dns_cache
+from hostcache import close_host_cache, get_host_cache
+from httpclient import HttpClient
+from pipeline.runner import run_pipeline
+from portscan import HostDiscovery, PortScanEngine, parse_port_spec, scan_hosts, service_name
 from scrape import scrape_subdomains, SCRAPERS
-from utils import append_path, append_subdomain, warning
+from sink import SINKS, fold_records, make_record, open_sink, read_records
+from store import EntityStore
+from utils import append_path, info, iter_wordlist, warning
 import pipeline.domain
 import pipeline.http
 import pipeline.ip
@@ -22,16 +33,35 @@ COMPLETE_PIPELINE = [
     # pipeline.domain.SubdomainBruteForceTransformer,
     pipeline.ip.IPAddressTransformer,
     # pipeline.ip.GeoIPTransformer,
+    # pipeline.ip.NetworkAggregatorTransformer,
     # pipeline.http.HttpProbeTransformer,
+    # pipeline.domain.SubdomainCertificateTransformer,
     # pipeline.url.SensitiveURLFinderTransformer,
-    pipeline.port.PortScannerTransformer
+    pipeline.port.PortScannerTransformer,
+    # pipeline.port.BannerGrabberTransformer,
 ]
 
 
+TRANSFORMERS = {T.__name__: T for T in [
+    pipeline.domain.SubdomainScraperTransformer,
+    pipeline.domain.SubdomainWebsiteScraperTransformer,
+    pipeline.domain.SubdomainBruteForceTransformer,
+    pipeline.ip.IPAddressTransformer,
+    pipeline.ip.GeoIPTransformer,
+    pipeline.ip.NetworkAggregatorTransformer,
+    pipeline.http.HttpProbeTransformer,
+    pipeline.domain.SubdomainCertificateTransformer,
+    pipeline.url.SensitiveURLFinderTransformer,
+    pipeline.port.PortScannerTransformer,
+    pipeline.port.BannerGrabberTransformer,
+]}
+
+
 OUTPUT_FORMATTERS = {
     'json': partial(json.dump, indent=2),
     'yaml': yaml.dump,
 }
+OUTPUT_FORMATS = list(OUTPUT_FORMATTERS) + list(SINKS)
 
 
 @click.group()
@@ -39,59 +69,168 @@ def cli():
     pass
 
 
+def load_profile(path):
+    # JSON is a subset of YAML, so one loader covers both
+    with open(path, 'r') as handle:
+        profile = yaml.safe_load(handle) or {}
+
+    unknown = [name for name in profile.get('stages', []) if name not in TRANSFORMERS]
+    if unknown:
+        raise click.BadParameter(f"Unknown stages: {', '.join(unknown)}", param_hint='--profile')
+    return profile
+
+
+def select_transformers(profile):
+    if profile is None:
+        for T in COMPLETE_PIPELINE:
+            if T.ESSENTIAL or click.confirm(f"[{'PASSIVE' if T.PASSIVE else 'ACTIVE'}] "
+                                            f"Do you want to run '{T.__name__}'", default=T.RECOMMENDED):
+                yield T
+            else:
+                warning(f"Skipping {T.__name__} ...")
+    elif 'stages' in profile:
+        for name in profile['stages']:
+            yield TRANSFORMERS[name]
+    else:
+        for T in COMPLETE_PIPELINE:
+            if T.ESSENTIAL or T.RECOMMENDED:
+                yield T
+
+
 @cli.command()
-@click.option('--domain', prompt='Domain', help='Domain to find subdomains for', multiple=True)
+@click.option('--domain', help='Domain to find subdomains for', multiple=True)
+@click.option('--batch', default=None, type=click.Path(exists=True), help='File with one domain per line')
+@click.option('--profile', default=None, type=click.Path(exists=True),
+              help='YAML/JSON run profile with stages and their options, nothing is prompted for')
+@click.option('--concurrency', default=None, type=int, help='Max domains investigated at once')
+@click.option('--checkpoint', default=None, help='File the run is periodically saved to and resumed from')
+@click.option('--max-age', default=None, type=float,
+              help='Hours after which checkpointed results are stale and redone')
 @click.option('--output', default=None, help='File to save results to')
-@click.option('--output-format', default='json', help='File to save results to')
-def investigate(domain, output, output_format):
+@click.option('--output-format', default='json', type=click.Choice(OUTPUT_FORMATS),
+              help='ndjson and msgpack stream a record per finding as it is found, the others are written at the end')
+def investigate(domain, batch, profile, concurrency, checkpoint, max_age, output, output_format):
+    profile = load_profile(profile) if profile else None
+    if batch and profile is None:
+        # Batch runs are unattended, stick to the defaults
+        profile = {}
+
     config = {}
-    data = {
-        'domains': {}
-    }
-    for d in domain:
-        data['domains'][d] = {
-            'type': 'domain',
-            'value': d
-        }
-
-    for T in COMPLETE_PIPELINE:
-        if not T.ESSENTIAL:
-            run_transformer = click.confirm(f"[{'PASSIVE' if T.PASSIVE else 'ACTIVE'}] "
-                                            f"Do you want to run '{T.__name__}'", default=T.RECOMMENDED)
-        else:
-            run_transformer = True
-
-        if not run_transformer:
-            warning(f"Skipping {T.__name__} ...")
-
-        if run_transformer:
-            t = T(data, config=config)
-            t.setup()
-            data = t.run()
-            # print(json.dumps(data, indent=2))
-            input("Press Enter ...")
-
-    # print(json.dumps(data, indent=2))
+    store = EntityStore()
+    if profile is not None:
+        config['options'] = profile.get('options', {})
+        concurrency = concurrency or profile.get('concurrency', defaults.DOMAIN_CONCURRENCY)
+        checkpoint = checkpoint or profile.get('checkpoint')
+        max_age = max_age or profile.get('max_age')
 
-    if output:
+    if checkpoint:
+        checkpoint = config['checkpoint'] = Checkpoint(checkpoint, max_age=max_age * 3600 if max_age else None)
+        if checkpoint.store is not None:
+            store = checkpoint.store
+
+    domains = list(domain)
+    if batch:
+        domains.extend(iter_wordlist(batch))
+    if not domains:
+        # Resuming without naming domains picks up the ones from the checkpoint
+        domains.extend([record.value for record in store.roots('domain')] or [click.prompt('Domain')])
+    domains = list(dict.fromkeys(domains))
+
+    stages = []
+    for T in select_transformers(profile):
+        t = T(store, config=config)
+        t.setup()
+        stages.append(t)
+
+    sink = open_sink(output, output_format) if output and output_format in SINKS else None
+    try:
+        store = trio.run(partial(run_pipeline, store, stages, domains, concurrency,
+                                 checkpoint=config.get('checkpoint'), sink=sink))
+    finally:
+        if sink is not None:
+            sink.close()
+
+    if output and output_format in OUTPUT_FORMATTERS:
         with open(output, 'w') as o_handle:
-            OUTPUT_FORMATTERS[output_format](data, o_handle)
+            OUTPUT_FORMATTERS[output_format](store.to_dict(), o_handle)
 
 
 @cli.command()
 @click.option('--url', prompt='URL', help='Base URL to bust')
 @click.option('--wordlist', default='data/dirs.txt', help='Wordlist used for brute-forcing')
-def dirbust(url, wordlist):
-    results = trio.run(bruteforce_urls, url, wordlist, append_path)
-    print(results)
+@click.option('--connections', default=defaults.DEFAULT_CONNECTION_COUNT, help='Max concurrent connections')
+@click.option('--connections-per-host', default=defaults.HTTP_CONNECTIONS_PER_HOST,
+              help='Max concurrent connections to a single host')
+@click.option('--method', default=defaults.HTTP_PROBE_METHOD, type=click.Choice(['HEAD', 'GET']),
+              help='HEAD probes fall back to GET when the server rejects HEAD')
+@click.option('--max-body', default=defaults.HTTP_PROBE_MAX_BODY, help='Max response body bytes read per GET')
+@click.option('--output', default=None, help='File to stream found paths to')
+@click.option('--output-format', default='ndjson', type=click.Choice(list(SINKS)))
+def dirbust(url, wordlist, connections, connections_per_host, method, max_body, output, output_format):
+    session = HttpClient(connections=connections, connections_per_host=connections_per_host, max_body=max_body)
+    if not output:
+        results = trio.run(partial(bruteforce_urls, url, wordlist, append_path, session=session, method=method))
+        print(results)
+        return
+
+    sink = open_sink(output, output_format)
+
+    async def on_found(found_url, response):
+        parsed = urlparse.urlparse(found_url)
+        sink.write(make_record('path', parsed.path, {
+            'type': 'path',
+            'value': parsed.path,
+            'status_code': response.status_code,
+            'length': response.length,
+        }, parsed.netloc))
+
+    try:
+        trio.run(partial(bruteforce_urls, url, wordlist, append_path, session=session, method=method,
+                         on_found=on_found))
+    finally:
+        sink.close()
 
 
 @cli.command()
 @click.option('--domain', prompt='Domain', help='Domain to find subdomains for')
 @click.option('--wordlist', default='data/names.txt', help='Wordlist used for brute-forcing')
-def domainbust(domain, wordlist):
-    results = trio.run(bruteforce_subdomains, domain, wordlist, append_subdomain)
-    print(results)
+@click.option('--resolvers', default='data/resolvers.txt', help='List of DNS resolvers')
+@click.option('--output', default=None, help='File to stream found subdomains to')
+@click.option('--output-format', default='ndjson', type=click.Choice(list(SINKS)))
+def domainbust(domain, wordlist, resolvers, output, output_format):
+    nameservers = list(iter_wordlist(resolvers))
+    if not output:
+        results = trio.run(bruteforce_subdomains, domain, wordlist, nameservers)
+        print(results)
+        return
+
+    sink = open_sink(output, output_format)
+    sink.write(make_record('domain', domain, {'type': 'domain', 'value': domain}))
+
+    async def on_found(subdomain, ip_addresses):
+        sink.write(make_record('domain', subdomain, {'type': 'domain', 'value': subdomain, 'sources': ['brute']},
+                               domain))
+        for ip in ip_addresses:
+            sink.write(make_record('ip_address', ip, {'type': 'ip_address', 'value': ip}, subdomain))
+
+    try:
+        trio.run(partial(bruteforce_subdomains, domain, wordlist, nameservers, on_found=on_found))
+    finally:
+        sink.close()
+
+
+@cli.command()
+@click.argument('records', type=click.Path(exists=True))
+@click.option('--input-format', default='ndjson', type=click.Choice(list(SINKS)))
+@click.option('--output', default=None, help='File to save the folded document to, printed when not given')
+@click.option('--output-format', default='json', type=click.Choice(list(OUTPUT_FORMATTERS)))
+def fold(records, input_format, output, output_format):
+    data = fold_records(read_records(records, input_format))
+    if output:
+        with open(output, 'w') as o_handle:
+            OUTPUT_FORMATTERS[output_format](data, o_handle)
+    else:
+        OUTPUT_FORMATTERS[output_format](data, sys.stdout)
 
 
 @cli.command()
@@ -101,6 +240,35 @@ def domainscrape(domain):
     print(results)
 
 
+@cli.command()
+@click.option('--ip', multiple=True, help='IP address to scan')
+@click.option('--targets', default=None, type=click.Path(exists=True), help='File with one IP address per line')
+@click.option('--ports', default='top-1000', help='Port file, list like 22,80,8000-8100, top-1000 or all')
+@click.option('--connections', default=defaults.PORT_SCAN_LIMIT, help='Max connects in flight')
+@click.option('--connections-per-host', default=defaults.PORT_SCAN_HOST_LIMIT,
+              help='Max connects in flight to a single host')
+@click.option('--timeout', default=defaults.PORT_SCAN_TIMEOUT, type=float,
+              help='Connect timeout, shrinks to fit the RTT measured for each host')
+@click.option('--skip-discovery', is_flag=True, help='Scan every host, even those that look dead')
+def portscan(ip, targets, ports, connections, connections_per_host, timeout, skip_discovery):
+    ips = list(ip)
+    if targets:
+        ips.extend(iter_wordlist(targets))
+    ports = parse_port_spec(ports)
+    engine = PortScanEngine(connections=connections, per_host=connections_per_host, timeout=timeout)
+    discovery = None if skip_discovery else HostDiscovery(engine, get_host_cache())
+
+    async def on_scanned(address, results):
+        for port, status in sorted(results.items()):
+            if status == 'open':
+                print(f"{address}\t{port}\t{ports[port] or service_name(port) or ''}")
+
+    trio.run(scan_hosts, engine, ips, ports, on_scanned, discovery)
+    info(f"Port scan: {engine.stats()}")
+    if discovery is not None:
+        info(f"Host discovery: {discovery.stats()}")
+
+
 @cli.command()
 def testing():
     results = trio.run(tcp_scan)
@@ -115,7 +283,8 @@ async def tcp_scan(timeout=2):
 
 @atexit.register
 def cleanup():
-    pass
+    close_dns_cache()
+    close_host_cache()
 
 
 if __name__ == "__main__":
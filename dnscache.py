@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import defaults
+
+
+class DNSCache(object):
+    def __init__(self, path=defaults.DNS_CACHE_PATH, size=defaults.DNS_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._writes = []
+        self.db = None
+
+        if path:
+            path = os.path.expanduser(path)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS dns_cache ("
+                "name TEXT, rdtype TEXT, rcode INTEGER, addresses TEXT, cnames TEXT, expires REAL, "
+                "PRIMARY KEY (name, rdtype))"
+            )
+            self.db.execute("DELETE FROM dns_cache WHERE expires < ?", (time.time(), ))
+            self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, name, rdtype):
+        key = (name.lower(), rdtype)
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            row = self.db.execute(
+                "SELECT rcode, addresses, cnames, expires FROM dns_cache WHERE name = ? AND rdtype = ?", key
+            ).fetchone()
+            if row:
+                entry = (row[0], json.loads(row[1]), json.loads(row[2]), row[3])
+                self._remember(key, entry)
+
+        if entry is None or entry[3] < time.time():
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, answer):
+        if answer.rcode is None:
+            # Timeouts say nothing about the name
+            return
+
+        if answer.addresses or answer.cnames:
+            ttl = min(max(answer.ttl or 0, defaults.DNS_CACHE_MIN_TTL), defaults.DNS_CACHE_MAX_TTL)
+        else:
+            # NXDOMAIN and NOERROR without data
+            ttl = defaults.DNS_NEGATIVE_TTL
+
+        key = (answer.name.lower(), answer.rdtype)
+        entry = (answer.rcode, list(answer.addresses), list(answer.cnames), time.time() + ttl)
+        self._remember(key, entry)
+
+        if self.db is not None:
+            self._writes.append(key + (entry[0], json.dumps(entry[1]), json.dumps(entry[2]), entry[3]))
+            if len(self._writes) >= defaults.DNS_CACHE_FLUSH_SZ:
+                self.flush()
+
+    def flush(self):
+        if self.db is None or not self._writes:
+            return
+        self.db.executemany("INSERT OR REPLACE INTO dns_cache VALUES (?, ?, ?, ?, ?, ?)", self._writes)
+        self.db.commit()
+        self._writes = []
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+_dns_cache = None
+
+
+def get_dns_cache():
+    global _dns_cache
+    if _dns_cache is None:
+        _dns_cache = DNSCache()
+    return _dns_cache
+
+
+def close_dns_cache():
+    global _dns_cache
+    if _dns_cache is not None:
+        _dns_cache.close()
+        _dns_cache = None
@@ -0,0 +1,406 @@
+import heapq
+import random
+import struct
+import time
+from contextlib import asynccontextmanager
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import trio
+
+import defaults
+from utils import random_string, warning
+
+
+class DNSAnswer(object):
+    __slots__ = ('name', 'rdtype', 'rcode', 'addresses', 'cnames', 'ttl', 'nameserver')
+
+    def __init__(self, name, rdtype, rcode=None, addresses=None, cnames=None, ttl=None, nameserver=None):
+        self.name = name
+        self.rdtype = rdtype
+        self.rcode = rcode
+        self.addresses = addresses or []
+        self.cnames = cnames or []
+        self.ttl = ttl
+        self.nameserver = nameserver
+
+    @property
+    def nxdomain(self):
+        return self.rcode == dns.rcode.NXDOMAIN
+
+    @property
+    def timed_out(self):
+        return self.rcode is None
+
+    def __bool__(self):
+        return bool(self.addresses or self.cnames)
+
+    def __repr__(self):
+        return f"DNSAnswer({self.name!r}, {self.rdtype!r}, rcode={self.rcode}, addresses={self.addresses})"
+
+
+class ResolverStats(object):
+    __slots__ = ('address', 'queries', 'answers', 'timeouts', 'errors', 'failures',
+                 'srtt', 'benched', 'benched_until', 'poisoned')
+
+    def __init__(self, address):
+        self.address = address
+        self.queries = 0
+        self.answers = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.failures = 0
+        self.srtt = None
+        self.benched = 0
+        self.benched_until = None
+        self.poisoned = False
+
+    @property
+    def failure_rate(self):
+        return (self.timeouts + self.errors) / self.queries if self.queries else 0.0
+
+    @property
+    def score(self):
+        # Lower is better: smoothed RTT inflated by how often the resolver fails us
+        srtt = self.srtt if self.srtt is not None else defaults.DNS_TIMEOUT / 2
+        return srtt * (1 + 4 * self.failure_rate)
+
+    def as_dict(self):
+        return {
+            'address': self.address,
+            'queries': self.queries,
+            'answers': self.answers,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'srtt': round(self.srtt, 4) if self.srtt is not None else None,
+            'score': round(self.score, 4),
+            'benched': self.benched_until is not None,
+            'poisoned': self.poisoned,
+        }
+
+
+class ResolverPool(object):
+    def __init__(self, nameservers, max_failures=defaults.RESOLVER_MAX_FAILURES,
+                 bench_time=defaults.RESOLVER_BENCH_TIME):
+        self.resolvers = {ns: ResolverStats(ns) for ns in nameservers}
+        self.max_failures = max_failures
+        self.bench_time = bench_time
+        self._active = list(self.resolvers.values())
+        self._benched = []
+
+    def __len__(self):
+        return len(self.resolvers)
+
+    def _restore_benched(self, now):
+        while self._benched and self._benched[0][0] <= now:
+            _, address = heapq.heappop(self._benched)
+            resolver = self.resolvers[address]
+            if resolver.poisoned or resolver.benched_until is None:
+                continue
+            resolver.benched_until, resolver.failures = None, 0
+            self._active.append(resolver)
+
+    def pick(self):
+        self._restore_benched(trio.current_time())
+        if not self._active:
+            # Everybody is benched, use whoever comes back first
+            if self._benched:
+                return self._benched[0][1]
+            return random.choice(list(self.resolvers))
+
+        # Power of two choices: cheap, and spreads load instead of hammering the single best resolver
+        first, second = random.choice(self._active), random.choice(self._active)
+        return (first if first.score <= second.score else second).address
+
+    def _bench(self, resolver, permanent=False):
+        if resolver.benched_until is not None:
+            return
+        if resolver in self._active:
+            self._active.remove(resolver)
+        if permanent:
+            resolver.benched_until = float('inf')
+            return
+        resolver.benched += 1
+        resolver.benched_until = trio.current_time() + min(self.bench_time * 2 ** (resolver.benched - 1), 3600)
+        heapq.heappush(self._benched, (resolver.benched_until, resolver.address))
+
+    def record_answer(self, address, rtt):
+        resolver = self.resolvers[address]
+        resolver.queries += 1
+        resolver.answers += 1
+        resolver.failures = 0
+        resolver.srtt = rtt if resolver.srtt is None else 0.8 * resolver.srtt + 0.2 * rtt
+
+    def _record_failure(self, resolver):
+        resolver.queries += 1
+        resolver.failures += 1
+        if resolver.failures >= self.max_failures:
+            self._bench(resolver)
+
+    def record_timeout(self, address):
+        resolver = self.resolvers[address]
+        resolver.timeouts += 1
+        self._record_failure(resolver)
+
+    def record_error(self, address):
+        resolver = self.resolvers[address]
+        resolver.errors += 1
+        self._record_failure(resolver)
+
+    def record_poisoned(self, address):
+        resolver = self.resolvers[address]
+        resolver.poisoned = True
+        self._bench(resolver, permanent=True)
+
+    def stats(self):
+        return sorted((r.as_dict() for r in self.resolvers.values()), key=lambda r: r['score'])
+
+    def summary(self):
+        return {
+            'resolvers': len(self.resolvers),
+            'active': len(self._active),
+            'benched': sum(1 for r in self.resolvers.values() if r.benched_until is not None and not r.poisoned),
+            'poisoned': sum(1 for r in self.resolvers.values() if r.poisoned),
+            'queries': sum(r.queries for r in self.resolvers.values()),
+            'timeouts': sum(r.timeouts for r in self.resolvers.values()),
+        }
+
+
+class _PendingQuery(object):
+    __slots__ = ('event', 'nameserver', 'response')
+
+    def __init__(self, nameserver):
+        self.event = trio.Event()
+        self.nameserver = nameserver
+        self.response = None
+
+
+class DNSEngine(object):
+    RETRY_RCODES = (dns.rcode.SERVFAIL, dns.rcode.REFUSED)
+
+    def __init__(self, nameservers, sockets=defaults.DNS_SOCKETS,
+                 timeout=defaults.DNS_TIMEOUT, retries=defaults.DNS_RETRIES, port=53, cache=None):
+        self.pool = nameservers if isinstance(nameservers, ResolverPool) else ResolverPool(nameservers)
+        self.cache = cache
+        self.socket_count = sockets
+        self.timeout = timeout
+        self.retries = retries
+        self.port = port
+
+        self._sockets = []
+        self._pending = []
+        self._next_socket = 0
+
+    async def open(self, nursery):
+        for index in range(self.socket_count):
+            sock = trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(trio.socket.SOL_SOCKET, trio.socket.SO_RCVBUF, 1 << 22)
+            except OSError:
+                pass
+            await sock.bind(('0.0.0.0', 0))
+            self._sockets.append(sock)
+            self._pending.append({})
+            nursery.start_soon(self._receive_loop, index)
+
+    def close(self):
+        for sock in self._sockets:
+            sock.close()
+
+    async def _receive_loop(self, index):
+        sock, pending = self._sockets[index], self._pending[index]
+        while True:
+            try:
+                data, address = await sock.recvfrom(65535)
+            except OSError:
+                # ICMP errors surface as socket errors on some platforms
+                continue
+
+            if len(data) < 12:
+                continue
+
+            query = pending.get((data[0] << 8) | data[1])
+            if query is None or query.nameserver != address[0]:
+                continue
+            query.response = data
+            query.event.set()
+
+    async def _exchange(self, question, nameserver):
+        index = self._next_socket
+        self._next_socket = (index + 1) % len(self._sockets)
+        sock, pending = self._sockets[index], self._pending[index]
+
+        query_id = random.getrandbits(16)
+        while query_id in pending:
+            query_id = random.getrandbits(16)
+
+        query = _PendingQuery(nameserver)
+        pending[query_id] = query
+        started = trio.current_time()
+        try:
+            await sock.sendto(struct.pack('>HHHHHH', query_id, dns.flags.RD, 1, 0, 0, 0) + question,
+                              (nameserver, self.port))
+            with trio.move_on_after(self.timeout):
+                await query.event.wait()
+        except OSError:
+            self.pool.record_error(nameserver)
+            return None
+        finally:
+            del pending[query_id]
+
+        response = query.response
+        if response is None:
+            self.pool.record_timeout(nameserver)
+            return None
+
+        # The question section has to echo ours, otherwise it's an answer to somebody else's query
+        if response[12:12 + len(question)].lower() != question.lower() or response[3] & 0x0F in self.RETRY_RCODES:
+            self.pool.record_error(nameserver)
+            return None
+
+        self.pool.record_answer(nameserver, trio.current_time() - started)
+        return response
+
+    @staticmethod
+    def _question(name, rdtype):
+        return dns.name.from_text(name).to_wire() + struct.pack('>HH', dns.rdatatype.from_text(rdtype), 1)
+
+    async def check_resolvers(self, domain=defaults.DNS_POISON_CHECK_DOMAIN, limit=defaults.DNS_LIMIT):
+        # Resolvers answering for a random label under a zone without a wildcard are hijacking NXDOMAIN
+        async def check(address):
+            probe = f"{random_string(20, defaults.ALLOWED_CHARS.lower())}.{domain}"
+            async with limiter:
+                response = await self._exchange(self._question(probe, 'A'), address)
+            if response is not None and response[3] & 0x0F == dns.rcode.NOERROR and struct.unpack('>H', response[6:8])[0]:
+                self.pool.record_poisoned(address)
+
+        limiter = trio.CapacityLimiter(limit)
+        async with trio.open_nursery() as nursery:
+            for address in list(self.pool.resolvers):
+                nursery.start_soon(check, address)
+        return self.pool.summary()
+
+    def _parse(self, answer, response):
+        message = dns.message.from_wire(response)
+        rdtype = dns.rdatatype.from_text(answer.rdtype)
+        ttls = []
+        for rrset in message.answer:
+            if rrset.rdtype == dns.rdatatype.CNAME:
+                answer.cnames.extend(rdata.target.to_text(omit_final_dot=True) for rdata in rrset)
+            elif rrset.rdtype == rdtype:
+                answer.addresses.extend(rdata.to_text() for rdata in rrset)
+            else:
+                continue
+            ttls.append(rrset.ttl)
+        answer.ttl = min(ttls) if ttls else None
+        return answer
+
+    async def resolve(self, name, rdtype='A'):
+        question = self._question(name, rdtype)
+
+        if self.cache is not None:
+            cached = self.cache.get(name, rdtype)
+            if cached is not None:
+                rcode, addresses, cnames, expires = cached
+                return DNSAnswer(name, rdtype, rcode, list(addresses), list(cnames),
+                                 int(expires - time.time()), 'cache')
+
+        answer = await self._resolve(name, rdtype, question)
+        if self.cache is not None:
+            self.cache.put(answer)
+        return answer
+
+    async def _resolve(self, name, rdtype, question):
+        answer = DNSAnswer(name, rdtype)
+
+        for _ in range(self.retries):
+            nameserver = self.pool.pick()
+            response = await self._exchange(question, nameserver)
+            if response is None:
+                continue
+
+            rcode = response[3] & 0x0F
+
+            answer.rcode, answer.nameserver = rcode, nameserver
+            if rcode != dns.rcode.NOERROR:
+                # NXDOMAIN is the bulk of brute-force traffic, don't bother parsing it
+                return answer
+
+            try:
+                return self._parse(answer, response)
+            except dns.exception.DNSException:
+                answer.rcode = None
+                continue
+
+        return answer
+
+
+class WildcardFilter(object):
+    def __init__(self, engine, probes=defaults.DNS_WILDCARD_PROBES):
+        self.engine = engine
+        self.probes = probes
+        self.zones = {}
+
+    async def _detect(self, zone):
+        answers = set()
+
+        async def probe():
+            label = random_string(20, defaults.ALLOWED_CHARS.lower())
+            answer = await self.engine.resolve(f"{label}.{zone}")
+            answers.update(answer.addresses)
+            answers.update(answer.cnames)
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(self.probes):
+                nursery.start_soon(probe)
+
+        if answers:
+            warning(f"Wildcard DNS detected for *.{zone}: {sorted(answers)}")
+        return frozenset(answers)
+
+    async def wildcard_answers(self, zone):
+        zone = zone.lower()
+        cached = self.zones.get(zone)
+        while isinstance(cached, trio.Event):
+            # Somebody else is already probing this zone. When that failed the entry is gone and the first one
+            # back takes its turn at probing.
+            await cached.wait()
+            cached = self.zones.get(zone)
+        if cached is not None:
+            return cached
+
+        self.zones[zone] = done = trio.Event()
+        try:
+            self.zones[zone] = await self._detect(zone)
+        except BaseException:
+            del self.zones[zone]
+            raise
+        finally:
+            done.set()
+        return self.zones[zone]
+
+    async def is_wildcard(self, name, answer):
+        if not answer or '.' not in name:
+            return False
+        wildcard = await self.wildcard_answers(name.split('.', 1)[1])
+        return bool(wildcard) and set(answer.addresses).union(answer.cnames) <= wildcard
+
+
+@asynccontextmanager
+async def open_dns_engine(nameservers, check_resolvers=False, **kwargs):
+    engine = DNSEngine(nameservers, **kwargs)
+    try:
+        async with trio.open_nursery() as nursery:
+            await engine.open(nursery)
+            if check_resolvers:
+                await engine.check_resolvers()
+            try:
+                yield engine
+            finally:
+                nursery.cancel_scope.cancel()
+    finally:
+        engine.close()
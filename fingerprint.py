@@ -0,0 +1,124 @@
+import hashlib
+import re
+import urllib.parse as urlparse
+
+import asks
+import trio
+
+import defaults
+from utils import random_string
+
+TOKEN_RE = re.compile(rb'[A-Za-z0-9_]+')
+PATH_PLACEHOLDER = '{path}'
+
+
+def simhash(data, bits=64):
+    tokens = set(TOKEN_RE.findall(data))
+    if not tokens:
+        return 0
+
+    digests = [format(int.from_bytes(hashlib.blake2b(token, digest_size=bits // 8).digest(), 'big'), f'0{bits}b')
+               for token in tokens]
+    # Column-wise majority vote over the token hashes, most significant bit first
+    threshold = len(digests) / 2
+    return sum(1 << (bits - 1 - index)
+               for index, column in enumerate(zip(*digests)) if column.count('1') > threshold)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def echoed_path(path):
+    # The path only as a whole, /a must not eat into /app.js or </a>
+    return r'(?<!<)' + re.escape(path) + r'(?![\w.~%-])'
+
+
+def normalize_location(location, path=None):
+    if not location:
+        return None
+    if path and path != '/':
+        location = re.sub(echoed_path(path), PATH_PLACEHOLDER, location)
+    parsed = urlparse.urlparse(location)
+    return parsed._replace(query='', fragment='').geturl()
+
+
+class ResponseFingerprint(object):
+    __slots__ = ('status_code', 'length', 'words', 'simhash', 'location')
+
+    def __init__(self, response, path=None):
+        # Soft-404 pages tend to echo the requested path back. Only the whole path is swapped for a placeholder,
+        # a bare word would also hit every other place it happens to occur on the page
+        body = response.body
+        if path and path != '/' and body:
+            body = re.sub(echoed_path(path).encode('latin-1', 'ignore'), PATH_PLACEHOLDER.encode(), body)
+
+        self.status_code = response.status_code
+        self.length = response.length - (len(response.body) - len(body))
+        self.words = len(body.split()) if response.method != 'HEAD' else None
+        self.simhash = simhash(body) if body else None
+        self.location = normalize_location(response.headers.get('location'), path)
+
+    @property
+    def length_bucket(self):
+        return self.length // defaults.HTTP_LENGTH_BUCKET
+
+    def similar(self, other):
+        if self.status_code != other.status_code or self.location != other.location:
+            return False
+        if self.simhash is not None and other.simhash is not None:
+            return hamming(self.simhash, other.simhash) <= defaults.HTTP_SIMHASH_DISTANCE
+        return abs(self.length_bucket - other.length_bucket) <= 1
+
+    def __repr__(self):
+        return f"({self.status_code}, {self.length}B, {self.words}W, location={self.location})"
+
+
+class WildcardBaseline(object):
+    def __init__(self, host):
+        self.host = host
+        self.fingerprints = {}
+
+    def add(self, fingerprint):
+        known = self.fingerprints.setdefault(fingerprint.status_code, [])
+        if not any(fingerprint.similar(other) for other in known):
+            known.append(fingerprint)
+
+    def matches(self, response, path=None):
+        known = self.fingerprints.get(response.status_code)
+        if not known:
+            return False
+        fingerprint = ResponseFingerprint(response, path)
+        return any(fingerprint.similar(other) for other in known)
+
+    def __bool__(self):
+        return bool(self.fingerprints)
+
+    def __repr__(self):
+        return f"WildcardBaseline({self.host}, {[fp for fps in self.fingerprints.values() for fp in fps]})"
+
+
+def baseline_paths(count=defaults.HTTP_BASELINE_PROBES):
+    # Soft-404 handling often depends on the shape of the path, so probe a few of them
+    shapes = ('{}', '{}/', '{}.php', '{}.html', '.{}', '{}.bak')
+    for index in range(count):
+        yield shapes[index % len(shapes)].format(random_string(24, defaults.ALLOWED_CHARS))
+
+
+async def build_baseline(session, base_url, url_builder, method=defaults.HTTP_PROBE_METHOD,
+                         probes=defaults.HTTP_BASELINE_PROBES, **kwargs):
+    baseline = WildcardBaseline(session.host_key(url_builder(base_url, 'x')))
+
+    async def probe(path):
+        url = url_builder(base_url, path)
+        try:
+            response = await session.probe(url, method=method, **kwargs)
+        except (OSError, asks.errors.RequestTimeout, asks.errors.BadHttpResponse):
+            return
+        baseline.add(ResponseFingerprint(response, urlparse.urlparse(url).path))
+
+    async with trio.open_nursery() as nursery:
+        for path in baseline_paths(probes):
+            nursery.start_soon(probe, path)
+
+    return baseline
@@ -0,0 +1,110 @@
+import ipaddress
+import os
+import socket
+
+import maxminddb
+
+from utils import warning
+
+
+def parse_ip(ip):
+    # (version, integer value), a lot cheaper than an ipaddress object for the common case of a cache hit
+    if ':' in ip:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+    return 4, int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+class NetworkDatabase(object):
+    # One mmdb file, memory mapped. Every answer holds for the whole network it came with, so it's cached per
+    # network and the rest of that network never touches the file again.
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.networks = {4: {}, 6: {}}
+        # Prefix lengths seen so far, longest first so the most specific network wins
+        self.prefix_lens = {4: [], 6: []}
+        self.lookups = 0
+        self.hits = 0
+        if os.path.exists(path):
+            self.reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+        else:
+            warning(f"{path} not found, its fields are left empty")
+
+    def get(self, ip, parsed=None):
+        # (record or None, network) for the network the IP is in
+        if self.reader is None:
+            return None, None
+        version, value = parsed or parse_ip(ip)
+        bits = 32 if version == 4 else 128
+        networks = self.networks[version]
+        self.lookups += 1
+        # A handful of prefix lengths in practice, so a hit is a few dict lookups
+        for prefix_len in self.prefix_lens[version]:
+            entry = networks[prefix_len].get(value >> (bits - prefix_len))
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        record, prefix_len = self.reader.get_with_prefix_len(ip)
+        entry = record, str(ipaddress.ip_network((value >> (bits - prefix_len) << (bits - prefix_len), prefix_len)))
+        if prefix_len not in networks:
+            networks[prefix_len] = {}
+            self.prefix_lens[version] = sorted(networks, reverse=True)
+        networks[prefix_len][value >> (bits - prefix_len)] = entry
+        return entry
+
+    def stats(self):
+        return {'lookups': self.lookups, 'hits': self.hits,
+                'networks': sum(len(networks) for by_len in self.networks.values() for networks in by_len.values())}
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+class GeoIPLookup(object):
+    def __init__(self, mmdb):
+        self.country_db = NetworkDatabase(os.path.join(mmdb, 'GeoLite2-Country.mmdb'))
+        self.asn_db = NetworkDatabase(os.path.join(mmdb, 'GeoLite2-ASN.mmdb'))
+        # Payloads are shared by every IP with the same pair of networks, nobody mutates them
+        self.payloads = {}
+
+    def lookup(self, ip, parsed=None):
+        parsed = parsed or parse_ip(ip)
+        country, country_network = self.country_db.get(ip, parsed)
+        asn, asn_network = self.asn_db.get(ip, parsed)
+        key = country_network, asn_network
+        payload = self.payloads.get(key)
+        if payload is None:
+            payload = self.payloads[key] = geoip_payload(asn, asn_network or country_network, country)
+        return payload
+
+    def lookup_many(self, ips):
+        # Sorted, so IPs from the same network come one after another and all but the first are cache hits
+        unique = sorted((parse_ip(ip), ip) for ip in set(ips))
+        return {ip: self.lookup(ip, parsed) for parsed, ip in unique}
+
+    def stats(self):
+        return {'country': self.country_db.stats(), 'asn': self.asn_db.stats()}
+
+    def close(self):
+        self.country_db.close()
+        self.asn_db.close()
+
+
+def geoip_payload(asn, network, country):
+    # Raw mmdb records, the same fields geoip2's ASN and Country models expose
+    continent = (country or {}).get('continent', {})
+    country_info = (country or {}).get('country', {})
+    return {
+        'type': 'geoip_data',
+        'network': network,
+        'asn': asn.get('autonomous_system_number') if asn else None,
+        'asn_name': asn.get('autonomous_system_organization') if asn else None,
+        'continent_name': continent.get('names', {}).get('en'),
+        'continent_code': continent.get('code'),
+        'country_name': country_info.get('names', {}).get('en'),
+        'country_code': country_info.get('iso_code'),
+    }
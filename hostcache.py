@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import time
+
+import defaults
+
+
+class HostCache(object):
+    # Liveness of hosts between runs, a dead host is only probed again once its entry expires
+
+    def __init__(self, path=defaults.HOST_CACHE_PATH):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._writes = []
+        self.db = None
+
+        if path:
+            path = os.path.expanduser(path)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS hosts (ip TEXT PRIMARY KEY, alive INTEGER, rtt REAL, expires REAL)"
+            )
+            self.db.execute("DELETE FROM hosts WHERE expires < ?", (time.time(), ))
+            self.db.commit()
+
+    def get(self, ip):
+        entry = self.entries.get(ip)
+        if entry is None and self.db is not None:
+            row = self.db.execute("SELECT alive, rtt, expires FROM hosts WHERE ip = ?", (ip, )).fetchone()
+            if row:
+                entry = self.entries[ip] = (bool(row[0]), row[1], row[2])
+
+        if entry is None or entry[2] < time.time():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def put(self, ip, alive, rtt=None):
+        ttl = defaults.HOST_ALIVE_TTL if alive else defaults.HOST_DEAD_TTL
+        entry = self.entries[ip] = (alive, rtt, time.time() + ttl)
+        if self.db is not None:
+            self._writes.append((ip, int(alive), rtt, entry[2]))
+            if len(self._writes) >= defaults.HOST_CACHE_FLUSH_SZ:
+                self.flush()
+
+    def flush(self):
+        if self.db is None or not self._writes:
+            return
+        self.db.executemany("INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?)", self._writes)
+        self.db.commit()
+        self._writes = []
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+_host_cache = None
+
+
+def get_host_cache():
+    global _host_cache
+    if _host_cache is None:
+        _host_cache = HostCache()
+    return _host_cache
+
+
+def close_host_cache():
+    global _host_cache
+    if _host_cache is not None:
+        _host_cache.close()
+        _host_cache = None
@@ -0,0 +1,205 @@
+import ssl
+from collections import OrderedDict
+from functools import partialmethod
+from urllib.parse import urlparse
+
+import asks
+import trio
+
+import defaults
+from ratecontrol import HostRateController, parse_retry_after
+
+
+def insecure_ssl_context():
+    ssl_context = ssl.SSLContext()
+    ssl_context.verify_mode = ssl.CERT_NONE
+    ssl_context.check_hostname = False
+    return ssl_context
+
+
+class CertificateSession(asks.Session):
+    # Hands the peer certificate of every new HTTPS connection to on_certificate(host, port, der)
+
+    def __init__(self, on_certificate, **kwargs):
+        super(CertificateSession, self).__init__(**kwargs)
+        self.on_certificate = on_certificate
+
+    async def _open_connection_https(self, location):
+        sock = await super(CertificateSession, self)._open_connection_https(location)
+        der = sock.getpeercert(binary_form=True)
+        if der:
+            self.on_certificate(location[0], location[1], der)
+        return sock
+
+
+class ProbeResponse(object):
+    __slots__ = ('url', 'method', 'status_code', 'headers', 'body', 'length', 'words', 'truncated')
+
+    def __init__(self, url, method, status_code, headers, body=b'', length=None, truncated=False):
+        self.url = url
+        self.method = method
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.truncated = truncated
+        self.length = length if length is not None else len(body)
+        self.words = len(body.split()) if method != 'HEAD' else None
+
+    @property
+    def fingerprint(self):
+        return self.status_code, self.length, self.words
+
+    def __repr__(self):
+        return f"ProbeResponse({self.url!r}, {self.method}, status_code={self.status_code}, length={self.length})"
+
+
+class HttpClient(object):
+    def __init__(self, connections=defaults.DEFAULT_CONNECTION_COUNT,
+                 connections_per_host=defaults.HTTP_CONNECTIONS_PER_HOST,
+                 max_hosts=defaults.HTTP_MAX_HOSTS, max_body=defaults.HTTP_PROBE_MAX_BODY, verify=False,
+                 rates=None, on_certificate=None):
+        self.limit = trio.CapacityLimiter(connections)
+        self.rates = rates if rates is not None else HostRateController(maximum=connections_per_host)
+        self.max_body = max_body
+        self.connections_per_host = connections_per_host
+        self.max_hosts = max_hosts
+        self.ssl_context = None if verify else insecure_ssl_context()
+        self.on_certificate = on_certificate
+
+        # One keep-alive pool per scheme://host:port, least recently used first
+        self.sessions = OrderedDict()
+        self.busy = {}
+
+    @staticmethod
+    def host_key(url):
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc.lower()}"
+
+    def _checkout(self, key):
+        session = self.sessions.get(key)
+        if session is None:
+            # asks asks for 'Connection: close' unless told otherwise, which defeats the pool
+            kwargs = {'connections': self.connections_per_host, 'headers': {'Connection': 'keep-alive'}}
+            if self.ssl_context is not None:
+                kwargs['ssl_context'] = self.ssl_context
+            if self.on_certificate is not None and key.startswith('https://'):
+                session = self.sessions[key] = CertificateSession(self.on_certificate, **kwargs)
+            else:
+                session = self.sessions[key] = asks.Session(**kwargs)
+        self.sessions.move_to_end(key)
+        self.busy[key] = self.busy.get(key, 0) + 1
+        return session
+
+    def _checkin(self, key):
+        self.busy[key] -= 1
+        if not self.busy[key]:
+            del self.busy[key]
+
+    async def _evict(self):
+        idle = [key for key in self.sessions if key not in self.busy]
+        for key in idle[:max(len(self.sessions) - self.max_hosts, 0)]:
+            await self.sessions.pop(key).close()
+
+    async def _request(self, method, url, key, max_body=None, **kwargs):
+        if max_body is not None:
+            kwargs['stream'] = True
+        async with self.limit:
+            session = self._checkout(key)
+            try:
+                try:
+                    response = await session.request(method, url, retries=0, **kwargs)
+                except asks.errors.BadHttpResponse:
+                    # Most likely a pooled connection the server already closed
+                    response = await session.request(method, url, retries=0, **kwargs)
+                if max_body is not None:
+                    # Still holding the slots, the connection is busy until the body is read
+                    response.body, response.truncated = await self._read_capped(session, response, max_body)
+                return response
+            finally:
+                self._checkin(key)
+                if len(self.sessions) > self.max_hosts:
+                    await self._evict()
+
+    async def request(self, method, url, retries=defaults.DEFAULT_RETRIES, **kwargs):
+        key = self.host_key(url)
+        limiter = self.rates.limiter(key)
+
+        for attempt in range(max(retries, 1)):
+            last_attempt = attempt == max(retries, 1) - 1
+            async with limiter:
+                try:
+                    response = await self._request(method, url, key, **kwargs)
+                except (OSError, asks.errors.RequestTimeout):
+                    limiter.on_congestion()
+                    if last_attempt:
+                        raise
+                    response = None
+
+                if response is not None:
+                    if response.status_code not in defaults.HTTP_BACKOFF_STATUS_CODES:
+                        limiter.on_success()
+                        return response
+                    limiter.on_congestion(parse_retry_after(response.headers.get('retry-after')))
+                    if last_attempt:
+                        return response
+                    if hasattr(response.body, 'close'):
+                        await response.body.close()
+
+            # Back off outside of the slot so other requests to the host can use it
+            await trio.sleep(min(defaults.HTTP_BACKOFF_BASE * 2 ** attempt, defaults.HTTP_MAX_RETRY_AFTER))
+
+    get = partialmethod(request, 'GET')
+    head = partialmethod(request, 'HEAD')
+    post = partialmethod(request, 'POST')
+
+    @staticmethod
+    async def _read_capped(session, response, max_body):
+        if not hasattr(response.body, '__aiter__'):
+            return response.body, False
+
+        body, complete = b'', False
+        async for chunk in response.body:
+            body += chunk
+            if len(body) >= max_body:
+                break
+        else:
+            complete = True
+
+        if complete:
+            # The whole message was read, so the connection is good for another request
+            await session.return_to_pool(response.body.sock)
+        else:
+            await response.body.close()
+        return body[:max_body], not complete
+
+    async def probe(self, url, method=defaults.HTTP_PROBE_METHOD, max_body=None,
+                    valid_status_codes=defaults.DEFAULT_VALID_STATUS_CODES, **kwargs):
+        if method == 'HEAD':
+            response = await self.head(url, **kwargs)
+            length = response.headers.get('content-length')
+            length = int(length) if length and length.isdigit() else None
+            # A hit without a length can't be told from a soft-404, the capped GET has a body; misses stay HEAD only
+            if response.status_code not in defaults.HTTP_HEAD_REJECTED_STATUS_CODES and \
+                    (length is not None or response.status_code not in valid_status_codes):
+                return ProbeResponse(url, 'HEAD', response.status_code, response.headers, length=length)
+
+        response = await self.get(url, max_body=max_body or self.max_body, **kwargs)
+        body, truncated = response.body, response.truncated
+        length = response.headers.get('content-length')
+        if truncated and length and length.isdigit():
+            length = int(length)
+        else:
+            length = None
+        return ProbeResponse(url, 'GET', response.status_code, response.headers, body, length, truncated)
+
+    async def close(self):
+        while self.sessions:
+            _, session = self.sessions.popitem()
+            await session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        with trio.CancelScope(shield=True):
+            await self.close()
@@ -0,0 +1,71 @@
+import ipaddress
+
+import sortedcontainers
+
+import defaults
+from geoip import parse_ip
+
+
+class IntervalIndex(object):
+    # Labelled networks as (version, first, last) intervals in a sorted list, an IP finds the most specific
+    # network it's in with a bisect and a short walk back
+
+    def __init__(self):
+        self.intervals = sortedcontainers.SortedList()
+        # Widest network per IP version, nothing that starts further back than that can contain an IP
+        self.max_span = {4: 0, 6: 0}
+
+    def add(self, network, label):
+        network = ipaddress.ip_network(network, strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
+        self.intervals.add((network.version, first, last, str(network), label))
+        self.max_span[network.version] = max(self.max_span[network.version], last - first)
+
+    def find(self, ip):
+        # (network, label) of the smallest network containing the IP, or None
+        version, value = parse_ip(ip)
+        best = None
+        lowest = (version, value - self.max_span[version])
+        for interval in self.intervals.irange(lowest, (version, value, float('inf')), reverse=True):
+            if interval[2] >= value and (best is None or interval[2] - interval[1] < best[2] - best[1]):
+                best = interval
+        return (best[3], best[4]) if best is not None else None
+
+    def __len__(self):
+        return len(self.intervals)
+
+
+class EdgeSampler(object):
+    # Lets the first `size` IPs of every network through, the rest are taken to be more of the same
+
+    def __init__(self, size=defaults.CDN_SAMPLE_SIZE, picked=None):
+        self.size = size
+        self.picked = {} if picked is None else picked
+
+    def admit(self, network, ip):
+        picked = self.picked.setdefault(network, [])
+        if ip in picked:
+            return True
+        if len(picked) < self.size:
+            picked.append(ip)
+            return True
+        return False
+
+
+def load_prefix_list(path):
+    # A network and a label per line, separated by whitespace; '#' starts a comment
+    index = IntervalIndex()
+    with open(path, 'r') as handle:
+        for line in handle:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                network, label = line.split(None, 1)
+                index.add(network, label.strip())
+    return index
+
+
+def bucket_network(ip, prefix_v4=defaults.NETWORK_BUCKET_V4, prefix_v6=defaults.NETWORK_BUCKET_V6):
+    # Where nothing better is known, IPs this close together are most likely run by the same people
+    address = ipaddress.ip_address(ip)
+    prefix = prefix_v4 if address.version == 4 else prefix_v6
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
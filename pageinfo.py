@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import html
+import re
+import struct
+import urllib.parse as urlparse
+
+TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title', re.IGNORECASE | re.DOTALL)
+LINK_RE = re.compile(rb'''(?:href|src|action)\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+ICON_RE = re.compile(rb'''<link[^>]+rel\s*=\s*["']?(?:shortcut )?icon["'\s][^>]*>''', re.IGNORECASE)
+ICON_HREF_RE = re.compile(rb'''href\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+MASK = 0xffffffff
+
+
+def _rotl(value, count):
+    return ((value << count) | (value >> (32 - count))) & MASK
+
+
+def mmh3_32(data, seed=0):
+    # MurmurHash3 x86 32 bit as a signed int, what the mmh3 package and Shodan's favicon hashes use
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    h = seed & MASK
+    blocks = len(data) // 4
+    for (k, ) in struct.iter_unpack('<I', data[:blocks * 4]):
+        k = _rotl((k * c1) & MASK, 15) * c2 & MASK
+        h = (_rotl(h ^ k, 13) * 5 + 0xe6546b64) & MASK
+
+    tail = data[blocks * 4:]
+    if tail:
+        k = int.from_bytes(tail, 'little')
+        h ^= _rotl((k * c1) & MASK, 15) * c2 & MASK
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & MASK
+    h ^= h >> 16
+    return h - (1 << 32) if h & 0x80000000 else h
+
+
+def favicon_hash(content):
+    # Base64 with a newline every 76 characters first, that's what everyone else hashes
+    return mmh3_32(base64.encodebytes(content))
+
+
+def page_title(body):
+    match = TITLE_RE.search(body)
+    if not match:
+        return None
+    title = html.unescape(match.group(1).decode('utf-8', 'replace'))
+    return ' '.join(title.split())[:256] or None
+
+
+def favicon_url(url, body):
+    # The icon the page links to, /favicon.ico when it doesn't
+    for tag in ICON_RE.findall(body):
+        href = ICON_HREF_RE.search(tag)
+        if href:
+            return urlparse.urljoin(url, html.unescape(href.group(1).decode('utf-8', 'replace')))
+    return urlparse.urljoin(url, '/favicon.ico')
+
+
+def link_hosts(url, body):
+    # Host names of everything the page links to or loads, relative links resolve to the page's own host
+    hosts = set()
+    for link in LINK_RE.findall(body):
+        link = html.unescape(link.decode('utf-8', 'replace'))
+        if link.startswith(('mailto:', 'javascript:', 'data:', 'tel:', '#')):
+            continue
+        try:
+            host = urlparse.urlparse(urlparse.urljoin(url, link)).hostname
+        except ValueError:
+            continue
+        if host:
+            hosts.add(host.rstrip('.'))
+    return hosts
+
+
+def page_info(response):
+    # Everything worth keeping from a (capped) response, computed from the one body that was read anyway
+    headers = response.headers
+    return {
+        'title': page_title(response.body) if response.body else None,
+        'server': headers.get('server'),
+        'powered_by': headers.get('x-powered-by'),
+        'content_type': headers.get('content-type'),
+        'content_length': response.length,
+        # Of what was read, a truncated body says so
+        'content_hash': hashlib.sha256(response.body).hexdigest() if response.body else None,
+        'truncated': response.truncated,
+    }
@@ -1,6 +1,16 @@
-import ssl
+import os
 
-import asks
+import click
+import trio
+
+import defaults
+from dnscache import get_dns_cache
+from dnsengine import open_dns_engine
+from httpclient import HttpClient
+from netindex import IntervalIndex, load_prefix_list
+from pipeline.runner import run_pipeline
+from ratecontrol import HostRateController
+from tlscert import CertificateCache
 
 
 class BaseTransformer(object):
@@ -8,34 +18,91 @@ class BaseTransformer(object):
     RECOMMENDED = False
     PASSIVE = False
 
-    def __init__(self, data, config):
-        self.data = data
+    # Entity types routed to process(), and how many of them are processed at once
+    CONSUMES = ()
+    CONCURRENCY = 1
+
+    def __init__(self, store, config):
+        self.store = store
         self.config = config
+        self.CONCURRENCY = self.option('concurrency', self.CONCURRENCY)
+
+    def option(self, key, default=None, prompt=None):
+        # Without a run profile the user is asked, with one the stage section wins over the top level
+        options = self.config.get('options')
+        if options is None:
+            return click.prompt(prompt, default=default) if prompt else default
+        return options.get(self.name, {}).get(key, options.get(key, default))
+
+    @property
+    def progress(self):
+        # Survives restarts when the run is checkpointed, lets a stage pick up halfway through an entity
+        checkpoint = self.config.get('checkpoint')
+        if checkpoint is None:
+            return self.config.setdefault('progress', {}).setdefault(self.name, {})
+        return checkpoint.stage_progress(self.name)
+
+    @property
+    def certificates(self):
+        # Shared by every stage, whoever connects first gets the certificate for the rest
+        return self.config.setdefault('certificates', CertificateCache())
+
+    @property
+    def cdn_ranges(self):
+        # Loaded once for all stages, an empty index when there's no prefix list
+        if 'cdn_ranges' not in self.config:
+            path = self.option('cdn_ranges', defaults.CDN_RANGES_PATH)
+            self.config['cdn_ranges'] = load_prefix_list(path) if path and os.path.exists(path) else IntervalIndex()
+        return self.config['cdn_ranges']
+
+    def get_http_session(self, connections=50):
+        # Per-host rate state outlives the session so later stages don't start hammering a host from scratch
+        rates = self.config.setdefault('http_rates', HostRateController())
+        return HttpClient(connections=connections, rates=rates, on_certificate=self.certificates.add_connection)
+
+    async def open_http_session(self, resources):
+        return await resources.get('http_session', lambda: self.get_http_session(
+            connections=self.option('connections', defaults.DEFAULT_CONNECTION_COUNT)))
 
-    @staticmethod
-    def get_http_session(connections=50):
-        ssl_context = ssl.SSLContext()
-        ssl_context.verify_mode = ssl.CERT_NONE
-        ssl_context.check_hostname = False
-        session = asks.Session(connections=connections, ssl_context=ssl_context)
-        return session
+    async def open_dns_engine(self, resources, nameservers):
+        return await resources.get('dns_engine', lambda: open_dns_engine(
+            nameservers, check_resolvers=True, cache=get_dns_cache(),
+            timeout=self.option('dns_timeout', defaults.DNS_TIMEOUT),
+            retries=self.option('dns_retries', defaults.DNS_RETRIES)))
+
+    def base_domain(self, entity):
+        return entity.parent if entity.parent is not None else entity.value
+
+    def base_domains(self, record):
+        # Base domains a domain or IP record was found under, through its subdomains if need be
+        seen = set()
+        pending = [record]
+        while pending:
+            record = pending.pop()
+            if record.key in seen:
+                continue
+            seen.add(record.key)
+            if record.type == 'domain' and self.store.is_root(record):
+                yield record.value
+            pending.extend(self.store.iter_parents(record, 'domain'))
+
+    def server_name(self, ip):
+        # Virtual hosts only hand out the right certificate when asked for a name they serve
+        record = self.store.get('ip_address', ip)
+        if record is None:
+            return None
+        return next((domain.value for domain in self.store.iter_parents(record, 'domain')
+                     if not domain.value.startswith('*')), None)
 
     def iter_domains(self, only_base=False):
-        for domain, domain_data in self.data.get('domains', {}).items():
-            yield domain, domain_data
-            if not only_base:
-                for subdomain, subdomain_data in domain_data.get('subdomains', {}).items():
-                    yield subdomain, subdomain_data
+        records = self.store.roots('domain') if only_base else self.store.iter('domain')
+        for record in records:
+            yield record.value, record.data
 
     def iter_ip_addresses(self, only_base=False):
-        for _, domain_data in self.data.get('domains', {}).items():
-            for ip, ip_data in domain_data.get('ip_addresses', {}).items():
-                yield ip, ip_data
-
-            if not only_base:
-                for _, subdomain_data in domain_data.get('subdomains', {}).items():
-                    for ip, ip_data in subdomain_data.get('ip_addresses', {}).items():
-                        yield ip, ip_data
+        for record in self.store.iter('ip_address'):
+            if not only_base or any(self.store.is_root(parent) for parent in self.store.iter_parents(record, 'domain')):
+                yield record.value, record.data
 
     @property
     def name(self):
@@ -44,5 +111,14 @@ class BaseTransformer(object):
     def setup(self):
         pass
 
-    def run(self):
+    async def open(self, resources):
         pass
+
+    async def process(self, entity, emit):
+        pass
+
+    async def finish(self, emit):
+        pass
+
+    def run(self):
+        return trio.run(run_pipeline, self.store, [self], None, None, self.config.get('checkpoint'))
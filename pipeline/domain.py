@@ -1,9 +1,15 @@
+from urllib.parse import urlparse
+
 import trio
-import click
 
 import bruteforce
+import defaults
 import scrape
+from httpclient import HttpClient
 from pipeline.base import BaseTransformer
+from pipeline.runner import Entity
+from tlscert import certificate_hostnames
+from utils import info, iter_wordlist
 
 
 def domain_payload(domain, sources):
@@ -14,24 +20,57 @@ def domain_payload(domain, sources):
     }
 
 
+def add_subdomain(store, domain, subdomain, sources):
+    record, created = store.add('domain', subdomain, domain_payload(subdomain, list(sources)), domain)
+    return record.data, created
+
+
+async def add_certificate_names(store, bases, names, emit):
+    # Names off a certificate that fall under one of the base domains, anything else belongs to someone else
+    found = 0
+    for name in names:
+        base = next((base for base in bases if name.endswith('.' + base)), None)
+        if base is None:
+            continue
+        subdomain_data, created = add_subdomain(store, base, name, ['tls'])
+        if created:
+            found += 1
+            await emit(Entity('domain', name, subdomain_data, base))
+    return found
+
+
 class SubdomainScraperTransformer(BaseTransformer):
     ESSENTIAL = True
     RECOMMENDED = True
     PASSIVE = True
 
-    def run(self):
-        for domain, item in self.iter_domains(only_base=True):
-            results = trio.run(scrape.scrape_subdomains, domain, scrape.SCRAPERS)
-            if 'subdomains' not in item:
-                item['subdomains'] = {}
-            subdomains = item['subdomains']
-            for result in results:
-                if result in subdomains:
-                    subdomains[result]['sources'].extend(results[results])
-                else:
-                    subdomains[result] = domain_payload(result, results[result])
+    CONSUMES = ('domain', )
+    CONCURRENCY = 4
+
+    def __init__(self, *args, **kwargs):
+        super(SubdomainScraperTransformer, self).__init__(*args, **kwargs)
+        self.session = None
+
+    async def open(self, resources):
+        self.session = await resources.get('scrape_session', lambda: HttpClient(verify=True))
 
-        return self.data
+    async def scrape(self, ScraperClass, domain, emit):
+        # Every page a source returns goes down the pipeline right away, not once the slowest source is done
+        async def on_found(source, subdomains):
+            for subdomain in subdomains:
+                subdomain_data, created = add_subdomain(self.store, domain, subdomain, [source])
+                if created:
+                    await emit(Entity('domain', subdomain, subdomain_data, domain))
+
+        await ScraperClass(domain, session=self.session).run(on_found=on_found)
+
+    async def process(self, entity, emit):
+        if entity.parent is not None:
+            return
+
+        async with trio.open_nursery() as nursery:
+            for ScraperClass in scrape.SCRAPERS:
+                nursery.start_soon(self.scrape, ScraperClass, entity.value, emit)
 
 
 class SubdomainBruteForceTransformer(BaseTransformer):
@@ -39,52 +78,126 @@ class SubdomainBruteForceTransformer(BaseTransformer):
     RECOMMENDED = False
     PASSIVE = True
 
+    CONSUMES = ('domain', )
+
     def __init__(self, *args, **kwargs):
         super(SubdomainBruteForceTransformer, self).__init__(*args, **kwargs)
         self.wordlist = None
         self.nameservers = None
+        self.engine = None
 
     def setup(self):
-        self.wordlist = click.prompt("Wordlist for brute forcing subdomains",
-                                     default='data/names_xsmall.txt')
-        nameservers = click.prompt("List of resolvers",
-                                   default='data/resolvers.txt')
-        self.nameservers = [ns.strip() for ns in open(nameservers, 'r').readlines()]
-
-    def run(self):
-        for domain, item in self.iter_domains(only_base=True):
-            results = trio.run(bruteforce.bruteforce_subdomains, domain, self.wordlist, self.nameservers)
-            if 'subdomains' not in item:
-                item['subdomains'] = {}
-            subdomains = item['subdomains']
-            for result, ip_addresses in results:
-                if result in subdomains:
-                    subdomains[result]['sources'].append('brute')
-                else:
-                    subdomains[result] = domain_payload(result, ['brute'])
-
-        return self.data
+        self.wordlist = self.option('wordlist', 'data/names_xsmall.txt', "Wordlist for brute forcing subdomains")
+        nameservers = self.option('resolvers', 'data/resolvers.txt', "List of resolvers")
+        self.nameservers = list(iter_wordlist(nameservers))
+
+    async def open(self, resources):
+        self.engine = await self.open_dns_engine(resources, self.nameservers)
+
+    async def process(self, entity, emit):
+        if entity.parent is not None:
+            return
+
+        async def on_found(subdomain, ip_addresses):
+            subdomain_data, created = add_subdomain(self.store, entity.value, subdomain, ['brute'])
+            if created:
+                await emit(Entity('domain', subdomain, subdomain_data, entity.value))
+
+        def on_progress(offset):
+            self.progress[entity.value] = offset
+
+        await bruteforce.bruteforce_subdomains(entity.value, self.wordlist, self.nameservers,
+                                               engine=self.engine, on_found=on_found,
+                                               start=self.progress.get(entity.value, 0), on_progress=on_progress)
+        # Done with the whole wordlist, a stale rerun starts over
+        self.progress.pop(entity.value, None)
 
 
 class SubdomainWebsiteScraperTransformer(BaseTransformer):
+    # HttpProbeTransformer picks up links and redirects from the page it fetches anyway, this fetches it again
     ESSENTIAL = False
-    RECOMMENDED = True
+    RECOMMENDED = False
     PASSIVE = False
 
-    def run(self):
-        results = trio.run(scrape.scrape_websites, [d for d, _ in self.iter_domains()])
+    CONSUMES = ('domain', )
+    CONCURRENCY = defaults.DEFAULT_CONNECTION_COUNT
+
+    def __init__(self, *args, **kwargs):
+        super(SubdomainWebsiteScraperTransformer, self).__init__(*args, **kwargs)
+        self.session = None
+
+    async def open(self, resources):
+        self.session = await self.open_http_session(resources)
 
-        for domain, item in self.iter_domains(only_base=True):
-            if 'subdomains' not in item:
-                item['subdomains'] = {}
+    async def process(self, entity, emit):
+        results = {}
+        await scrape.scrape_website_for_domains(entity.value, results, self.session)
 
-            subdomains = item['subdomains']
-            for result, _ in results.items():
-                if not result.endswith('.' + domain):
-                    continue
-                if result in subdomains:
-                    subdomains[result]['sources'].extend(['website'])
-                else:
-                    subdomains[result] = domain_payload(result, ['website'])
+        base = self.base_domain(entity)
+        for result in results:
+            if not result.endswith('.' + base):
+                continue
+            subdomain_data, created = add_subdomain(self.store, base, result, ['website'])
+            if created:
+                await emit(Entity('domain', result, subdomain_data, base))
 
-        return self.data
+
+class SubdomainCertificateTransformer(BaseTransformer):
+    ESSENTIAL = False
+    RECOMMENDED = True
+    PASSIVE = False
+
+    CONSUMES = ('http', 'tcp_port')
+    CONCURRENCY = defaults.DEFAULT_CONNECTION_COUNT
+
+    def __init__(self, *args, **kwargs):
+        super(SubdomainCertificateTransformer, self).__init__(*args, **kwargs)
+        self.timeout = None
+        self.seen = set()
+        self.found = 0
+
+    def setup(self):
+        self.timeout = self.option('timeout', defaults.BANNER_TIMEOUT)
+
+    def endpoint(self, entity):
+        # (record, host, port, server name) of a TLS endpoint, None for anything that isn't one
+        if entity.type == 'http':
+            url = urlparse(entity.value)
+            if url.scheme != 'https':
+                return None
+            record = self.store.get('http', entity.value)
+            # Probed through its IP in vhost mode, that's where the certificate was seen
+            return record, record.data.get('ip') or url.hostname, url.port or 443, url.hostname
+
+        record = self.store.get('tcp_port', entity.value, entity.parent)
+        if record is None or (entity.value not in defaults.TLS_PORTS and 'tls' not in record.data):
+            return None
+        return record, entity.parent, entity.value, self.server_name(entity.parent)
+
+    async def process(self, entity, emit):
+        endpoint = self.endpoint(entity)
+        if endpoint is None:
+            return
+        record, host, port, server_name = endpoint
+
+        # Probing or banner grabbing usually got here first, the handshake is only done when nobody did
+        cert = record.data.get('tls') or self.certificates.get(host, port, server_name)
+        if cert is None:
+            cert = await self.certificates.fetch(host, port, server_name, self.timeout)
+        if cert is None:
+            return
+        self.store.update(record, {'tls': cert})
+
+        # A port hangs off its IP, the domains are found from there
+        owner = self.store.get('ip_address', entity.parent) if entity.type == 'tcp_port' else record
+        bases = tuple(self.base_domains(owner))
+        # Certificates are shared across lots of hosts, one look at each is enough
+        if (cert['sha256'], bases) in self.seen:
+            return
+        self.seen.add((cert['sha256'], bases))
+        self.found += await add_certificate_names(self.store, bases, certificate_hostnames(cert), emit)
+
+    async def finish(self, emit):
+        if self.seen:
+            info(f"Certificates: {len(self.seen)} looked at, {self.certificates.handshakes} handshakes, "
+                 f"{self.found} new subdomains")
@@ -1,10 +1,27 @@
 import random
+import urllib.parse as urlparse
 
 import asks
 import trio
 
 import defaults
+from fingerprint import ResponseFingerprint
+from netindex import EdgeSampler
+from pageinfo import favicon_hash, favicon_url, link_hosts, page_info
 from pipeline.base import BaseTransformer
+from pipeline.domain import add_subdomain
+from pipeline.runner import Entity
+from primitives import query_dns
+from utils import info, iter_wordlist
+from vhost import ConnectionLost, VhostClient
+
+PROBE_ERRORS = (OSError, trio.BrokenResourceError, trio.TooSlowError, ConnectionLost, asks.errors.RequestTimeout,
+                asks.errors.BadHttpResponse)
+REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+
+
+def in_scope(host, base):
+    return bool(host) and (host == base or host.endswith('.' + base))
 
 
 class HttpProbeTransformer(BaseTransformer):
@@ -12,42 +29,190 @@ class HttpProbeTransformer(BaseTransformer):
     RECOMMENDED = True
     PASSIVE = False
 
-    async def probe_url(self, session, url, domain_data, key='http'):
-        params = dict(
-            follow_redirects=False,
-            timeout=5,
-            retries=1,
-            headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
-        )
+    CONSUMES = ('domain', )
+    CONCURRENCY = defaults.DEFAULT_CONNECTION_COUNT
+
+    def __init__(self, *args, **kwargs):
+        super(HttpProbeTransformer, self).__init__(*args, **kwargs)
+        self.session = None
+        self.timeout = None
+        self.cdn_hosts = None
+        self.sampler = None
+        self.mode = None
+        self.nameservers = None
+        self.engine = None
+        self.vhosts = None
+        self.favicons = {}
+        self.pending_favicons = {}
+
+    def setup(self):
+        self.timeout = self.option('timeout', 5)
+        # host: a request per URL, connections pooled per host name. ip: host names are probed through the IP
+        # they resolve to, one connection per (ip, port, scheme) with only Host and SNI changing
+        self.mode = self.option('mode', 'host')
+        # probe: every domain, skip or sample: domains that only resolve to CDN edges are left out, or only a few
+        # per CDN network are probed. Virtual hosts on a CDN usually do differ, hence probing them by default.
+        self.cdn_hosts = self.option('cdn_hosts', 'probe')
+        self.sampler = EdgeSampler(self.option('cdn_sample', defaults.CDN_SAMPLE_SIZE))
+        if self.mode == 'ip' or self.cdn_hosts != 'probe':
+            nameservers = self.option('resolvers', 'data/resolvers.txt', "List of resolvers")
+            self.nameservers = list(iter_wordlist(nameservers))
+
+    async def is_shared_edge(self, domain):
+        if self.cdn_hosts == 'probe':
+            return False
+        # Domains usually get here before IPAddressTransformer is done with them, so they're resolved here too
+        edges = [self.cdn_ranges.find(ip) for ip in await self.addresses(domain)]
+        if not edges or None in edges:
+            return False
+        return self.cdn_hosts == 'skip' or not self.sampler.admit(edges[0][0], domain)
+
+    async def fetch(self, url, max_body=None):
+        # One GET, redirects not followed, through the IP in vhost mode; None when nothing answered
+        parsed = urlparse.urlparse(url)
+        try:
+            if self.mode != 'ip':
+                with trio.move_on_after(self.timeout):
+                    return await self.session.probe(url, method='GET', max_body=max_body, follow_redirects=False,
+                                                    timeout=self.timeout, retries=1,
+                                                    headers={'User-Agent': random.choice(defaults.USER_AGENTS)})
+                return None
+            ip = await self.resolve(parsed.hostname)
+            if ip is None:
+                return None
+            path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+            port = parsed.port or defaults.SCHEME_PORTS[parsed.scheme]
+            # Timed by the client, once it has a connection to the IP for it
+            return await self.vhosts.request(ip, port, parsed.scheme, parsed.netloc, path, max_body=max_body)
+        except PROBE_ERRORS:
+            pass
+        return None
+
+    async def follow(self, url, base):
+        # Every response along the redirect chain, plus where it left off when it left the base domain or looped
+        responses = []
+        while len(responses) <= defaults.HTTP_MAX_REDIRECTS:
+            response = await self.fetch(url)
+            if response is None:
+                break
+            response.url = url
+            responses.append(response)
+
+            location = response.headers.get('location')
+            if response.status_code not in REDIRECT_STATUS_CODES or not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if not in_scope(urlparse.urlparse(url).hostname, base) or url in [r.url for r in responses]:
+                return responses, url
+        return responses, None
 
+    async def favicon(self, url, body, base):
+        # Most sites of one product share an icon, so http and https (or a redirect to one) only fetch it once
+        icon = favicon_url(url, body)
+        # Icons on other sites' hosts (CDNs, a parent company) aren't this target's to fetch
+        if not in_scope(urlparse.urlparse(icon).hostname, base):
+            return None
+        if icon in self.favicons:
+            return self.favicons[icon]
+
+        event = self.pending_favicons.get(icon)
+        if event is not None:
+            await event.wait()
+            return self.favicons.get(icon)
+
+        self.pending_favicons[icon] = trio.Event()
+        try:
+            response = await self.fetch(icon, defaults.HTTP_FAVICON_MAX_BODY)
+            hashed = None
+            if response is not None and response.status_code == 200 and response.body and not response.truncated:
+                hashed = favicon_hash(response.body)
+            self.favicons[icon] = hashed
+            return hashed
+        finally:
+            self.pending_favicons.pop(icon).set()
+
+    async def probe_url(self, url, base, domain_data, hosts, key='http'):
         results = {
             'live': False,
             'status_code': None,
             'url': url
         }
+        domain_data[key] = results
 
-        try:
-            with trio.move_on_after(5):
-                response = await session.get(url, **params)
-                results['live'], results['status_code'] = True, response.status_code
+        responses, left_at = await self.follow(url, base)
+        if not responses:
+            return False
 
-        except (OSError, asks.errors.RequestTimeout):
-            pass
-        domain_data[key] = results
-        return results['live']
+        first, final = responses[0], responses[-1]
+        results['live'], results['status_code'] = True, first.status_code
+        results['redirects'] = [{'url': response.url, 'status_code': response.status_code}
+                                for response in responses[1:]]
+        results['final_url'] = left_at or final.url
+        results.update(page_info(final))
+        if final.status_code == 200 and self.option('favicon', True):
+            results['favicon_hash'] = await self.favicon(final.url, final.body, base)
+
+        if self.mode == 'ip':
+            parsed = urlparse.urlparse(url)
+            results['ip'] = await self.resolve(parsed.hostname)
+            # Whether the name gets a site of its own or whatever the server shows for names it doesn't know
+            baseline = await self.vhosts.baseline(results['ip'], defaults.SCHEME_PORTS[parsed.scheme], parsed.scheme)
+            if baseline is not None:
+                results['vhost'] = 'default' if ResponseFingerprint(first).similar(baseline) else 'distinct'
+
+        hosts.update(urlparse.urlparse(response.url).hostname for response in responses)
+        if left_at:
+            hosts.add(urlparse.urlparse(left_at).hostname)
+        hosts.update(link_hosts(final.url, final.body))
+        return True
 
-    async def check_urls(self):
-        session = self.get_http_session()
+    async def addresses(self, domain):
+        # Usually resolved already, by IPAddressTransformer or through the shared DNS cache
+        record = self.store.get('domain', domain)
+        addresses = [ip.value for ip in self.store.iter_children(record, 'ip_address')] if record else []
+        if not addresses:
+            answer = await query_dns(domain, self.engine, None)
+            addresses = answer.addresses if answer else []
+        return addresses
 
+    async def resolve(self, domain):
+        # The same pick for every name on the same set of IPs, so they end up on the same connections
+        addresses = await self.addresses(domain)
+        return min(addresses) if addresses else None
+
+    async def open(self, resources):
+        if self.nameservers is not None:
+            self.engine = await self.open_dns_engine(resources, self.nameservers)
+        if self.mode == 'ip':
+            self.vhosts = await resources.get('vhost_client', lambda: VhostClient(
+                connections=self.option('connections', defaults.DEFAULT_CONNECTION_COUNT),
+                connections_per_ip=self.option('connections_per_ip', defaults.VHOST_CONNECTIONS_PER_IP),
+                timeout=self.timeout,
+                on_certificate=self.certificates.add))
+        else:
+            self.session = await self.open_http_session(resources)
+
+    async def process(self, entity, emit):
+        if await self.is_shared_edge(entity.value):
+            return
+
+        web, hosts = {}, set()
+        base = self.base_domain(entity)
         async with trio.open_nursery() as nursery:
-            for domain, domain_data in self.iter_domains():
-                if 'web' not in domain_data:
-                    domain_data['web'] = {}
-                url = f"http://{domain}"
-                nursery.start_soon(self.probe_url, session, url, domain_data['web'])
-                url = f"https://{domain}"
-                nursery.start_soon(self.probe_url, session, url, domain_data['web'], 'https')
-
-    def run(self):
-        trio.run(self.check_urls)
-        return self.data
+            nursery.start_soon(self.probe_url, f"http://{entity.value}", base, web, hosts)
+            nursery.start_soon(self.probe_url, f"https://{entity.value}", base, web, hosts, 'https')
+
+        for result in web.values():
+            record, _ = self.store.add('http', result['url'], result, entity.value)
+            if result['live']:
+                await emit(Entity('http', result['url'], record.data, entity.value))
+
+        # Redirect targets and whatever the page links to, what a separate crawl of the site used to find
+        for host in sorted(host for host in hosts if host != entity.value and in_scope(host, base)):
+            subdomain_data, created = add_subdomain(self.store, base, host, ['website'])
+            if created:
+                await emit(Entity('domain', host, subdomain_data, base))
+
+    async def finish(self, emit):
+        if self.vhosts is not None:
+            info(f"Virtual host probing: {self.vhosts.stats()}")
@@ -1,12 +1,11 @@
-import geoip2.database
-import geoip2.errors
-import trio
-import click
-
 import defaults
+from geoip import GeoIPLookup
+from netindex import bucket_network
 from pipeline.base import BaseTransformer
+from pipeline.runner import Entity
 
 from primitives import query_dns
+from utils import info, iter_wordlist
 
 
 def ip_payload(ip):
@@ -16,55 +15,35 @@ def ip_payload(ip):
     }
 
 
-def geoip_payload(asn_response, country_response):
-    return {
-        'type': 'geoip_data',
-        'network': str(asn_response.network) if asn_response else None,
-        'asn': asn_response.autonomous_system_number if asn_response else None,
-        'asn_name': asn_response.autonomous_system_organization if asn_response else None,
-        'continent_name': country_response.continent.names['en'] if country_response else None,
-        'continent_code': country_response.continent.code if country_response else None,
-        'country_name': country_response.country.names['en'] if country_response else None,
-        'country_code': country_response.country.iso_code if country_response else None,
-    }
-
-
 class IPAddressTransformer(BaseTransformer):
     ESSENTIAL = False
     RECOMMENDED = True
     PASSIVE = True
 
+    CONSUMES = ('domain', )
+    CONCURRENCY = defaults.DNS_LIMIT
+
     def __init__(self, *args, **kwargs):
         super(IPAddressTransformer, self).__init__(*args, **kwargs)
         self.nameservers = None
+        self.engine = None
 
     def setup(self):
-        nameservers = click.prompt("List of resolvers", default='data/resolvers.txt')
-        self.nameservers = [ns.strip() for ns in open(nameservers, 'r').readlines()]
-
-    async def resolve_domains(self):
-        limit = trio.CapacityLimiter(defaults.DNS_LIMIT)
-        results = []
-        async with trio.open_nursery() as nursery:
-            for domain, _ in self.iter_domains():
-                nursery.start_soon(
-                    query_dns,
-                    domain,
-                    self.nameservers,
-                    results,
-                    limit,
-                    None
-                )
-
-        results = dict(results)
-        for domain, domain_data in self.iter_domains():
-            domain_data['ip_addresses'] = {
-                ip: ip_payload(ip) for ip in results.get(domain, [])
-            }
+        nameservers = self.option('resolvers', 'data/resolvers.txt', "List of resolvers")
+        self.nameservers = list(iter_wordlist(nameservers))
 
-    def run(self):
-        trio.run(self.resolve_domains)
-        return self.data
+    async def open(self, resources):
+        self.engine = await self.open_dns_engine(resources, self.nameservers)
+
+    async def process(self, entity, emit):
+        answer = await query_dns(entity.value, self.engine, None)
+        addresses = answer.addresses if answer else []
+
+        for ip in addresses:
+            # An IP shared by many domains is one record linked to each, and goes down the pipeline once
+            record, created = self.store.add('ip_address', ip, ip_payload(ip), entity.value)
+            if created:
+                await emit(Entity('ip_address', ip, record.data, entity.value))
 
 
 class GeoIPTransformer(BaseTransformer):
@@ -72,37 +51,73 @@ class GeoIPTransformer(BaseTransformer):
     RECOMMENDED = True
     PASSIVE = True
 
+    CONSUMES = ('ip_address', )
+    # Lookups don't wait on anything, more at once only adds scheduling
+    CONCURRENCY = 1
+
     def __init__(self, *args, **kwargs):
         super(GeoIPTransformer, self).__init__(*args, **kwargs)
         self.mmdb = None
-        self.country_reader = None
-        self.asn_reader = None
+        self.geoip = None
 
     def setup(self):
-        self.mmdb = click.prompt("MaxMind Database Location", default='data/mmdb')
-        self.country_reader = geoip2.database.Reader(f'{self.mmdb}/GeoLite2-Country.mmdb')
-        self.asn_reader = geoip2.database.Reader(f'{self.mmdb}/GeoLite2-ASN.mmdb')
-
-    def run(self):
-        for domain, domain_data in self.iter_domains():
-            if 'ip_addresses' in domain_data:
-                for ip_addr, ip_data in domain_data['ip_addresses'].items():
-                    asn_response, country_response = self.get_geoip_data(ip_addr)
-                    ip_data['geo_ip'] = geoip_payload(asn_response, country_response)
+        self.mmdb = self.option('mmdb', 'data/mmdb', "MaxMind Database Location")
+        self.geoip = GeoIPLookup(self.mmdb)
 
-        return self.data
+    async def process(self, entity, emit):
+        record = self.store.get(entity.type, entity.value)
+        self.store.update(record, {'geo_ip': self.geoip.lookup(entity.value)})
 
-    def get_geoip_data(self, ip_addr):
-        try:
-            country_response = self.country_reader.country(ip_addr)
-        except geoip2.errors.AddressNotFoundError:
-            country_response = None
-        try:
-            asn_response = self.asn_reader.asn(ip_addr)
-        except geoip2.errors.AddressNotFoundError:
-            asn_response = None
-        return asn_response, country_response
+    async def finish(self, emit):
+        info(f"GeoIP: {self.geoip.stats()}")
 
+    def run(self):
+        # Everything already in the store in one sorted pass instead of going through the pipeline
+        records = {record.value: record for record in self.store.iter('ip_address')}
+        for ip, payload in self.geoip.lookup_many(records).items():
+            self.store.update(records[ip], {'geo_ip': payload})
+        info(f"GeoIP: {self.geoip.stats()}")
+        return self.store
 
 
+class NetworkAggregatorTransformer(BaseTransformer):
+    ESSENTIAL = False
+    RECOMMENDED = True
+    PASSIVE = True
 
+    CONSUMES = ('ip_address', )
+    CONCURRENCY = 1
+
+    def network(self, record):
+        # The CDN network the IP is in, else the ASN's announced network, else its /24 (/48 for IPv6)
+        cdn = self.cdn_ranges.find(record.value)
+        if cdn is not None:
+            return cdn[0], cdn[1]
+        geo_ip = record.data.get('geo_ip') or {}
+        # Without an ASN the network is the country database's, often a /14 of unrelated hosts
+        if geo_ip.get('asn') is not None and geo_ip.get('network'):
+            return geo_ip['network'], None
+        return bucket_network(record.value), None
+
+    async def process(self, entity, emit):
+        record = self.store.get(entity.type, entity.value)
+        network, cdn = self.network(record)
+        self.store.update(record, {'network': network, 'cdn': cdn})
+
+    async def finish(self, emit):
+        # Grouped once everything is in, GeoIP may not have gotten to an IP yet when it went through process()
+        groups = {}
+        for record in self.store.iter('ip_address'):
+            network, cdn = self.network(record)
+            groups.setdefault(network, []).append(record)
+            self.store.update(record, {'network': network, 'cdn': cdn})
+
+        for network, records in groups.items():
+            for record in records:
+                self.store.update(record, {'network_ips': len(records)})
+
+        largest = sorted(groups.items(), key=lambda item: len(item[1]), reverse=True)[:defaults.NETWORK_TOP_GROUPS]
+        for network, records in largest:
+            domains = {parent.key for record in records for parent in self.store.iter_parents(record, 'domain')}
+            cdn = records[0].data.get('cdn')
+            info(f"{network}{f' ({cdn})' if cdn else ''}: {len(records)} IPs, {len(domains)} domains")
@@ -1,16 +1,23 @@
-import click
-import trio
+from collections import Counter
 
 import defaults
+from banner import grab_banner
 from pipeline.base import BaseTransformer
-from primitives import check_port
+from pipeline.domain import add_certificate_names
+from pipeline.runner import Entity
+from hostcache import get_host_cache
+from netindex import EdgeSampler
+from tlscert import certificate_hostnames
+from portscan import HostDiscovery, PortScanEngine, parse_port_spec, service_name
+from utils import info, run_worker_pool
 
 
-def port_payload(port):
+def port_payload(port, service=None):
     return {
         'value': port,
         'status': 'open',
         'type': 'tcp_port',
+        'service': service,
     }
 
 
@@ -19,47 +26,137 @@ class PortScannerTransformer(BaseTransformer):
     RECOMMENDED = False
     PASSIVE = False
 
+    CONSUMES = ('ip_address', )
+    CONCURRENCY = 16
+
     def __init__(self, *args, **kwargs):
         super(PortScannerTransformer, self).__init__(*args, **kwargs)
-        self.wordlist = None
         self.ports_index = None
+        self.timeout = None
+        self.engine = None
+        self.discovery = None
+        self.dead_hosts = None
+        self.cdn_hosts = None
+        self.sampler = None
+        self.skipped = Counter()
 
     def setup(self):
-        self.wordlist = click.prompt("List of ports", default='data/ports.txt')
-
-        ports_with_desc = [line.strip().split('\t') for line in open(self.wordlist, 'r').readlines()]
-        self.ports_index = {}
-        for item in ports_with_desc:
-            if len(item) == 2:
-                port, desc = item
-            else:
-                port, desc = item[0], '--NO-DESC--'
-            self.ports_index[port] = desc
-
-    async def scan_all_ports(self):
-        limit = trio.CapacityLimiter(defaults.PORT_SCAN_LIMIT)
-        results = {}
-        async with trio.open_nursery() as nursery:
-            for ip, ip_data in self.iter_ip_addresses():
-                if ip in results:
-                    continue
-
-                results[ip] = {}
-                for port in self.ports_index:
-                    nursery.start_soon(
-                        check_port,
-                        ip,
-                        port,
-                        results,
-                        limit,
-                    )
-
-        for ip, ip_data in self.iter_ip_addresses():
-            ip_data['ports'] = {}
-            for port, status in results[ip].items():
-                if status == 'open':
-                    ip_data['ports'][port] = port_payload(port)
-
-    def run(self):
-        trio.run(self.scan_all_ports)
-        return self.data
+        ports = self.option('ports', 'data/ports.txt', "Ports (file, list like 22,80,8000-8100, top-1000 or all)")
+        self.ports_index = parse_port_spec(ports)
+        self.timeout = self.option('timeout', defaults.PORT_SCAN_TIMEOUT)
+        # skip: dead hosts aren't scanned, defer: they are, once every live host is done, off: no discovery
+        self.dead_hosts = self.option('dead_hosts', 'skip')
+        # scan: CDN edges are scanned like anything else, skip: never, sample: only a few IPs per CDN network
+        self.cdn_hosts = self.option('cdn_hosts', 'sample')
+
+    async def open(self, resources):
+        # What was sampled is kept with the progress, a resumed run doesn't pick new ones
+        self.sampler = EdgeSampler(self.option('cdn_sample', defaults.CDN_SAMPLE_SIZE),
+                                   self.progress.setdefault('cdn_sampled', {}))
+        self.engine = PortScanEngine(connections=self.option('limit', defaults.PORT_SCAN_LIMIT),
+                                     per_host=self.option('host_limit', defaults.PORT_SCAN_HOST_LIMIT),
+                                     timeout=self.timeout,
+                                     retries=self.option('retries', defaults.PORT_SCAN_RETRIES))
+        if self.dead_hosts != 'off':
+            ports = self.option('discovery_ports', ','.join(map(str, defaults.HOST_DISCOVERY_PORTS)))
+            self.discovery = HostDiscovery(self.engine, get_host_cache() if self.option('host_cache', True) else None,
+                                           ports=list(parse_port_spec(ports)),
+                                           timeout=self.option('discovery_timeout', defaults.HOST_DISCOVERY_TIMEOUT))
+
+    async def scan_ip(self, ip):
+        # Ports already scanned before an interruption are kept, only the rest are probed
+        await self.engine.scan(ip, self.ports_index, self.progress.setdefault(ip, {}))
+        return self.progress.pop(ip)
+
+    async def scan(self, ip, emit):
+        statuses = await self.scan_ip(ip)
+
+        counts = Counter(statuses.values())
+        self.store.update(self.store.get('ip_address', ip),
+                          {'port_scan': {status: counts[status] for status in ('open', 'closed', 'filtered')}})
+
+        for port in sorted(port for port, status in statuses.items() if status == 'open'):
+            service = self.ports_index.get(port) or service_name(port)
+            record, created = self.store.add('tcp_port', port, port_payload(port, service), ip)
+            if created:
+                await emit(Entity('tcp_port', port, record.data, ip))
+
+    def is_shared_edge(self, ip):
+        # Hundreds of subdomains can sit on the same CDN edges, which all look the same from the outside
+        cdn = self.cdn_ranges.find(ip)
+        if cdn is None or self.cdn_hosts == 'scan':
+            return False
+        if self.cdn_hosts == 'sample' and self.sampler.admit(cdn[0], ip):
+            return False
+        self.skipped[cdn[1]] += 1
+        return True
+
+    async def process(self, entity, emit):
+        ip = entity.value
+        if self.is_shared_edge(ip):
+            return
+        if self.discovery is not None:
+            alive = await self.discovery.is_alive(ip)
+            self.store.update(self.store.get(entity.type, ip), {'alive': alive})
+            if not alive:
+                if self.dead_hosts == 'defer':
+                    # Kept with the stage progress, so a resumed run still gets to them
+                    self.progress.setdefault('deferred', []).append(ip)
+                return
+
+        await self.scan(ip, emit)
+
+    async def finish(self, emit):
+        async def scan_deferred(ip):
+            await self.scan(ip, emit)
+            self.progress['deferred'].remove(ip)
+
+        deferred = list(self.progress.get('deferred', ()))
+        if deferred:
+            info(f"Scanning {len(deferred)} hosts that looked dead")
+            await run_worker_pool(deferred, scan_deferred, self.CONCURRENCY)
+
+        if self.engine is not None:
+            info(f"Port scan: {self.engine.stats()}")
+        if self.discovery is not None:
+            info(f"Host discovery: {self.discovery.stats()}")
+        if self.skipped:
+            info(f"CDN hosts not scanned: {dict(self.skipped)}")
+
+
+class BannerGrabberTransformer(BaseTransformer):
+    ESSENTIAL = False
+    RECOMMENDED = False
+    PASSIVE = False
+
+    CONSUMES = ('tcp_port', )
+    CONCURRENCY = defaults.BANNER_CONCURRENCY
+
+    def __init__(self, *args, **kwargs):
+        super(BannerGrabberTransformer, self).__init__(*args, **kwargs)
+        self.timeout = None
+        self.max_bytes = None
+        self.counts = Counter()
+
+    def setup(self):
+        self.timeout = self.option('timeout', defaults.BANNER_TIMEOUT)
+        self.max_bytes = self.option('max_bytes', defaults.BANNER_MAX_BYTES)
+
+    async def process(self, entity, emit):
+        ip, port = entity.parent, entity.value
+        server_name = self.server_name(ip)
+        result = await grab_banner(ip, port, server_name=server_name, timeout=self.timeout,
+                                   wait=min(defaults.BANNER_READ_WAIT, self.timeout), max_bytes=self.max_bytes)
+        self.counts[result['service'] or 'unknown'] += 1
+        # A service that wasn't recognized keeps the name guessed from the port number
+        fields = {key: value for key, value in result.items() if value is not None}
+        self.store.update(self.store.get('tcp_port', port, ip), fields)
+
+        if result['tls'] is not None:
+            self.certificates.put(ip, port, result['tls'], server_name)
+            await add_certificate_names(self.store, list(self.base_domains(self.store.get('ip_address', ip))),
+                                        certificate_hostnames(result['tls']), emit)
+
+    async def finish(self, emit):
+        if self.counts:
+            info(f"Services: {dict(self.counts)}")
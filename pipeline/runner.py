@@ -0,0 +1,162 @@
+import math
+from contextlib import AsyncExitStack
+from functools import partial
+
+import trio
+
+from utils import error, info, run_worker_pool
+
+
+class Entity(object):
+    __slots__ = ('type', 'value', 'data', 'parent')
+
+    def __init__(self, type, value, data, parent=None):
+        self.type = type
+        self.value = value
+        self.data = data
+        self.parent = parent
+
+    def __repr__(self):
+        return f"Entity({self.type!r}, {self.value!r}, parent={self.parent!r})"
+
+
+class Resources(object):
+    # Things like DNS engines and HTTP sessions, opened once and shared by every stage that asks for them
+
+    def __init__(self, stack):
+        self.stack = stack
+        self.items = {}
+
+    async def get(self, key, factory):
+        if key not in self.items:
+            self.items[key] = await self.stack.enter_async_context(factory())
+        return self.items[key]
+
+
+def seed_entities(store, domain):
+    # Everything a resumed run already found, stages that produce them are done and won't emit them again
+    yield Entity('domain', domain.value, domain.data)
+    seen = set()
+    for record in [domain] + list(store.iter_children(domain, 'domain')):
+        if record is not domain:
+            yield Entity('domain', record.value, record.data, domain.value)
+        for url in store.iter_children(record, 'http'):
+            if url.data.get('live'):
+                yield Entity('http', url.value, url.data, record.value)
+        for ip in store.iter_children(record, 'ip_address'):
+            if ip.key not in seen:
+                seen.add(ip.key)
+                yield Entity('ip_address', ip.value, ip.data, record.value)
+                for port in store.iter_children(ip, 'tcp_port'):
+                    yield Entity('tcp_port', port.value, port.data, ip.value)
+
+
+class PipelineRunner(object):
+    def __init__(self, store, stages, checkpoint=None, sink=None):
+        self.store = store
+        self.stages = stages
+        self.checkpoint = checkpoint
+        self.sink = sink
+        self.routes = {}
+        # Entities in flight per base domain, so a domain can be reported done while others are still running
+        self.pending = {}
+        self._idle = {}
+
+    async def emit(self, entity, root=None):
+        for send_channel in self.routes.get(entity.type, ()):
+            self.pending[root] = self.pending.get(root, 0) + 1
+            # Channels are unbounded: stages feed each other in cycles, and a bounded cycle can deadlock
+            send_channel.send_nowait((entity, root))
+
+    def _done(self, root):
+        self.pending[root] -= 1
+        if not self.pending[root]:
+            del self.pending[root]
+            idle = self._idle.pop(root, None)
+            if idle is not None:
+                idle.set()
+
+    async def _wait_idle(self, root):
+        if root in self.pending:
+            await self._idle.setdefault(root, trio.Event()).wait()
+
+    async def _wait_all_idle(self):
+        while self.pending:
+            await self._wait_idle(next(iter(self.pending)))
+
+    async def _worker(self, stage, receive_channel):
+        async with receive_channel:
+            async for entity, root in receive_channel:
+                try:
+                    if self.checkpoint is not None and self.checkpoint.is_done(stage.name, entity):
+                        continue
+                    await stage.process(entity, partial(self.emit, root=root))
+                    if self.checkpoint is not None:
+                        self.checkpoint.mark_done(stage.name, entity)
+                except Exception as e:
+                    error(f"{stage.name} failed on {entity.value}: {e!r}")
+                finally:
+                    self._done(root)
+
+    async def investigate(self, domain):
+        record, _ = self.store.add('domain', domain, {'type': 'domain', 'value': domain})
+        for entity in seed_entities(self.store, record):
+            await self.emit(entity, root=domain)
+        await self._wait_idle(domain)
+        info(f"Finished {domain}")
+
+    async def run(self, domains=None, concurrency=None):
+        if domains is None:
+            domains = [record.value for record in self.store.roots('domain')]
+
+        send_channels = []
+        async with AsyncExitStack() as stack:
+            if self.sink is not None:
+                # A resumed run starts the stream with everything found so far
+                for record, parent in self.store.iter_edges():
+                    self.sink.on_change(record, parent)
+                self.store.listeners.append(self.sink.on_change)
+                stack.callback(self.store.listeners.remove, self.sink.on_change)
+
+            if self.checkpoint is not None:
+                self.checkpoint.store = self.store
+                # Also covers crashes and Ctrl-C, the checkpoint is only ever behind by the save interval
+                stack.callback(self.checkpoint.save)
+
+            resources = Resources(stack)
+            for stage in self.stages:
+                await stage.open(resources)
+
+            async with trio.open_nursery() as nursery:
+                if self.checkpoint is not None:
+                    nursery.start_soon(self.checkpoint.autosave)
+
+                for stage in self.stages:
+                    if not stage.CONSUMES:
+                        continue
+                    send_channel, receive_channel = trio.open_memory_channel(math.inf)
+                    send_channels.append(send_channel)
+                    for entity_type in stage.CONSUMES:
+                        self.routes.setdefault(entity_type, []).append(send_channel)
+                    async with receive_channel:
+                        for _ in range(stage.CONCURRENCY):
+                            nursery.start_soon(self._worker, stage, receive_channel.clone())
+
+                # Only this many base domains are in the pipeline at once, the rest wait their turn
+                await run_worker_pool(domains, self.investigate, concurrency or max(len(domains), 1))
+
+                # Stages finish in pipeline order; whatever a finishing stage emits has to drain first
+                for stage in self.stages:
+                    await self._wait_all_idle()
+                    await stage.finish(self.emit)
+                await self._wait_all_idle()
+
+                for send_channel in send_channels:
+                    await send_channel.aclose()
+                nursery.cancel_scope.cancel()
+
+        return self.store
+
+
+async def run_pipeline(store, stages, domains=None, concurrency=None, checkpoint=None, sink=None):
+    return await PipelineRunner(store, stages, checkpoint, sink).run(domains, concurrency)
@@ -1,4 +1,3 @@
-import click
 import random
 
 import asks
@@ -6,7 +5,9 @@ import trio
 
 import defaults
 import utils
+from fingerprint import build_baseline
 from pipeline.base import BaseTransformer
+from pipeline.runner import Entity
 import urllib.parse as urlparse
 
 from utils import warning
@@ -27,14 +28,19 @@ class SensitiveURLFinderTransformer(BaseTransformer):
     RECOMMENDED = True
     PASSIVE = False
 
+    CONSUMES = ('domain', )
+    CONCURRENCY = 10
+
     def __init__(self, *args, **kwargs):
         super(SensitiveURLFinderTransformer, self).__init__(*args, **kwargs)
         self.wordlist = None
         self.url_index = None
+        self.session = None
+        self.timeout = None
 
     def setup(self):
-        self.wordlist = click.prompt("Sensitive URLs List file",
-                                     default='data/sensitive_urls.txt')
+        self.wordlist = self.option('wordlist', 'data/sensitive_urls.txt', "Sensitive URLs List file")
+        self.timeout = self.option('timeout', 5)
 
         urls_with_desc = [line.strip().split('\t') for line in open(self.wordlist, 'r').readlines()]
         self.url_index = {}
@@ -45,29 +51,29 @@ class SensitiveURLFinderTransformer(BaseTransformer):
                 url, desc = item[0], '--NO-DESC--'
             self.url_index[url] = desc
 
-    async def probe_url(self, session, url, description=None, valid_status_codes=None, results=None):
+    async def probe_url(self, session, url, description=None, valid_status_codes=None, baseline=None,
+                        results=None):
         result = None
         params = dict(
-            follow_redirects=True,
-            timeout=5,
+            follow_redirects=False,
+            timeout=self.timeout,
             retries=1,
             headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
         )
         try:
-            with trio.move_on_after(5):
-                response = await session.get(url, **params)
-                result = response
-                print(f"{url}\t\t{response.status_code}")
-        except (OSError, asks.errors.RequestTimeout):
+            with trio.move_on_after(self.timeout):
+                result = await session.probe(url, method='GET', **params)
+                print(f"{url}\t\t{result.status_code}")
+        except (OSError, asks.errors.RequestTimeout, asks.errors.BadHttpResponse):
             pass
 
         if valid_status_codes is None:
             valid_status_codes = defaults.DEFAULT_VALID_STATUS_CODES
         if result and results is not None:
-            if result.status_code in valid_status_codes:
+            original_path = urlparse.urlparse(url).path
+            if result.status_code in valid_status_codes and not (baseline and baseline.matches(result, original_path)):
                 domain = urlparse.urlparse(url).netloc
-                path = urlparse.urlparse(result.url).path
-                original_path = urlparse.urlparse(url).path
+                path = urlparse.urlparse(result.headers.get('location', '')).path or None
                 if domain not in results:
                     results[domain] = {}
                 results[domain][original_path] = path_payload(
@@ -79,44 +85,32 @@ class SensitiveURLFinderTransformer(BaseTransformer):
 
         return result
 
-    async def get_sensitive_urls(self, paths, valid_status_codes=None):
-        session = self.get_http_session()
-        results = {}
-
-        async with trio.open_nursery() as nursery:
-            for path, description in paths.items():
-                for domain, _ in self.iter_domains():
-                    nursery.start_soon(
-                        self.probe_url,
-                        session,
-                        utils.append_path(f"http://{domain}", path),
-                        description,
-                        valid_status_codes[domain] if valid_status_codes else None,
-                        results
-                    )
-
-        return results
+    async def open(self, resources):
+        self.session = await self.open_http_session(resources)
 
-    def run(self):
-        path404 = "/" + utils.random_string(30, defaults.ALLOWED_CHARS)
-        wildcard_responses = trio.run(self.get_sensitive_urls, {path404: ""})
+    async def process(self, entity, emit):
+        domain = entity.value
+        baseline = await build_baseline(self.session, f"http://{domain}", utils.append_path, method='GET',
+                                        follow_redirects=False, timeout=self.timeout, retries=1)
+        soft_404s = {code: fps for code, fps in baseline.fingerprints.items()
+                     if code in defaults.DEFAULT_VALID_STATUS_CODES}
+        if soft_404s:
+            warning(f"Found wildcard responses for {domain}: {soft_404s}")
 
-        valid_status_codes = {}
-        for domain, _ in self.iter_domains():
-            valid_status_codes[domain] = defaults.DEFAULT_VALID_STATUS_CODES[:]
-            if domain in wildcard_responses and wildcard_responses[domain]:
-                first_key = list(wildcard_responses[domain].keys())[0]
-                wildcard_status_code = wildcard_responses[domain][first_key]['status_code']
-                warning(f"Found wildcard status_code={wildcard_status_code} for {domain}")
-                valid_status_codes[domain].remove(wildcard_status_code)
-
-        sensitive_urls = trio.run(self.get_sensitive_urls, self.url_index, valid_status_codes)
-        print("Sensitive URLS: ", sensitive_urls)
-
-        import json
-        json.dumps(sensitive_urls, indent=2)
-
-        for domain, domain_data in self.iter_domains():
-            domain_data['paths'] = sensitive_urls.get(domain, {})
-
-        return self.data
+        results = {}
+        async with trio.open_nursery() as nursery:
+            for path, description in self.url_index.items():
+                nursery.start_soon(
+                    self.probe_url,
+                    self.session,
+                    utils.append_path(f"http://{domain}", path),
+                    description,
+                    None,
+                    baseline,
+                    results
+                )
+
+        for path, path_data in results.get(domain, {}).items():
+            record, created = self.store.add('path', path, path_data, domain)
+            if created:
+                await emit(Entity('path', path, record.data, domain))
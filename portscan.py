@@ -0,0 +1,261 @@
+import errno
+import os
+import resource
+import socket
+import struct
+import time
+
+import trio
+
+import defaults
+from utils import run_worker_pool
+
+PORT_SPECS = {
+    'all': '1-65535',
+    'top-1000': 'data/top_ports.txt',
+}
+
+# ICMP unreachable and friends, something on the path dropped the connection attempt
+FILTERED_ERRNOS = {errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EACCES, errno.EPERM, errno.ETIMEDOUT}
+# Out of file descriptors or local ports, temporary as long as connects keep finishing
+RESOURCE_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.EADDRNOTAVAIL, errno.ENOBUFS}
+LINGER_RESET = struct.pack('ii', 1, 0)
+
+
+def _parse_port_item(item):
+    start, _, end = item.strip().partition('-')
+    start, end = int(start), int(end or start)
+    if not 1 <= start <= end <= 65535:
+        raise ValueError(f"Invalid port range: {item}")
+    return range(start, end + 1)
+
+
+def parse_port_spec(spec):
+    # "22,80,8000-8100", "top-1000", "all", or a file with a port or range (and optional description) per line
+    spec = str(spec).strip()
+    spec = PORT_SPECS.get(spec, spec)
+    ports = {}
+    if os.path.exists(spec):
+        with open(spec, 'r') as handle:
+            for line in handle:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                item, _, description = line.rstrip('\n').partition('\t')
+                for port in _parse_port_item(item):
+                    ports[port] = description or None
+    else:
+        for item in spec.split(','):
+            if item.strip():
+                for port in _parse_port_item(item):
+                    ports[port] = None
+    return ports
+
+
+def service_name(port):
+    try:
+        return socket.getservbyport(port, 'tcp')
+    except OSError:
+        return None
+
+
+def raise_fd_limit():
+    # Every connect in flight is a file descriptor, take everything the hard limit allows
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        target = defaults.PORT_SCAN_MAX_FDS if hard == resource.RLIM_INFINITY else hard
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, target), hard))
+            soft = max(soft, target)
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class RTTEstimator(object):
+    # Smoothed RTT and variance as in RFC 6298, answered connects (open or refused) are the samples
+    __slots__ = ('srtt', 'rttvar', 'samples')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def add(self, rtt):
+        self.samples += 1
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self, initial, minimum, maximum):
+        if self.srtt is None:
+            return initial
+        return min(max(self.srtt + 4 * self.rttvar, minimum), maximum)
+
+
+class PortScanEngine(object):
+    def __init__(self, connections=defaults.PORT_SCAN_LIMIT, per_host=defaults.PORT_SCAN_HOST_LIMIT,
+                 timeout=defaults.PORT_SCAN_TIMEOUT, min_timeout=defaults.PORT_SCAN_MIN_TIMEOUT,
+                 retries=defaults.PORT_SCAN_RETRIES):
+        fds = raise_fd_limit() - defaults.PORT_SCAN_FD_RESERVE
+        self.connections = max(min(connections, fds), 1)
+        self.per_host = per_host
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.retries = retries
+        self.limit = trio.CapacityLimiter(self.connections)
+        self.rtts = {}
+        self.connects = 0
+        self.counts = {'open': 0, 'closed': 0, 'filtered': 0}
+        self.started = None
+
+    def host_timeout(self, ip):
+        rtt = self.rtts.get(ip)
+        return rtt.timeout(self.timeout, self.min_timeout, self.timeout) if rtt else self.timeout
+
+    async def _connect(self, ip, port, timeout):
+        family = trio.socket.AF_INET6 if ':' in ip else trio.socket.AF_INET
+        while True:
+            try:
+                sock = trio.socket.socket(family, trio.socket.SOCK_STREAM)
+            except OSError as e:
+                if e.errno not in RESOURCE_ERRNOS:
+                    raise
+                # Out of descriptors, whatever else the process does needs them too; back off and retry
+                await trio.sleep(defaults.PORT_SCAN_BACKOFF)
+                continue
+
+            # Reset instead of FIN on close, nothing lingers in TIME_WAIT holding a local port
+            sock.setsockopt(trio.socket.SOL_SOCKET, trio.socket.SO_LINGER, LINGER_RESET)
+            started = time.monotonic()
+            self.connects += 1
+            exhausted = False
+            try:
+                with trio.move_on_after(timeout):
+                    try:
+                        await sock.connect((ip, port))
+                        return 'open', time.monotonic() - started
+                    except ConnectionRefusedError:
+                        return 'closed', time.monotonic() - started
+                    except OSError as e:
+                        if e.errno in FILTERED_ERRNOS:
+                            return 'filtered', None
+                        if e.errno not in RESOURCE_ERRNOS:
+                            raise
+                        exhausted = True
+                if not exhausted:
+                    return 'filtered', None
+            finally:
+                sock.close()
+            # Ran out of local ports, same as above
+            await trio.sleep(defaults.PORT_SCAN_BACKOFF)
+
+    async def check(self, ip, port):
+        status = 'filtered'
+        async with self.limit:
+            for attempt in range(self.retries + 1):
+                # A retry gets twice the time, in case the RTT estimate was too optimistic
+                timeout = min(self.host_timeout(ip) * 2 ** attempt, self.timeout)
+                status, rtt = await self._connect(ip, port, timeout)
+                if rtt is not None:
+                    self.rtts.setdefault(ip, RTTEstimator()).add(rtt)
+                if status != 'filtered':
+                    break
+
+        self.counts[status] += 1
+        return status
+
+    async def scan(self, ip, ports, results=None):
+        # Ports already in results are skipped, per_host caps how many connects one host sees at once
+        results = {} if results is None else results
+        if self.started is None:
+            self.started = time.monotonic()
+
+        async def check(port):
+            results[port] = await self.check(ip, port)
+
+        await run_worker_pool((port for port in ports if port not in results), check, self.per_host)
+        return results
+
+    async def ping(self, ip, ports=defaults.HOST_DISCOVERY_PORTS, timeout=defaults.HOST_DISCOVERY_TIMEOUT):
+        # Any answer, open or refused, means the host is up; the first one wins and seeds its RTT estimate
+        rtt = None
+        async with trio.open_nursery() as nursery:
+            async def probe(port):
+                nonlocal rtt
+                async with self.limit:
+                    _, answered = await self._connect(ip, port, timeout)
+                if answered is not None and rtt is None:
+                    rtt = answered
+                    self.rtts.setdefault(ip, RTTEstimator()).add(answered)
+                    nursery.cancel_scope.cancel()
+
+            for port in ports:
+                nursery.start_soon(probe, port)
+        return rtt
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return dict(self.counts, connects=self.connects, connections=self.connections,
+                    rate=round(self.connects / elapsed) if elapsed else 0)
+
+
+class HostDiscovery(object):
+    # Cheap liveness check before a full port sweep, so dead hosts don't eat len(ports) timeouts each
+
+    def __init__(self, engine, cache=None, ports=defaults.HOST_DISCOVERY_PORTS,
+                 timeout=defaults.HOST_DISCOVERY_TIMEOUT):
+        self.engine = engine
+        self.cache = cache
+        self.ports = ports
+        self.timeout = timeout
+        self.results = {}
+        self.pending = {}
+        self.counts = {'alive': 0, 'dead': 0}
+
+    async def is_alive(self, ip):
+        if ip in self.results:
+            return self.results[ip]
+        if self.cache is not None:
+            entry = self.cache.get(ip)
+            if entry is not None:
+                alive, rtt, _ = entry
+                if rtt is not None:
+                    self.engine.rtts.setdefault(ip, RTTEstimator()).add(rtt)
+                self.results[ip] = alive
+                return alive
+
+        # Several domains can resolve to the same IP at the same time, only one of them probes it
+        event = self.pending.get(ip)
+        if event is not None:
+            await event.wait()
+            # When the probe itself failed, rather scan than lose the host
+            return self.results.get(ip, True)
+
+        self.pending[ip] = trio.Event()
+        try:
+            rtt = await self.engine.ping(ip, self.ports, self.timeout)
+            alive = self.results[ip] = rtt is not None
+            self.counts['alive' if alive else 'dead'] += 1
+            if self.cache is not None:
+                self.cache.put(ip, alive, rtt)
+            return alive
+        finally:
+            self.pending.pop(ip).set()
+
+    def stats(self):
+        return dict(self.counts, cache=self.cache.stats() if self.cache is not None else None)
+
+
+async def scan_hosts(engine, ips, ports, on_scanned=None, discovery=None):
+    # Enough hosts at once to keep every connection busy even when each host gets its own cap
+    async def scan(ip):
+        if discovery is not None and not await discovery.is_alive(ip):
+            return
+        results = await engine.scan(ip, ports)
+        if on_scanned is not None:
+            await on_scanned(ip, results)
+
+    hosts = max(engine.connections // max(min(engine.per_host, len(ports)), 1), 1)
+    await run_worker_pool(ips, scan, hosts)
@@ -1,17 +1,15 @@
 import asks
 import random
+import urllib.parse as urlparse
 
-import dns
-import trio
-from dns import asyncresolver
-from dns import resolver
-from dns import name
+import dns.exception
 
 import defaults
 from utils import success
 
 
-async def fetch_url(url, results, limit, valid_status_codes, pbar=None):
+async def fetch_url(url, session, results, valid_status_codes, pbar=None,
+                    method=defaults.HTTP_PROBE_METHOD, baseline=None, on_found=None):
     params = dict(
         follow_redirects=False,
         timeout=defaults.DEFAULT_TIMEOUT,
@@ -19,71 +17,41 @@ async def fetch_url(url, results, limit, valid_status_codes, pbar=None):
         headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
     )
 
+    path = urlparse.urlparse(url).path
     try:
-        async with limit:
-            response = await asks.get(url, **params)
-        if response.status_code in valid_status_codes:
+        response = await session.probe(url, method=method, valid_status_codes=valid_status_codes, **params)
+        if response.method == 'HEAD' and response.status_code in valid_status_codes \
+                and baseline and baseline.matches(response, path):
+            # A length alone can't tell a page from a soft-404 of about the same size, its body can
+            response = await session.probe(url, method='GET', **params)
+        if results is not None and response.status_code in valid_status_codes \
+                and not (baseline and baseline.matches(response, path)):
             results.append((url, response.status_code))
-            print(f"[+] Found: {url} - {response.status_code}")
+            print(f"[+] Found: {url} - {response.status_code} ({response.length} bytes)")
+            if on_found is not None:
+                await on_found(url, response)
         return response
-    except (OSError, asks.errors.RequestTimeout) as e:
+    except (OSError, asks.errors.RequestTimeout, asks.errors.BadHttpResponse):
         return None
     finally:
         if pbar:
             pbar.update()
 
 
-async def check_port(ip_addr, port, results, limit):
-    return_value = 'closed'
-    async with limit:
-        with trio.move_on_after(defaults.PORT_SCAN_TIMEOUT):
-            conn = trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_STREAM)
-            try:
-                await conn.connect((ip_addr, port))
-                return_value = 'open'
-            except Exception as e:
-                print("check_port:", e)
-            finally:
-                conn.close()
-
-    if results is not None:
-        if ip_addr not in results:
-            results[ip_addr] = {}
-        results[ip_addr][port] = return_value
-    return return_value
-
-
-async def query_dns(domain, nameservers, results, limit, pbar=None):
-    random.shuffle(nameservers)
-    response = None
-    for ns in nameservers[:5] + ['8.8.8.8']:
-        async with limit:
-            try:
-                asyncresolver.nameservers = [ns]
-                asyncresolver.timeout = 5
-                asyncresolver.lifetime = 5
-
-                response = None
-                with trio.move_on_after(5):
-                    response = await asyncresolver.resolve(domain, 'A')
-
-                if response:
-                    success(f"Found: {domain}")
-                    if results is not None:
-                        results.append((domain, [ip.to_text() for ip in response]))
-                    break
-            except resolver.NXDOMAIN:
-                break
-            except (resolver.NoAnswer, name.EmptyLabel, resolver.NoNameservers) as e:
-                # warning(f"Exception for {domain}: {e}, {type(e)}")
-                continue
-            except dns.exception.Timeout:
-                # warning(f"DNS Timeout for domain={domain}, nameserver={ns}")
-                # await trio.sleep(1)
-                pass
-
-    if pbar:
-        pbar.update()
-    return response
-
-
+async def query_dns(domain, engine, results, pbar=None, rdtype='A', wildcards=None):
+    answer = None
+    try:
+        answer = await engine.resolve(domain, rdtype)
+        if wildcards is not None and await wildcards.is_wildcard(domain, answer):
+            return None
+        if answer.addresses:
+            success(f"Found: {domain}")
+            if results is not None:
+                results.append((domain, answer.addresses))
+    except dns.exception.DNSException:
+        # Names that can't be encoded (empty labels, labels too long, ...)
+        pass
+    finally:
+        if pbar:
+            pbar.update()
+    return answer
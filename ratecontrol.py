@@ -0,0 +1,138 @@
+import email.utils
+import time
+
+import trio
+
+import defaults
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        seconds = int(value)
+    else:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), defaults.HTTP_MAX_RETRY_AFTER)
+
+
+class AdaptiveLimiter(object):
+    # Additive increase / multiplicative decrease of the number of requests in flight to one host
+
+    def __init__(self, initial=defaults.HTTP_INITIAL_WINDOW, minimum=1, maximum=defaults.HTTP_CONNECTIONS_PER_HOST):
+        self.window = float(min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.successes = 0
+        self.congestions = 0
+        self._lot = trio.lowlevel.ParkingLot()
+
+    @property
+    def available(self):
+        return int(self.window) - self.in_flight
+
+    async def acquire(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await trio.sleep(delay)
+                continue
+            if self.available > 0:
+                break
+            await self._lot.park()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        if self.available > 0 and self._lot:
+            self._lot.unpark(count=self.available)
+
+    def on_success(self):
+        self.successes += 1
+        self.window = min(self.window + 1 / self.window, self.maximum)
+        self._wake()
+
+    def on_congestion(self, retry_after=None):
+        self.congestions += 1
+        now = time.monotonic()
+        # Requests that were already in flight fail together, count them as one congestion event
+        if now - self.last_decrease >= defaults.HTTP_DECREASE_INTERVAL:
+            self.window = max(self.window / 2, self.minimum)
+            self.last_decrease = now
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        self.release()
+
+    def stats(self):
+        return {
+            'window': round(self.window, 2),
+            'in_flight': self.in_flight,
+            'successes': self.successes,
+            'congestions': self.congestions,
+        }
+
+
+class HostRateController(object):
+    def __init__(self, initial=defaults.HTTP_INITIAL_WINDOW, maximum=defaults.HTTP_CONNECTIONS_PER_HOST):
+        self.initial = initial
+        self.maximum = maximum
+        self.limiters = {}
+
+    def limiter(self, host):
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = AdaptiveLimiter(self.initial, maximum=self.maximum)
+        return limiter
+
+    def stats(self):
+        return {host: limiter.stats() for host, limiter in self.limiters.items()}
+
+
+class TokenBucket(object):
+    # `rate` requests a second on average, `burst` of them back to back after a quiet spell. Waiters are served
+    # in order, so a slow source is paced instead of hammered and then blocked.
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waits = 0
+        self._lock = trio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                self.waits += 1
+                await trio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        pass
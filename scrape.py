@@ -11,18 +11,29 @@ import parse
 import random
 
 import defaults
+from httpclient import HttpClient
+from ratecontrol import TokenBucket
 import sortedcontainers
 import urllib.parse as urlparse
 from utils import success, warning
 
+# One bucket per source for the whole process, every domain being scraped shares the source's rate limit
+_rate_limits = {}
+
 
 class DomainScraper(object):
     SOURCE = None
+    # Requests per second and burst allowed against the source, and how long one request to it may take
+    RATE = defaults.SCRAPER_RATE
+    BURST = defaults.SCRAPER_BURST
+    TIMEOUT = defaults.SCRAPER_TIMEOUT
 
-    def __init__(self, domain, **kwargs):
+    def __init__(self, domain, session=None, **kwargs):
         self.domain = domain.lower()
+        self.session = session if session is not None else HttpClient(verify=True)
         self.kwargs = kwargs
         self.subdomains = sortedcontainers.SortedList([])
+        self.on_found = None
 
     def __add__(self, domain):
         if isinstance(domain, list):
@@ -45,8 +56,48 @@ class DomainScraper(object):
     def __iter__(self):
         return iter(self.subdomains)
 
-    async def run(self, results):
-        raise NotImplementedError("Implement run method")
+    @classmethod
+    def rate_limit(cls):
+        bucket = _rate_limits.get(cls.SOURCE)
+        if bucket is None:
+            bucket = _rate_limits[cls.SOURCE] = TokenBucket(cls.RATE, cls.BURST)
+        return bucket
+
+    async def fetch(self, url, **kwargs):
+        params = dict(
+            follow_redirects=True,
+            retries=defaults.DEFAULT_RETRIES,
+            headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
+        )
+        params.update(kwargs)
+        # Waiting for the rate limit doesn't count against the timeout, only the source being slow does
+        await self.rate_limit().acquire()
+        with trio.fail_after(self.TIMEOUT):
+            return await self.session.get(url, **params)
+
+    async def found(self, domains):
+        # Reported as each page comes in, not once the whole source is done
+        new = [domain.lower().strip() for domain in domains if self + domain]
+        if new and self.on_found is not None:
+            await self.on_found(self.SOURCE, new)
+
+    async def scrape(self):
+        raise NotImplementedError("Implement scrape method")
+
+    async def run(self, results=None, on_found=None):
+        # A source that hangs or breaks only costs its own results, and those found before it did are kept
+        self.on_found = on_found
+        try:
+            await self.scrape()
+        except trio.TooSlowError:
+            warning(f"{self.SOURCE} timed out for {self.domain} after {self.TIMEOUT}s")
+        except Exception as e:
+            warning(f"{self.SOURCE} failed for {self.domain}: {e!r}")
+
+        if results is not None:
+            self.report_results(results)
+        self.print_table()
+        return {'source': self.SOURCE, 'results': list(self)}
 
     def report_results(self, results):
         for domain in self.subdomains:
@@ -66,15 +117,11 @@ class DomainScraper(object):
 
 class CrtShScraper(DomainScraper):
     SOURCE = 'crt.sh'
+    # Slow to answer for big domains
+    TIMEOUT = 120
 
-    async def run(self, results):
-        API_URL = f'https://crt.sh/?q=%25.{self.domain}'
-        params = dict(
-            follow_redirects=True,
-            retries=defaults.DEFAULT_RETRIES,
-            headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
-        )
-        response = await asks.get(API_URL, **params)
+    async def scrape(self):
+        response = await self.fetch(f'https://crt.sh/?q=%25.{self.domain}')
 
         matches = parse.findall("<TD>{domain}</TD>", str(response.content))
         for item in matches:
@@ -82,19 +129,14 @@ class CrtShScraper(DomainScraper):
                 continue
 
             domains = item['domain'].split('<BR>')
-            domains = [d for d in domains if d.endswith(self.domain)
-                       and '*' not in d and '@' not in d]
-            self + domains
-
-        self.report_results(results)
-        self.print_table()
-
-        return_ = {'source': self.SOURCE, 'results': list(self)}
-        return return_
+            await self.found([d for d in domains if d.endswith(self.domain) and '*' not in d and '@' not in d])
 
 
 class NetcraftScraper(DomainScraper):
     SOURCE = 'searchdns.netcraft.com'
+    # Each page links to the next, so pages can't be fetched at once; this keeps them about a second apart
+    RATE = 1
+    BURST = 1
 
     @staticmethod
     def solve_js_challenge(response):
@@ -117,145 +159,82 @@ class NetcraftScraper(DomainScraper):
             return None
         return 'http://searchdns.netcraft.com' + urls[0]
 
-    async def run(self, results):
+    async def scrape(self):
         API_URL = f'https://searchdns.netcraft.com/' \
             f'?restriction=site+ends+with&host={self.domain}&position=limited'
 
-        params = dict(
-            follow_redirects=True,
-            retries=defaults.DEFAULT_RETRIES,
-            headers={'User-Agent': random.choice(defaults.USER_AGENTS)},
-        )
-
-        response = await asks.get('https://searchdns.netcraft.com/', **params)
+        response = await self.fetch('https://searchdns.netcraft.com/')
         cookies = self.solve_js_challenge(response=response)
-        params['cookies'] = cookies
 
-        while True:
-            response = await asks.get(API_URL, **params)
+        while API_URL:
+            response = await self.fetch(API_URL, cookies=cookies)
 
             soup = BeautifulSoup(response.content.decode('utf-8'), features='html.parser')
             urls = soup.find_all('a', {'class': 'results-table__host'})
-            for url in urls:
-                if not url['href']:
-                    continue
-                domain = urlparse.urlparse(url['href']).netloc
-                self + domain
+            await self.found([urlparse.urlparse(url['href']).netloc for url in urls if url.get('href')])
 
             API_URL = self.get_next_page_url(response)
-
-            if not API_URL:
-                break
-
-            cookies = self.solve_js_challenge(response=response)
-            if cookies:
-                params['cookies'] = cookies
-
-            await trio.sleep(1)
-
-        self.report_results(results)
-        self.print_table()
-
-        return_ = {'source': self.SOURCE, 'results': list(self)}
-        return return_
+            cookies = self.solve_js_challenge(response=response) or cookies
 
 
 class SublisterAPIScraper(DomainScraper):
     SOURCE = 'api.sublist3r.com'
 
-    async def run(self, results):
-        API_URL = f'https://api.sublist3r.com/search.php?domain={self.domain}'
-        params = dict(
-            follow_redirects=True,
-            retries=defaults.DEFAULT_RETRIES,
-            headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
-        )
-        response = await asks.get(API_URL, **params)
-        self + json.loads(response.content)
-
-        self.report_results(results)
-        self.print_table()
-
-        return_ = {'source': 'api.sublist3r.com', 'results': list(self)}
-        return return_
+    async def scrape(self):
+        response = await self.fetch(f'https://api.sublist3r.com/search.php?domain={self.domain}')
+        await self.found(json.loads(response.content) or [])
 
 
 class ThreatCrowdScraper(DomainScraper):
     SOURCE = 'threatcrowd.org'
+    # Documented limit: one request every ten seconds
+    RATE = 0.1
+    BURST = 1
 
-    async def run(self, results):
-        API_URL = f'https://www.threatcrowd.org/searchApi/v2/domain/report/?domain={self.domain}'
-        params = dict(
-            follow_redirects=True,
-            retries=defaults.DEFAULT_RETRIES,
-            headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
-        )
-        response = await asks.get(API_URL, **params)
+    async def scrape(self):
+        response = await self.fetch(f'https://www.threatcrowd.org/searchApi/v2/domain/report/?domain={self.domain}')
         try:
             found_domains = json.loads(response.content)['subdomains']
         except KeyError:
             warning(f"ThreatCrowd didn't include any subdomains for {self.domain}")
             found_domains = []
 
-        found_domains = [d for d in found_domains if d.endswith(self.domain)]
-        self + found_domains
-
-        self.report_results(results)
-        self.print_table()
-
-        return_ = {'source': 'threatcrowd.org', 'results': self.subdomains}
-        return return_
+        await self.found([d for d in found_domains if d.endswith(self.domain)])
 
 
 class VirusTotalScraper(DomainScraper):
     SOURCE = 'www.virustotal.com'
+    # Pages come with an opaque cursor to the next one, so the largest page size is what cuts round trips
+    PAGE_SIZE = 40
 
-    async def run(self, results):
-        API_URL = f'https://www.virustotal.com/ui/domains/{self.domain}/subdomains'
-        params = dict(
-            follow_redirects=True,
-            retries=defaults.DEFAULT_RETRIES,
-            headers={'User-Agent': random.choice(defaults.USER_AGENTS)}
-        )
+    async def scrape(self):
+        API_URL = f'https://www.virustotal.com/ui/domains/{self.domain}/subdomains?limit={self.PAGE_SIZE}'
 
-        while True:
-            response = await asks.get(API_URL, **params)
+        while API_URL:
+            response = await self.fetch(API_URL)
             payload = json.loads(response.content)
             if 'error' in payload:
                 break
 
-            for item in payload['data']:
-                if item['type'] != 'domain':
-                    continue
-
-                domain = item['id']
-                if not domain.endswith(self.domain) or domain == self.domain:
-                    continue
-
-                self + domain
-
-            if 'links' in payload and 'next' in payload['links']:
-                API_URL = payload['links']['next']
-            else:
-                break
-
-        self.report_results(results)
-        self.print_table()
+            await self.found([item['id'] for item in payload['data'] if item['type'] == 'domain' and
+                              item['id'].endswith('.' + self.domain)])
+            API_URL = payload.get('links', {}).get('next')
 
-        return {'source': self.SOURCE, 'results': list(self)}
 
+async def scrape_subdomains(domain, scrapers, session=None, on_found=None):
+    if session is None:
+        session = HttpClient(verify=True)
 
-async def scrape_subdomains(domain, scrapers):
     results = {}
     async with trio.open_nursery() as nursery:
         for ScraperClass in scrapers:
-            scraper = ScraperClass(domain)
-            nursery.start_soon(scraper.run, results)
+            scraper = ScraperClass(domain, session=session)
+            nursery.start_soon(scraper.run, results, on_found)
 
     return results
 
 
-async def scrape_website_for_domains(address, results):
+async def scrape_website_for_domains(address, results, session):
     params = dict(
         follow_redirects=True,
         retries=defaults.DEFAULT_RETRIES,
@@ -268,7 +247,7 @@ async def scrape_website_for_domains(address, results):
 
     try:
         with trio.move_on_after(5):
-            response = await asks.get(WEBSITE_URL, **params)
+            response = await session.get(WEBSITE_URL, **params)
 
             soup = BeautifulSoup(response.content.decode('utf-8'), features='html.parser')
 
@@ -280,15 +259,18 @@ async def scrape_website_for_domains(address, results):
                 if domain and domain.endswith(BASE_DOMAIN) and domain not in results:
                     success(f"Found {domain} in '{WEBSITE_URL}'")
                     results[domain] = WEBSITE_URL
-    except (OSError, asks.errors.RequestTimeout):
+    except (OSError, asks.errors.RequestTimeout, asks.errors.BadHttpResponse):
         pass
 
 
-async def scrape_websites(addresses):
+async def scrape_websites(addresses, session=None):
+    if session is None:
+        session = HttpClient()
+
     results = {}
     async with trio.open_nursery() as nursery:
         for addr in addresses:
-            nursery.start_soon(scrape_website_for_domains, addr, results)
+            nursery.start_soon(scrape_website_for_domains, addr, results, session)
     return results
 
 
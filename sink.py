@@ -0,0 +1,86 @@
+import json
+
+from store import EntityStore
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def make_record(entity_type, value, data, parent=None):
+    return {
+        'type': entity_type,
+        'value': value,
+        'parent': parent,
+        'data': dict(data),
+    }
+
+
+class RecordSink(object):
+    def on_change(self, record, parent):
+        self.write(make_record(record.type, record.value, record.data, parent.value if parent is not None else None))
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NDJSONSink(RecordSink):
+    def __init__(self, path):
+        # Line buffered, so whatever tails the file sees each record as soon as it's found
+        self.handle = open(path, 'w', buffering=1)
+
+    def write(self, record):
+        self.handle.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        self.handle.close()
+
+
+class MsgpackSink(RecordSink):
+    def __init__(self, path):
+        self.handle = open(path, 'wb')
+        self.packer = msgpack.Packer(default=str)
+
+    def write(self, record):
+        self.handle.write(self.packer.pack(record))
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+
+SINKS = {
+    'ndjson': NDJSONSink,
+    'msgpack': MsgpackSink,
+}
+
+
+def open_sink(path, output_format):
+    if output_format == 'msgpack' and msgpack is None:
+        raise RuntimeError("msgpack output needs the msgpack package, pip install msgpack")
+    return SINKS[output_format](path)
+
+
+def read_records(path, input_format='ndjson'):
+    if input_format == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError("msgpack input needs the msgpack package, pip install msgpack")
+        with open(path, 'rb') as handle:
+            yield from msgpack.Unpacker(handle, raw=False)
+    else:
+        with open(path, 'r') as handle:
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def fold_records(records):
+    # Replays the stream into an entity store, records may repeat (resumed runs) and are merged
+    store = EntityStore()
+    for record in records:
+        store.add(record['type'], record['value'], record['data'], record.get('parent'))
+    return store.to_dict()
@@ -0,0 +1,165 @@
+# What an entity of each type hangs off, and where it shows up in the nested document
+PARENT_TYPES = {
+    'domain': 'domain',
+    'ip_address': 'domain',
+    'tcp_port': 'ip_address',
+    'http': 'domain',
+    'path': 'domain',
+}
+CONTAINERS = {
+    'domain': 'subdomains',
+    'ip_address': 'ip_addresses',
+    'tcp_port': 'ports',
+    'http': 'web',
+    'path': 'paths',
+}
+# Only unique within their parent, the same port or path means something else on another host
+SCOPED_TYPES = ('tcp_port', 'path')
+
+
+def merge(data, fields):
+    changed = False
+    for key, value in fields.items():
+        if isinstance(value, list) and isinstance(data.get(key), list):
+            new = [item for item in value if item not in data[key]]
+            data[key].extend(new)
+            changed = changed or bool(new)
+        elif data.get(key, merge) != value:
+            data[key] = value
+            changed = True
+    return changed
+
+
+class Record(object):
+    __slots__ = ('type', 'value', 'data', 'key')
+
+    def __init__(self, type, value, data, key):
+        self.type = type
+        self.value = value
+        self.data = data
+        self.key = key
+
+    def __repr__(self):
+        return f"Record({self.type!r}, {self.value!r})"
+
+
+class EntityStore(object):
+    # Every domain, IP, port and URL is stored once, nesting is kept as edges between them
+
+    def __init__(self):
+        self.records = {}
+        self.by_type = {}
+        self.children = {}
+        self.parents = {}
+        # Records added without a parent, base domains given by the user rather than found
+        self.root_records = {}
+        # Called with (record, parent) whenever a record is added, linked to another parent or changes
+        self.listeners = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['listeners'] = []
+        return state
+
+    @staticmethod
+    def key(type, value, parent=None):
+        if type in SCOPED_TYPES:
+            return type, parent, value
+        return type, value
+
+    def get(self, type, value, parent=None):
+        return self.records.get(self.key(type, value, parent))
+
+    def add(self, type, value, data=None, parent=None):
+        # parent is a Record, or the value of one of PARENT_TYPES[type], created if it isn't known yet
+        if parent is not None and not isinstance(parent, Record):
+            parent = self.get(PARENT_TYPES[type], parent) or self.add(PARENT_TYPES[type], parent)[0]
+
+        key = self.key(type, value, parent.value if parent is not None else None)
+        record = self.records.get(key)
+        created = record is None
+        changed = created
+        if created:
+            record = self.records[key] = Record(type, value, dict(data or {}), key)
+            self.by_type.setdefault(type, {})[key] = record
+        elif data:
+            changed = merge(record.data, data)
+
+        if parent is not None:
+            changed = self.link(parent, record) or changed
+        elif key not in self.root_records.setdefault(type, {}):
+            self.root_records[type][key] = record
+            changed = True
+
+        if changed:
+            self.notify(record, parent)
+        return record, created
+
+    def update(self, record, fields):
+        if merge(record.data, fields):
+            # Any parent will do, listeners only need to be able to place the record
+            parent = next(self.iter_parents(record), None)
+            self.notify(record, parent)
+
+    def notify(self, record, parent):
+        for listener in self.listeners:
+            listener(record, parent)
+
+    def link(self, parent, child):
+        if parent.key == child.key or child.key in self.children.get(parent.key, ()):
+            return False
+        self.children.setdefault(parent.key, {})[child.key] = child
+        self.parents.setdefault(child.key, {})[parent.key] = parent
+        return True
+
+    def iter_edges(self):
+        # Everything in the store as (record, parent) pairs, enough to rebuild it with add(). Every record comes
+        # with the parent it was found under first, so replaying never sees a parent before it was added itself.
+        for record in self.records.values():
+            yield record, None if self.is_root(record) else next(self.iter_parents(record), None)
+        for record in self.records.values():
+            parents = list(self.iter_parents(record))
+            for parent in parents if self.is_root(record) else parents[1:]:
+                yield record, parent
+
+    def iter(self, type):
+        return iter(self.by_type.get(type, {}).values())
+
+    def iter_children(self, record, type=None):
+        for child in self.children.get(record.key, {}).values():
+            if type is None or child.type == type:
+                yield child
+
+    def iter_parents(self, record, type=None):
+        for parent in self.parents.get(record.key, {}).values():
+            if type is None or parent.type == type:
+                yield parent
+
+    def roots(self, type='domain'):
+        return iter(self.root_records.get(type, {}).values())
+
+    def is_root(self, record):
+        return record.key in self.root_records.get(record.type, {})
+
+    def count(self, type=None):
+        if type is None:
+            return len(self.records)
+        return len(self.by_type.get(type, ()))
+
+    def view(self, record, _path=()):
+        view = dict(record.data)
+        _path += (record.key, )
+        for child in self.iter_children(record):
+            if child.key in _path:
+                continue
+            container = view.setdefault(CONTAINERS[child.type], {})
+            if child.type == 'http':
+                key = 'https' if child.value.startswith('https://') else 'http'
+            else:
+                key = child.value
+            container[key] = self.view(child, _path)
+        return view
+
+    def to_dict(self):
+        # The nested document investigate has always written, IPs shared by domains are repeated under each
+        return {'domains': {record.value: self.view(record) for record in self.roots('domain')}}
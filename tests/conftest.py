@@ -0,0 +1,68 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, head):
+        self.server.requests.append((self.command, self.path))
+        self.server.clients.add(self.client_address)
+        status, headers, body = self.server.respond(self)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        chunked = headers.get('Transfer-Encoding') == 'chunked'
+        if not chunked and 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if head:
+            return
+        if not isinstance(body, bytes):
+            # A body sent piece by piece, Content-Length is up to the caller
+            for chunk in body:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        elif chunked:
+            self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body) if body else b'0\r\n\r\n')
+        else:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(False)
+
+    def do_HEAD(self):
+        self.reply(True)
+
+
+@pytest.fixture
+def http_server():
+    # start(respond) serves respond(request) -> (status, headers, body) locally and returns the server, its
+    # base URL is server.url, every (method, path) it saw is in server.requests and every connection that sent one
+    # in server.clients
+    servers = []
+
+    def start(respond):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        server.respond = respond
+        server.requests = []
+        server.clients = set()
+        server.url = f"http://127.0.0.1:{server.server_address[1]}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,43 @@
+import os
+import ssl
+
+import trio
+
+from pipeline.domain import SubdomainCertificateTransformer
+from pipeline.runner import Entity
+from store import EntityStore
+from tlscert import parse_certificate
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'certificate.pem')) as handle:
+    DER = ssl.PEM_cert_to_DER_cert(handle.read())
+
+
+def harvest(entity, store):
+    stage = SubdomainCertificateTransformer(store, config={'options': {}})
+    stage.setup()
+    emitted = []
+
+    async def emit(found):
+        emitted.append((found.value, found.parent))
+
+    trio.run(stage.process, entity, emit)
+    return sorted(emitted)
+
+
+def test_certificates_of_tls_ports_name_subdomains():
+    # Already seen by the banner grabber, so nothing connects anywhere
+    store = EntityStore()
+    store.add('domain', 'localhost')
+    store.add('domain', 'app.localhost', {}, 'localhost')
+    store.add('ip_address', '127.0.0.1', {}, 'app.localhost')
+    port, _ = store.add('tcp_port', 443, {'tls': parse_certificate(DER)}, '127.0.0.1')
+    assert harvest(Entity('tcp_port', 443, port.data, '127.0.0.1'), store) == \
+        [('dev.localhost', 'localhost'), ('www.localhost', 'localhost')]
+
+
+def test_certificates_of_https_urls_name_subdomains():
+    store = EntityStore()
+    store.add('domain', 'localhost')
+    record, _ = store.add('http', 'https://localhost', {'tls': parse_certificate(DER)}, 'localhost')
+    assert harvest(Entity('http', 'https://localhost', record.data, 'localhost'), store) == \
+        [('dev.localhost', 'localhost'), ('www.localhost', 'localhost')]
@@ -0,0 +1,84 @@
+import time
+
+import trio
+
+from checkpoint import Checkpoint
+from pipeline.base import BaseTransformer
+from pipeline.runner import Entity, run_pipeline
+from store import EntityStore
+
+
+class PortFinder(BaseTransformer):
+    # Stands in for resolving and scanning: every domain gets an IP with port 443 open
+    CONSUMES = ('domain', )
+    processed = []
+
+    async def process(self, entity, emit):
+        PortFinder.processed.append(entity.value)
+        record, _ = self.store.add('ip_address', '192.0.2.1', {'type': 'ip_address', 'value': '192.0.2.1'},
+                                   entity.value)
+        port, created = self.store.add('tcp_port', 443, {'type': 'tcp_port', 'value': 443}, '192.0.2.1')
+        if created:
+            await emit(Entity('tcp_port', 443, port.data, '192.0.2.1'))
+
+
+def investigate(path, stages, max_age=None):
+    checkpoint = Checkpoint(str(path), max_age=max_age)
+    store = checkpoint.store or EntityStore()
+    config = {'options': {}, 'checkpoint': checkpoint}
+    stages = [T(store, config) for T in stages]
+    return trio.run(run_pipeline, store, stages, ['example.com'], None, checkpoint), stages
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = tmp_path / 'run.pickle'
+    checkpoint = Checkpoint(str(path))
+    checkpoint.store = EntityStore()
+    checkpoint.store.add('domain', 'example.com')
+    entity = Entity('domain', 'example.com', {})
+    checkpoint.mark_done('PortFinder', entity)
+    checkpoint.stage_progress('PortFinder')['offset'] = 10
+    checkpoint.save()
+
+    resumed = Checkpoint(str(path))
+    assert resumed.store.get('domain', 'example.com') is not None
+    assert resumed.is_done('PortFinder', entity)
+    assert not resumed.is_done('Other', entity)
+    assert resumed.stage_progress('PortFinder') == {'offset': 10}
+
+    resumed.done['PortFinder'][Checkpoint.key(entity)] = time.time() - 7200
+    resumed.max_age = 3600
+    assert not resumed.is_done('PortFinder', entity)
+
+
+def test_unreadable_checkpoint_starts_over(tmp_path):
+    path = tmp_path / 'run.pickle'
+    path.write_bytes(b'not a pickle')
+    assert Checkpoint(str(path)).store is None
+
+
+def test_resumed_runs_skip_what_is_done(tmp_path):
+    PortFinder.processed = []
+    path = tmp_path / 'run.pickle'
+    investigate(path, [PortFinder])
+    store, _ = investigate(path, [PortFinder])
+    assert PortFinder.processed == ['example.com']
+    assert store.get('tcp_port', 443, '192.0.2.1') is not None
+
+
+class PortWatcher(BaseTransformer):
+    # Stands in for the banner grabber, a stage added when the run is resumed
+    CONSUMES = ('tcp_port', )
+    seen = []
+
+    async def process(self, entity, emit):
+        PortWatcher.seen.append((entity.value, entity.parent))
+
+
+def test_resumed_runs_hand_stored_ports_to_new_stages(tmp_path):
+    PortFinder.processed, PortWatcher.seen = [], []
+    path = tmp_path / 'run.pickle'
+    investigate(path, [PortFinder])
+    investigate(path, [PortFinder, PortWatcher])
+    assert PortFinder.processed == ['example.com']
+    assert PortWatcher.seen == [(443, '192.0.2.1')]
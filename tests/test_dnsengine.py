@@ -0,0 +1,54 @@
+import trio
+
+from dnsengine import DNSAnswer, WildcardFilter
+
+
+class WildcardEngine(object):
+    # *.example.com answers 192.0.2.1; the first query fails when told to, like a timed out resolver
+    def __init__(self, fail_first=False):
+        self.queries = 0
+        self.fail_first = fail_first
+
+    async def resolve(self, name, rdtype='A'):
+        self.queries += 1
+        await trio.sleep(0.01)
+        if self.fail_first and self.queries == 1:
+            raise OSError("resolver went away")
+        addresses = ['192.0.2.1'] if name.endswith('.example.com') else []
+        return DNSAnswer(name, rdtype, addresses=addresses)
+
+
+def test_wildcard_answers_are_filtered():
+    wildcards = WildcardFilter(WildcardEngine(), probes=2)
+
+    async def run():
+        return [await wildcards.is_wildcard('random.example.com', DNSAnswer('random.example.com', 'A',
+                                                                            addresses=['192.0.2.1'])),
+                await wildcards.is_wildcard('www.example.com', DNSAnswer('www.example.com', 'A',
+                                                                         addresses=['198.51.100.7'])),
+                await wildcards.is_wildcard('www.example.org', DNSAnswer('www.example.org', 'A',
+                                                                         addresses=['198.51.100.7']))]
+
+    assert trio.run(run) == [True, False, False]
+
+
+def test_waiters_take_over_when_the_probe_fails():
+    engine = WildcardEngine(fail_first=True)
+    wildcards = WildcardFilter(engine, probes=1)
+    results = []
+
+    async def lookup():
+        try:
+            results.append(await wildcards.wildcard_answers('example.com'))
+        except OSError:
+            results.append('failed')
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            for _ in range(3):
+                nursery.start_soon(lookup)
+
+    trio.run(run)
+    assert results.count('failed') == 1
+    assert results.count(frozenset({'192.0.2.1'})) == 2
+    assert engine.queries == 2
@@ -0,0 +1,67 @@
+import trio
+
+from bruteforce import bruteforce_urls
+from fingerprint import ResponseFingerprint, hamming, normalize_location, simhash
+from httpclient import HttpClient, ProbeResponse
+from utils import append_path
+
+SOFT_404 = b'<html><head><title>Not found</title></head><body><p>Sorry, %s could not be found.</p>' + \
+           b'<p>' + b'The page you are looking for is gone or never existed. ' * 6 + b'</p></body></html>'
+REAL_PAGE = b'<html><head><title>%s</title></head><body><form>' + \
+            b'<input name="user"><input name="password" type="password">' * 6 + b'</form></body></html>'
+
+
+def response(body, status_code=200, headers=None, method='GET'):
+    return ProbeResponse('http://example.com/', method, status_code, headers or {}, body)
+
+
+def test_simhash_is_close_for_similar_pages():
+    a = simhash(SOFT_404 % b'/a8f3k2')
+    b = simhash(SOFT_404 % b'/admin')
+    c = simhash(REAL_PAGE % b'Admin')
+    assert hamming(a, b) < hamming(a, c)
+
+
+def test_echoed_path_is_replaced_as_a_whole():
+    body = b'<a href="/app.js">x</a> page /a missing'
+    fingerprint = ResponseFingerprint(response(body), '/a')
+    other = ResponseFingerprint(response(body.replace(b'/a missing', b'/b missing')), '/b')
+    assert fingerprint.simhash == other.simhash
+    assert fingerprint.length == other.length
+
+
+def test_location_is_normalized():
+    assert normalize_location('http://example.com/admin/?x=1', '/admin') == 'http://example.com{path}/'
+    assert normalize_location('/login?next=/admin', '/admin') == '/login'
+
+
+def test_similar_needs_the_same_status_and_location():
+    soft = ResponseFingerprint(response(SOFT_404 % b'/x', 302, {'location': '/x/'}), '/x')
+    assert soft.similar(ResponseFingerprint(response(SOFT_404 % b'/y', 302, {'location': '/y/'}), '/y'))
+    assert not soft.similar(ResponseFingerprint(response(SOFT_404 % b'/y', 302, {'location': '/'}), '/y'))
+    assert not soft.similar(ResponseFingerprint(response(SOFT_404 % b'/y', 200), '/y'))
+
+
+def bruteforce(server, tmp_path, words, method):
+    wordlist = tmp_path / 'words.txt'
+    wordlist.write_text('\n'.join(words) + '\n')
+
+    async def run():
+        async with HttpClient() as session:
+            return await bruteforce_urls(server.url, str(wordlist), append_path, session=session, method=method)
+
+    return sorted(url for url, _ in trio.run(run))
+
+
+def test_head_hits_the_size_of_a_soft_404_are_confirmed_with_get(http_server, tmp_path):
+    pages = {'/admin': REAL_PAGE % b'Admin', '/login': REAL_PAGE % b'Login'}
+
+    def respond(request):
+        return 200, {}, pages.get(request.path, SOFT_404 % request.path.encode())
+
+    server = http_server(respond)
+    assert abs(len(pages['/admin']) - len(SOFT_404 % b'/admin')) < 2 * 256
+    words = ['admin', 'login', 'backup', 'e', 'a']
+    expected = [f"{server.url}/admin", f"{server.url}/login"]
+    assert bruteforce(server, tmp_path, words, 'HEAD') == expected
+    assert bruteforce(server, tmp_path, words, 'GET') == expected
@@ -0,0 +1,34 @@
+from geoip import GeoIPLookup, parse_ip
+from pipeline.ip import GeoIPTransformer
+from store import EntityStore
+
+
+def test_parse_ip():
+    assert parse_ip('192.0.2.1') == (4, 0xc0000201)
+    assert parse_ip('2001:db8::1') == (6, 0x20010db8000000000000000000000001)
+
+
+def test_missing_databases_leave_the_fields_empty(tmp_path):
+    payload = GeoIPLookup(str(tmp_path)).lookup('192.0.2.1')
+    assert payload['type'] == 'geoip_data'
+    assert payload['asn'] is None and payload['country_code'] is None
+
+
+class CountingGeoIP(GeoIPTransformer):
+    setups = 0
+
+    def setup(self):
+        CountingGeoIP.setups += 1
+        super(CountingGeoIP, self).setup()
+
+
+def test_run_does_one_bulk_pass_over_the_store(tmp_path):
+    store = EntityStore()
+    store.add('domain', 'example.com')
+    for ip in ('192.0.2.1', '192.0.2.2'):
+        store.add('ip_address', ip, {'type': 'ip_address', 'value': ip}, 'example.com')
+    stage = CountingGeoIP(store, config={'options': {'mmdb': str(tmp_path)}})
+    stage.setup()
+    assert stage.run() is store
+    assert CountingGeoIP.setups == 1
+    assert all(record.data['geo_ip']['type'] == 'geoip_data' for record in store.iter('ip_address'))
@@ -0,0 +1,97 @@
+import trio
+
+from dnsengine import DNSAnswer
+from httpclient import ProbeResponse
+from netindex import IntervalIndex
+from pageinfo import favicon_hash
+from pipeline.http import HttpProbeTransformer, in_scope
+from store import EntityStore
+
+
+class IconProbe(HttpProbeTransformer):
+    def __init__(self, *args, **kwargs):
+        super(IconProbe, self).__init__(*args, **kwargs)
+        self.fetched = []
+
+    async def fetch(self, url, max_body=None):
+        self.fetched.append(url)
+        await trio.sleep(0.01)
+        return ProbeResponse(url, 'GET', 200, {}, b'icon')
+
+
+def favicons(pages):
+    stage = IconProbe(EntityStore(), config={'options': {}})
+    stage.setup()
+    results = [None] * len(pages)
+
+    async def run():
+        async def icon(index, url, body):
+            results[index] = await stage.favicon(url, body, 'example.com')
+
+        async with trio.open_nursery() as nursery:
+            for index, (url, body) in enumerate(pages):
+                nursery.start_soon(icon, index, url, body)
+
+    trio.run(run)
+    return results, stage.fetched
+
+
+def test_in_scope():
+    assert in_scope('example.com', 'example.com')
+    assert in_scope('www.example.com', 'example.com')
+    assert not in_scope('badexample.com', 'example.com')
+    assert not in_scope(None, 'example.com')
+
+
+def test_off_site_icons_are_not_fetched():
+    body = b'<link rel="icon" href="https://cdn.other.net/icon.png">'
+    results, fetched = favicons([('https://www.example.com/', body)])
+    assert results == [None]
+    assert fetched == []
+
+
+def test_concurrent_probes_share_one_icon_fetch():
+    # http redirecting to https: both probes end up on the same page
+    body = b'<link rel="shortcut icon" href="/static/icon.png">'
+    results, fetched = favicons([('https://www.example.com/home', body), ('https://www.example.com/home', body)])
+    assert results == [favicon_hash(b'icon')] * 2
+    assert fetched == ['https://www.example.com/static/icon.png']
+
+
+class Engine(object):
+    # Answers from a dict, like DNSEngine.resolve would for names that aren't in the store yet
+    def __init__(self, answers):
+        self.answers = answers
+
+    async def resolve(self, name, rdtype='A'):
+        return DNSAnswer(name, rdtype, addresses=self.answers.get(name))
+
+
+def edge_stage(tmp_path, cdn_hosts):
+    resolvers = tmp_path / 'resolvers.txt'
+    resolvers.write_text('127.0.0.1\n')
+    index = IntervalIndex()
+    index.add('104.16.0.0/13', 'cloudflare')
+    config = {'options': {'HttpProbeTransformer': {'cdn_hosts': cdn_hosts, 'resolvers': str(resolvers)}},
+              'cdn_ranges': index}
+    store = EntityStore()
+    store.add('domain', 'example.com')
+    stage = HttpProbeTransformer(store, config=config)
+    stage.setup()
+    stage.engine = Engine({'a.example.com': ['104.16.1.1'], 'b.example.com': ['104.16.1.2'],
+                           'c.example.com': ['203.0.113.5'], 'd.example.com': ['104.16.1.3', '203.0.113.5']})
+    return stage
+
+
+def shared_edges(stage, domains):
+    async def run():
+        return [await stage.is_shared_edge(domain) for domain in domains]
+
+    return trio.run(run)
+
+
+def test_unresolved_domains_are_resolved_before_the_cdn_check(tmp_path):
+    domains = ['a.example.com', 'b.example.com', 'c.example.com', 'd.example.com']
+    assert shared_edges(edge_stage(tmp_path, 'probe'), domains) == [False, False, False, False]
+    assert shared_edges(edge_stage(tmp_path, 'skip'), domains) == [True, True, False, False]
+    assert shared_edges(edge_stage(tmp_path, 'sample'), domains) == [False, True, False, False]
@@ -0,0 +1,65 @@
+import time
+
+import trio
+
+from httpclient import HttpClient
+
+
+def probe_all(server, paths, **kwargs):
+    async def run():
+        async with HttpClient(**kwargs) as session:
+            results = {}
+
+            async def probe(path):
+                results[path] = await session.probe(server.url + path, method='GET', retries=1)
+
+            async with trio.open_nursery() as nursery:
+                for path in paths:
+                    nursery.start_soon(probe, path)
+            return results
+
+    return trio.run(run)
+
+
+def test_capped_reads_hold_the_host_slot(http_server):
+    def respond(request):
+        def body():
+            yield b'x' * 100
+            time.sleep(0.02)
+            yield b'x' * 100
+        return 200, {'Content-Length': '200'}, body()
+
+    server = http_server(respond)
+    results = probe_all(server, [f"/{index}" for index in range(200)], connections_per_host=20)
+    assert all(response.body == b'x' * 200 for response in results.values())
+    assert len(server.clients) <= 20
+
+
+def test_capped_read_stops_at_max_body(http_server):
+    server = http_server(lambda request: (200, {}, b'y' * 5000))
+    results = probe_all(server, ['/'], max_body=1000)
+    assert results['/'].body == b'y' * 1000
+    assert results['/'].truncated
+    assert results['/'].length == 5000
+
+
+def test_head_falls_back_to_get_for_hits_without_a_length(http_server):
+    def respond(request):
+        if request.path == '/head-rejected' and request.command == 'HEAD':
+            return 405, {}, b''
+        if request.path in ('/admin', '/head-rejected'):
+            return 200, {'Transfer-Encoding': 'chunked'}, b'<html>admin</html>'
+        return 404, {'Transfer-Encoding': 'chunked'}, b'<html>not here</html>'
+
+    server = http_server(respond)
+
+    async def run():
+        async with HttpClient() as session:
+            return [await session.probe(server.url + path, method='HEAD', retries=1)
+                    for path in ('/missing', '/admin', '/head-rejected')]
+
+    missing, admin, rejected = trio.run(run)
+    assert (missing.method, missing.status_code) == ('HEAD', 404)
+    assert (admin.method, admin.body) == ('GET', b'<html>admin</html>')
+    assert (rejected.method, rejected.status_code) == ('GET', 200)
+    assert [method for method, path in server.requests if path == '/missing'] == ['HEAD']
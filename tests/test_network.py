@@ -0,0 +1,29 @@
+from geoip import geoip_payload
+from netindex import IntervalIndex, bucket_network
+from pipeline.ip import NetworkAggregatorTransformer
+from store import EntityStore
+
+
+def aggregator(geo_ips):
+    store = EntityStore()
+    store.add('domain', 'example.com')
+    for ip, geo_ip in geo_ips.items():
+        store.add('ip_address', ip, {'type': 'ip_address', 'value': ip, 'geo_ip': geo_ip}, 'example.com')
+    index = IntervalIndex()
+    index.add('104.16.0.0/13', 'cloudflare')
+    return NetworkAggregatorTransformer(store, config={'options': {}, 'cdn_ranges': index}), store
+
+
+def test_networks_come_from_cdn_ranges_then_asn_then_buckets():
+    google = geoip_payload({'autonomous_system_number': 15169, 'autonomous_system_organization': 'GOOGLE'},
+                           '8.8.8.0/24', None)
+    # Only the country database: its network is far too large to group by
+    country_only = geoip_payload(None, '8.8.0.0/14', {'country': {'iso_code': 'US'}})
+    stage, store = aggregator({'104.16.1.1': None, '8.8.8.8': google, '8.9.1.1': country_only, '8.10.1.1': None})
+    assert [stage.network(store.get('ip_address', ip)) for ip in ('104.16.1.1', '8.8.8.8', '8.9.1.1', '8.10.1.1')] == \
+        [('104.16.0.0/13', 'cloudflare'), ('8.8.8.0/24', None), ('8.9.1.0/24', None), ('8.10.1.0/24', None)]
+
+
+def test_bucket_network():
+    assert bucket_network('192.0.2.77') == '192.0.2.0/24'
+    assert bucket_network('2001:db8:1:2::1') == '2001:db8:1::/48'
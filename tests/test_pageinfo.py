@@ -0,0 +1,38 @@
+import pytest
+
+from httpclient import ProbeResponse
+from pageinfo import favicon_hash, favicon_url, link_hosts, mmh3_32, page_info, page_title
+
+PAGE = b'''<html><head><title> Home &amp;
+  away </title><link rel="shortcut icon" href="/static/fav.ico"></head>
+<body><a href="https://App.example.com/login">x</a><img src="//cdn.example.net/a.png">
+<a href="mailto:me@example.com">mail</a><a href="/about">about</a></body></html>'''
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'', 0), (b'a', 1009084850), (b'abcd', 1139631978), (b'hello world', 1586663183),
+    (b'\x00\xff' * 37, 2086378740),
+])
+def test_mmh3_32_matches_the_mmh3_package(data, expected):
+    assert mmh3_32(data) == expected
+
+
+def test_favicon_hash_hashes_the_base64_lines():
+    assert favicon_hash(b'\x00\x01icon' * 50) == -716358997
+
+
+def test_page_details():
+    assert page_title(PAGE) == 'Home & away'
+    assert favicon_url('https://example.com/home', PAGE) == 'https://example.com/static/fav.ico'
+    assert favicon_url('https://example.com/home', b'<html></html>') == 'https://example.com/favicon.ico'
+    assert link_hosts('https://example.com/home', PAGE) == {'example.com', 'app.example.com', 'cdn.example.net'}
+
+
+def test_page_info():
+    response = ProbeResponse('https://example.com/', 'GET', 200,
+                             {'server': 'nginx', 'x-powered-by': 'PHP/8.1', 'content-type': 'text/html'},
+                             PAGE[:20], length=5000, truncated=True)
+    info = page_info(response)
+    assert info['title'] is None
+    assert (info['server'], info['powered_by'], info['content_length'], info['truncated']) == \
+        ('nginx', 'PHP/8.1', 5000, True)
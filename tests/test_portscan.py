@@ -0,0 +1,81 @@
+import errno
+import os
+
+import pytest
+import trio
+
+import portscan
+from portscan import PortScanEngine, parse_port_spec
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_parse_port_spec_lists_and_ranges():
+    assert parse_port_spec('22, 80,8000-8002') == {22: None, 80: None, 8000: None, 8001: None, 8002: None}
+    assert len(parse_port_spec('all')) == 65535
+
+
+@pytest.mark.parametrize('spec', ['0', '65536', '100-90', 'http'])
+def test_parse_port_spec_rejects_bad_ports(spec):
+    with pytest.raises(ValueError):
+        parse_port_spec(spec)
+
+
+def test_parse_port_spec_files(tmp_path, monkeypatch):
+    ports = tmp_path / 'ports.txt'
+    ports.write_text('# comment\n22\tssh\n\n8080-8081\n')
+    assert parse_port_spec(str(ports)) == {22: 'ssh', 8080: None, 8081: None}
+    monkeypatch.chdir(ROOT)
+    assert len(parse_port_spec('top-1000')) == 1000
+
+
+def scan(ports, timeout=1):
+    engine = PortScanEngine(timeout=timeout)
+
+    async def run():
+        return await engine.scan('127.0.0.1', ports)
+
+    return trio.run(run), engine
+
+
+def test_open_and_closed_ports():
+    async def run():
+        listener = trio.socket.socket()
+        await listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        engine = PortScanEngine(timeout=1)
+        try:
+            return port, await engine.scan('127.0.0.1', [port, 1])
+        finally:
+            listener.close()
+
+    port, results = trio.run(run)
+    assert results == {port: 'open', 1: 'closed'}
+
+
+def test_running_out_of_local_ports_is_retried(monkeypatch):
+    socket_type = trio.socket.socket
+    failures = []
+
+    class ExhaustedSocket(object):
+        # The first connects fail the way they do with every ephemeral port in use
+        def __init__(self, *args):
+            self.socket = socket_type(*args)
+
+        def setsockopt(self, *args):
+            self.socket.setsockopt(*args)
+
+        def close(self):
+            self.socket.close()
+
+        async def connect(self, address):
+            if len(failures) < 2:
+                failures.append(address)
+                raise OSError(errno.EADDRNOTAVAIL, 'Cannot assign requested address')
+            await self.socket.connect(address)
+
+    monkeypatch.setattr(portscan.trio.socket, 'socket', ExhaustedSocket)
+    results, engine = scan([1])
+    assert results == {1: 'closed'}
+    assert len(failures) == 2
@@ -0,0 +1,45 @@
+import email.utils
+import time
+
+import trio
+
+import defaults
+from ratecontrol import AdaptiveLimiter, TokenBucket, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after(' 0 ') == 0
+    assert parse_retry_after('100000') == defaults.HTTP_MAX_RETRY_AFTER
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    date = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= parse_retry_after(date) <= 10
+    assert parse_retry_after(email.utils.formatdate(time.time() - 60, usegmt=True)) == 0
+
+
+def test_adaptive_limiter_window():
+    limiter = AdaptiveLimiter(initial=4, maximum=8)
+    limiter.on_congestion()
+    assert limiter.window == 2
+    # Failures of requests that were in flight together only halve it once
+    limiter.on_congestion()
+    assert limiter.window == 2
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.window == 8
+
+
+def test_token_bucket_paces_after_the_burst():
+    bucket = TokenBucket(rate=20, burst=2)
+    times = []
+
+    async def run():
+        start = time.monotonic()
+        for _ in range(4):
+            async with bucket:
+                times.append(time.monotonic() - start)
+
+    trio.run(run)
+    assert times[1] < 0.01
+    assert 0.04 <= times[2] < 0.08 and 0.09 <= times[3] < 0.13
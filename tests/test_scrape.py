@@ -0,0 +1,66 @@
+import json
+import time
+
+import trio
+
+from httpclient import HttpClient
+from scrape import DomainScraper, scrape_subdomains
+
+
+def source_server(http_server):
+    def respond(request):
+        if request.path.startswith('/slow'):
+            time.sleep(0.5)
+        page = int(request.path.rsplit('=', 1)[1]) if '=' in request.path else 0
+        next_page = f"/pages?page={page + 1}" if page < 2 else None
+        return 200, {}, json.dumps({'names': [f"host{page}.example.com"], 'next': next_page}).encode()
+
+    return http_server(respond)
+
+
+def scrapers(url):
+    class PagedScraper(DomainScraper):
+        SOURCE = 'paged'
+        RATE, BURST = 100, 1
+
+        async def scrape(self):
+            next_page = '/pages'
+            while next_page:
+                payload = json.loads((await self.fetch(url + next_page)).content)
+                await self.found(payload['names'])
+                next_page = payload['next']
+
+    class BrokenScraper(DomainScraper):
+        SOURCE = 'broken'
+
+        async def scrape(self):
+            await self.found(['before.example.com'])
+            raise ValueError("unexpected payload")
+
+    class SlowScraper(DomainScraper):
+        SOURCE = 'slow'
+        TIMEOUT = 0.1
+
+        async def scrape(self):
+            await self.fetch(url + '/slow')
+            await self.found(['never.example.com'])
+
+    return [PagedScraper, BrokenScraper, SlowScraper]
+
+
+def test_sources_fail_on_their_own_and_report_as_they_go(http_server):
+    server = source_server(http_server)
+    found = []
+
+    async def on_found(source, subdomains):
+        found.append((source, subdomains))
+
+    async def run():
+        async with HttpClient() as session:
+            return await scrape_subdomains('example.com', scrapers(server.url), session, on_found)
+
+    results = trio.run(run)
+    assert results == {'host0.example.com': ['paged'], 'host1.example.com': ['paged'],
+                       'host2.example.com': ['paged'], 'before.example.com': ['broken']}
+    assert [subdomains for source, subdomains in found if source == 'paged'] == \
+        [['host0.example.com'], ['host1.example.com'], ['host2.example.com']]
@@ -0,0 +1,38 @@
+import pytest
+
+from sink import fold_records, open_sink, read_records
+from store import EntityStore
+
+
+def record_run(path, output_format):
+    store = EntityStore()
+    sink = open_sink(str(path), output_format)
+    store.listeners.append(sink.on_change)
+    store.add('domain', 'example.com', {'type': 'domain', 'value': 'example.com'})
+    store.add('domain', 'www.example.com', {'type': 'domain', 'value': 'www.example.com', 'sources': ['crtsh']},
+              'example.com')
+    store.add('ip_address', '192.0.2.1', {'type': 'ip_address', 'value': '192.0.2.1'}, 'www.example.com')
+    store.add('ip_address', '192.0.2.1', {'type': 'ip_address', 'value': '192.0.2.1'}, 'example.com')
+    record, _ = store.add('tcp_port', 443, {'type': 'tcp_port', 'value': 443}, '192.0.2.1')
+    store.update(record, {'service': 'https'})
+    sink.close()
+    return store
+
+
+@pytest.mark.parametrize('output_format', ['ndjson', 'msgpack'])
+def test_records_fold_back_into_the_store(tmp_path, output_format):
+    if output_format == 'msgpack':
+        pytest.importorskip('msgpack')
+    path = tmp_path / f"run.{output_format}"
+    store = record_run(path, output_format)
+    records = list(read_records(str(path), output_format))
+    assert records[0] == {'type': 'domain', 'value': 'example.com', 'parent': None,
+                          'data': {'type': 'domain', 'value': 'example.com'}}
+    assert fold_records(records) == store.to_dict()
+
+
+def test_repeated_records_are_merged(tmp_path):
+    path = tmp_path / 'run.ndjson'
+    store = record_run(path, 'ndjson')
+    records = list(read_records(str(path)))
+    assert fold_records(records + records) == store.to_dict()
@@ -0,0 +1,39 @@
+import os
+import ssl
+
+import pytest
+
+from tlscert import CertificateCache, CertificateError, certificate_hostnames, parse_certificate
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'certificate.pem')) as handle:
+    DER = ssl.PEM_cert_to_DER_cert(handle.read())
+
+
+def test_parse_certificate():
+    cert = parse_certificate(DER)
+    assert cert['subject_cn'] == cert['issuer_cn'] == 'localhost'
+    assert cert['serial'] == '6d9b2dd6c78c6d6b7c43b7b201b979e7f48aa5b'
+    assert cert['not_before'] == '2026-10-18T09:07:03+00:00'
+    assert cert['not_after'] == '2026-11-17T09:07:03+00:00'
+    assert cert['san'] == ['localhost', 'www.localhost', '*.dev.localhost', 'x.other.com']
+    assert certificate_hostnames(cert) == ['localhost', 'www.localhost', 'dev.localhost', 'x.other.com']
+
+
+@pytest.mark.parametrize('length', range(1, len(DER), 37))
+def test_truncated_certificates(length):
+    with pytest.raises(CertificateError):
+        parse_certificate(DER[:length])
+
+
+def test_malformed_validity():
+    # The year of notBefore no longer a number
+    start = DER.index(b'261018090703Z')
+    with pytest.raises(CertificateError):
+        parse_certificate(DER[:start] + b'2x' + DER[start + 2:])
+
+
+def test_cache_ignores_what_does_not_parse():
+    cache = CertificateCache()
+    assert cache.add('127.0.0.1', 443, DER[:100]) is None
+    assert cache.add('127.0.0.1', 443, DER, 'localhost')['subject_cn'] == 'localhost'
+    assert cache.get('127.0.0.1', 443, 'localhost')['subject_cn'] == 'localhost'
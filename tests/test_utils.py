@@ -0,0 +1,20 @@
+import pytest
+
+from utils import append_path, count_lines, iter_wordlist
+
+
+@pytest.mark.parametrize('content', [b'', b'\n\n', b'a\nb\n', b'a\n\n  \nb\r\n\t\n c \nlast', b'\n\na'])
+def test_count_lines_agrees_with_iter_wordlist(tmp_path, content):
+    wordlist = tmp_path / 'words.txt'
+    wordlist.write_bytes(content)
+    assert count_lines(str(wordlist)) == len(list(iter_wordlist(str(wordlist))))
+
+
+def test_count_lines_of_sequences():
+    assert count_lines(['a', '', ' b ']) == 2
+    assert count_lines(iter(['a'])) is None
+
+
+def test_append_path():
+    assert append_path('http://example.com/', '/admin') == 'http://example.com/admin'
+    assert append_path('http://example.com', 'admin') == 'http://example.com/admin'
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+import trio
+
+from vhost import VhostClient
+
+
+def slow_server(http_server, delay):
+    def respond(request):
+        time.sleep(delay)
+        return 200, {}, f"site of {request.headers['Host']}".encode()
+
+    return http_server(respond)
+
+
+def test_queueing_for_a_connection_is_not_timed(http_server):
+    server = slow_server(http_server, 0.05)
+    port = int(server.url.rsplit(':', 1)[1])
+    hosts = [f"name{index}.example.com" for index in range(20)]
+
+    async def run():
+        responses = {}
+        async with VhostClient(connections_per_ip=1, timeout=0.3) as client:
+            async def probe(host):
+                responses[host] = await client.request('127.0.0.1', port, 'http', host)
+
+            async with trio.open_nursery() as nursery:
+                for host in hosts:
+                    nursery.start_soon(probe, host)
+            return responses, client.stats()
+
+    responses, stats = trio.run(run)
+    assert {host: response.body for host, response in responses.items()} == \
+        {host: f"site of {host}".encode() for host in hosts}
+    assert stats['connects'] == 1
+
+
+def test_a_server_that_does_not_answer_times_out(http_server):
+    server = slow_server(http_server, 1)
+    port = int(server.url.rsplit(':', 1)[1])
+
+    async def run():
+        async with VhostClient(timeout=0.2) as client:
+            await client.request('127.0.0.1', port, 'http', 'example.com')
+
+    with pytest.raises(trio.TooSlowError):
+        trio.run(run)
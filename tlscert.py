@@ -0,0 +1,224 @@
+import datetime
+import hashlib
+import ipaddress
+import ssl
+
+import trio
+
+import defaults
+
+# Only what's needed to read names and dates out of a certificate, not a general ASN.1 decoder
+TAG_SEQUENCE = 0x30
+TAG_SET = 0x31
+TAG_OID = 0x06
+TAG_UTC_TIME = 0x17
+TAG_GENERALIZED_TIME = 0x18
+TAG_EXPLICIT_VERSION = 0xa0
+TAG_EXPLICIT_EXTENSIONS = 0xa3
+TAG_SAN_DNS = 0x82
+TAG_SAN_IP = 0x87
+
+OID_COMMON_NAME = bytes.fromhex('550403')
+OID_ORGANIZATION = bytes.fromhex('55040a')
+OID_SUBJECT_ALT_NAME = bytes.fromhex('551d11')
+
+
+class CertificateError(ValueError):
+    pass
+
+
+def _read_tlv(data, offset):
+    if offset + 2 > len(data):
+        raise CertificateError("Truncated DER")
+    tag = data[offset]
+    if tag & 0x1f == 0x1f:
+        raise CertificateError("High tag numbers aren't used in certificates")
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        if not 1 <= size <= 4 or offset + size > len(data):
+            raise CertificateError("Bad DER length")
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    if offset + length > len(data):
+        raise CertificateError("Truncated DER")
+    return tag, offset, offset + length
+
+
+def _children(data, start, end):
+    while start < end:
+        tag, value_start, value_end = _read_tlv(data, start)
+        yield tag, value_start, value_end
+        start = value_end
+
+
+def _string(value):
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def _parse_name(data, start, end):
+    attributes = {}
+    for _, rdn_start, rdn_end in _children(data, start, end):
+        for _, attr_start, attr_end in _children(data, rdn_start, rdn_end):
+            (_, oid_start, oid_end), (_, value_start, value_end) = list(_children(data, attr_start, attr_end))[:2]
+            attributes.setdefault(bytes(data[oid_start:oid_end]), _string(bytes(data[value_start:value_end])))
+    return attributes
+
+
+def _parse_time(tag, value):
+    value = value.decode('ascii').rstrip('Z')
+    if tag == TAG_UTC_TIME:
+        # Two digit years, 50-99 are the 1900s
+        year = int(value[:2])
+        value = str(1900 + year if year >= 50 else 2000 + year) + value[2:]
+    return datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S').replace(tzinfo=datetime.timezone.utc).isoformat()
+
+
+def _parse_san(data, start, end):
+    names, addresses = [], []
+    _, seq_start, seq_end = _read_tlv(data, start)
+    for tag, value_start, value_end in _children(data, seq_start, seq_end):
+        value = bytes(data[value_start:value_end])
+        if tag == TAG_SAN_DNS:
+            names.append(value.decode('ascii', 'replace').lower())
+        elif tag == TAG_SAN_IP and len(value) in (4, 16):
+            addresses.append(str(ipaddress.ip_address(value)))
+    return names, addresses
+
+
+def parse_certificate(der):
+    # Whatever a peer sends, a certificate that doesn't parse is a CertificateError and nothing else
+    try:
+        return _parse_certificate(der)
+    except CertificateError:
+        raise
+    except (ValueError, IndexError, TypeError) as e:
+        raise CertificateError(f"Malformed certificate: {e!r}") from e
+
+
+def _parse_certificate(der):
+    data = memoryview(der)
+    _, cert_start, cert_end = _read_tlv(data, 0)
+    _, tbs_start, tbs_end = _read_tlv(data, cert_start)
+    fields = list(_children(data, tbs_start, tbs_end))
+    if fields and fields[0][0] == TAG_EXPLICIT_VERSION:
+        fields = fields[1:]
+    if len(fields) < 6:
+        raise CertificateError("Not a certificate")
+
+    (_, serial_start, serial_end), _, issuer, validity, subject = fields[:5]
+    issuer = _parse_name(data, issuer[1], issuer[2])
+    subject = _parse_name(data, subject[1], subject[2])
+    not_before, not_after = [_parse_time(tag, bytes(data[start:end]))
+                             for tag, start, end in _children(data, validity[1], validity[2])]
+
+    names, addresses = [], []
+    for tag, start, end in fields[6:]:
+        if tag != TAG_EXPLICIT_EXTENSIONS:
+            continue
+        _, exts_start, exts_end = _read_tlv(data, start)
+        for _, ext_start, ext_end in _children(data, exts_start, exts_end):
+            parts = list(_children(data, ext_start, ext_end))
+            if bytes(data[parts[0][1]:parts[0][2]]) == OID_SUBJECT_ALT_NAME:
+                # extnValue is the last part, an OCTET STRING wrapping the GeneralNames
+                names, addresses = _parse_san(data, parts[-1][1], parts[-1][2])
+
+    return {
+        'subject_cn': subject.get(OID_COMMON_NAME),
+        'subject_o': subject.get(OID_ORGANIZATION),
+        'issuer_cn': issuer.get(OID_COMMON_NAME),
+        'issuer_o': issuer.get(OID_ORGANIZATION),
+        'serial': format(int.from_bytes(data[serial_start:serial_end], 'big'), 'x'),
+        'not_before': not_before,
+        'not_after': not_after,
+        'san': names,
+        'san_ips': addresses,
+        'sha256': hashlib.sha256(der).hexdigest(),
+    }
+
+
+def certificate_hostnames(cert):
+    # Wildcards stand for their parent, that's the part that can be resolved
+    names = list(cert['san'])
+    if cert['subject_cn'] and '.' in cert['subject_cn'] and ' ' not in cert['subject_cn']:
+        names.append(cert['subject_cn'].lower())
+    return list(dict.fromkeys(name[2:] if name.startswith('*.') else name for name in names))
+
+
+def insecure_tls_context():
+    # Certificates are collected, not trusted, so expired, self-signed and mismatched ones are all wanted
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def fetch_certificate(ip, port, server_name=None, timeout=defaults.BANNER_TIMEOUT, stream=None):
+    with trio.fail_after(timeout):
+        if stream is None:
+            stream = await trio.open_tcp_stream(ip, port)
+        tls = trio.SSLStream(stream, insecure_tls_context(), server_hostname=server_name)
+        try:
+            await tls.do_handshake()
+            der = tls.getpeercert(binary_form=True)
+            cert = parse_certificate(der) if der else None
+            if cert is not None:
+                cert['version'] = tls.version()
+                cert['cipher'] = tls.cipher()[0]
+            return cert
+        finally:
+            await trio.aclose_forcefully(tls)
+
+
+class CertificateCache(object):
+    # Certificates seen on any connection, keyed by (host, port, server name), so stages that touch the same
+    # endpoint don't each do their own handshake
+
+    def __init__(self):
+        self.certificates = {}
+        self.pending = {}
+        self.handshakes = 0
+
+    def add(self, host, port, der, server_name=None):
+        try:
+            cert = parse_certificate(der)
+        except CertificateError:
+            return None
+        self.put(host, port, cert, server_name)
+        return cert
+
+    def add_connection(self, host, port, der):
+        # From an HTTPS connection to a host name, which is what it sent as SNI too
+        self.add(host, port, der, host)
+
+    def put(self, host, port, cert, server_name=None):
+        self.certificates[host, port, server_name] = cert
+
+    def get(self, host, port, server_name=None):
+        return self.certificates.get((host, port, server_name))
+
+    async def fetch(self, host, port, server_name=None, timeout=defaults.BANNER_TIMEOUT):
+        key = host, port, server_name
+        if key in self.certificates:
+            return self.certificates[key]
+
+        event = self.pending.get(key)
+        if event is not None:
+            await event.wait()
+            return self.certificates.get(key)
+
+        self.pending[key] = trio.Event()
+        try:
+            self.handshakes += 1
+            try:
+                cert = await fetch_certificate(host, port, server_name, timeout)
+            except (trio.TooSlowError, trio.BrokenResourceError, OSError, CertificateError):
+                cert = None
+            self.certificates[key] = cert
+            return cert
+        finally:
+            self.pending.pop(key).set()
@@ -1,6 +1,12 @@
-import click
+import mmap
 import random
-import itertools
+import re
+
+import click
+import trio
+
+# A line with something other than whitespace on it, without running into the next line
+NON_BLANK_LINE_RE = re.compile(rb'^[^\S\n]*\S', re.MULTILINE)
 
 
 def error(text):
@@ -42,10 +48,49 @@ def append_subdomain(domain, subdomain):
     return f"{subdomain}.{domain}"
 
 
-def init_source(source):
+def iter_wordlist(source):
     if isinstance(source, str):
-        source = open(source, 'r', encoding='latin-1').readlines()
-    else:
-        source = iter(itertools.tee(source))
-    return source
-
+        with open(source, 'r', encoding='latin-1') as handle:
+            yield from iter_wordlist(handle)
+        return
+
+    for line in source:
+        word = line.strip()
+        if word:
+            yield word
+
+
+def count_lines(source):
+    # What iter_wordlist yields, blank lines don't count
+    if not isinstance(source, str):
+        return sum(1 for line in source if line.strip()) if hasattr(source, '__len__') else None
+
+    with open(source, 'rb') as handle:
+        try:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return 0
+
+        with mapped:
+            return sum(1 for _ in NON_BLANK_LINE_RE.finditer(mapped))
+
+
+async def run_worker_pool(items, handler, workers, buffer_size=None):
+    send_channel, receive_channel = trio.open_memory_channel(buffer_size or workers)
+
+    async def producer():
+        async with send_channel:
+            for item in items:
+                await send_channel.send(item)
+
+    async def worker(channel):
+        async with channel:
+            async for item in channel:
+                await handler(item)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(producer)
+        async with receive_channel:
+            for _ in range(workers):
+                nursery.start_soon(worker, receive_channel.clone())
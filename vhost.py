@@ -0,0 +1,216 @@
+import random
+
+import h11
+import trio
+
+import defaults
+from fingerprint import ResponseFingerprint
+from httpclient import ProbeResponse
+from tlscert import insecure_tls_context
+from utils import random_string
+
+RECEIVE_SIZE = 65536
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class RawConnection(object):
+    # One keep-alive HTTP/1.1 connection to an IP, any Host header can be sent over it; SNI is fixed at connect
+
+    def __init__(self, stream, server_name=None):
+        self.stream = stream
+        self.server_name = server_name
+        self.http = h11.Connection(our_role=h11.CLIENT)
+        self.requests = 0
+
+    async def _next_event(self):
+        while True:
+            event = self.http.next_event()
+            if event is not h11.NEED_DATA:
+                return event
+            try:
+                data = await self.stream.receive_some(RECEIVE_SIZE)
+            except trio.BrokenResourceError as e:
+                raise ConnectionLost() from e
+            self.http.receive_data(data)
+
+    async def request(self, method, path, host, max_body):
+        # (ProbeResponse, whether the connection is good for another request)
+        headers = [
+            ('Host', host),
+            ('User-Agent', random.choice(defaults.USER_AGENTS)),
+            ('Accept', '*/*'),
+            ('Connection', 'keep-alive'),
+        ]
+        try:
+            await self.stream.send_all(self.http.send(h11.Request(method=method, target=path, headers=headers)) +
+                                       self.http.send(h11.EndOfMessage()))
+        except trio.BrokenResourceError as e:
+            raise ConnectionLost() from e
+        self.requests += 1
+
+        try:
+            response = await self._next_event()
+            while isinstance(response, h11.InformationalResponse):
+                response = await self._next_event()
+            if not isinstance(response, h11.Response):
+                raise ConnectionLost()
+
+            body, complete = b'', False
+            while len(body) < max_body:
+                event = await self._next_event()
+                if isinstance(event, h11.Data):
+                    body += event.data
+                elif isinstance(event, (h11.EndOfMessage, h11.ConnectionClosed)):
+                    complete = isinstance(event, h11.EndOfMessage)
+                    break
+        except h11.RemoteProtocolError as e:
+            raise ConnectionLost() from e
+
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in response.headers}
+        length = headers.get('content-length')
+        length = int(length) if length and length.isdigit() else None
+        probe = ProbeResponse(None, method, response.status_code, headers, body[:max_body], length,
+                              truncated=not complete)
+
+        reusable = complete and self.http.our_state is h11.DONE and self.http.their_state is h11.DONE
+        if reusable:
+            self.http.start_next_cycle()
+        return probe, reusable
+
+    async def aclose(self):
+        await trio.aclose_forcefully(self.stream)
+
+
+class VhostClient(object):
+    # Requests for many host names on few servers: connections are pooled per (ip, port, scheme) instead of per
+    # host name, and every response can be compared to what the server answers for a name it doesn't know
+
+    def __init__(self, connections=defaults.DEFAULT_CONNECTION_COUNT,
+                 connections_per_ip=defaults.VHOST_CONNECTIONS_PER_IP, max_body=defaults.HTTP_PROBE_MAX_BODY,
+                 timeout=defaults.DEFAULT_TIMEOUT, on_certificate=None):
+        self.limit = trio.CapacityLimiter(connections)
+        self.connections_per_ip = connections_per_ip
+        self.timeout = timeout
+        self.max_body = max_body
+        self.on_certificate = on_certificate
+        self.limits = {}
+        self.idle = {}
+        self.baselines = {}
+        self.pending = {}
+        self.connects = 0
+        self.requests = 0
+
+    async def _connect(self, ip, port, scheme, server_name):
+        stream = await trio.open_tcp_stream(ip, port)
+        self.connects += 1
+        if scheme == 'https':
+            # The Host header may carry a port, SNI never does
+            sni = server_name.split(':')[0] if server_name else None
+            stream = trio.SSLStream(stream, insecure_tls_context(), server_hostname=sni)
+            try:
+                await stream.do_handshake()
+            except BaseException:
+                await trio.aclose_forcefully(stream)
+                raise
+            der = stream.getpeercert(binary_form=True)
+            if der and self.on_certificate is not None:
+                self.on_certificate(ip, port, der, sni)
+        return RawConnection(stream, server_name)
+
+    def _checkout(self, key, server_name):
+        idle = self.idle.get(key)
+        if not idle:
+            return None
+        # Over TLS the name the connection was opened with fits best, any other one still does for most servers
+        for connection in idle:
+            if connection.server_name == server_name:
+                idle.remove(connection)
+                return connection
+        return idle.pop()
+
+    async def request(self, ip, port, scheme, host, path='/', method='GET', max_body=None):
+        key = ip, port, scheme
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = trio.CapacityLimiter(self.connections_per_ip)
+
+        async with self.limit, limit:
+            # Names on one IP queue up for its few connections, only the request itself is timed
+            with trio.fail_after(self.timeout):
+                connection = self._checkout(key, host)
+                while True:
+                    fresh = connection is None
+                    if fresh:
+                        connection = await self._connect(ip, port, scheme, host)
+                    try:
+                        response, reusable = await connection.request(method, path, host, max_body or self.max_body)
+                    except ConnectionLost:
+                        await connection.aclose()
+                        # A pooled connection the server already gave up on, only a fresh one failing counts
+                        if fresh:
+                            raise
+                        connection = None
+                        continue
+                    except BaseException:
+                        await connection.aclose()
+                        raise
+                    self.requests += 1
+
+                    if response.status_code == 421 and scheme == 'https' and connection.server_name != host:
+                        # Misdirected Request: this server wants the host name in SNI too
+                        if reusable:
+                            self.idle.setdefault(key, []).append(connection)
+                        else:
+                            await connection.aclose()
+                        connection = None
+                        continue
+
+                    if reusable:
+                        self.idle.setdefault(key, []).append(connection)
+                    else:
+                        await connection.aclose()
+                    response.url = f"{scheme}://{host}{path}"
+                    return response
+
+    async def baseline(self, ip, port, scheme):
+        # Fingerprint of the server's default virtual host, None when it couldn't be had
+        key = ip, port, scheme
+        if key in self.baselines:
+            return self.baselines[key]
+
+        event = self.pending.get(key)
+        if event is not None:
+            await event.wait()
+            return self.baselines.get(key)
+
+        self.pending[key] = trio.Event()
+        fingerprint = None
+        try:
+            host = f"{random_string(16, defaults.ALLOWED_CHARS).lower()}.invalid"
+            try:
+                fingerprint = ResponseFingerprint(await self.request(ip, port, scheme, host))
+            except (ConnectionLost, trio.BrokenResourceError, trio.TooSlowError, OSError):
+                pass
+            self.baselines[key] = fingerprint
+            return fingerprint
+        finally:
+            self.pending.pop(key).set()
+
+    def stats(self):
+        return {'connects': self.connects, 'requests': self.requests, 'servers': len(self.limits)}
+
+    async def close(self):
+        while self.idle:
+            _, connections = self.idle.popitem()
+            for connection in connections:
+                await connection.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        with trio.CancelScope(shield=True):
+            await self.close()